@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+from rich.console import Console
+
+from config import *
+from session import Session
+
+
+def task_id(task, line_number):
+    for key in ("id", "task_id", "request_id"):
+        if task.get(key):
+            return str(task[key])
+    return f"line_{line_number}"
+
+
+def task_prompt(task):
+    # Accept a ready-made prompt or a backlog entry with a title and body
+    if task.get("prompt"):
+        return task["prompt"]
+    return "\n\n".join(str(task[key]) for key in ("title", "body") if task.get(key))
+
+
+def load_tasks(path):
+    tasks = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            task = json.loads(line)
+            tasks.append({**task, "id": task_id(task, line_number), "prompt": task_prompt(task)})
+    return tasks
+
+
+def finished_ids(output_path, retry_failed=False):
+    # Every task with a result line is done; failed ones are rerun only on request
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line torn by the interruption belongs to a task that gets rerun
+                continue
+            if record.get("status") == "ok" or not retry_failed:
+                done.add(record["id"])
+    return done
+
+
+def workspace_name(task_id):
+    return re.sub(r"[^A-Za-z0-9._-]", "_", task_id)
+
+
+class ResultWriter:
+    # One line per finished task, flushed and fsynced so an interrupted batch knows where to resume
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a+", encoding="utf-8")
+        if self._file.tell():
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != "\n":
+                # Terminate a line torn by an interrupted run so the next result starts clean
+                self._file.write("\n")
+
+    def write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+async def execute_task(task, max_iterations, workspaces):
+    from gemini import run_automode
+
+    workspace = os.path.abspath(os.path.join(workspaces, workspace_name(task["id"])))
+    os.makedirs(workspace, exist_ok=True)
+    session = Session(cwd=workspace, session_id=f"batch_{workspace_name(task['id'])}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    started = time.time()
+    start = time.perf_counter()
+    record = {"id": task["id"], "session_id": session.session_id, "workspace": workspace}
+    try:
+        iterations = await run_automode(session, task["prompt"], task.get("max_iterations", max_iterations))
+        # The last text reply; older ones may have been spilled to disk and needn't be read back
+        reply = next((message.parts for message in reversed(session.conversation_history)
+                      if message.role == "model" and isinstance(message.parts, str)), "")
+        record.update(status="ok", iterations=iterations, response=reply)
+    except Exception as e:
+        record.update(status="error", error=f"{type(e).__name__}: {e}")
+    finally:
+        session.close()
+
+    record.update(
+        started=datetime.fromtimestamp(started).isoformat(),
+        elapsed_s=time.perf_counter() - start,
+        tokens={name: dict(tokens) for name, tokens in session.token_counters()},
+    )
+    return record
+
+
+class BatchProgress:
+    # One status line per finished task, separate from the (usually silenced) chat console
+    def __init__(self, total):
+        self.total = total
+        self.counts = {"ok": 0, "error": 0}
+        self.console = Console()
+        self.start = time.perf_counter()
+
+    def __call__(self, record):
+        self.counts[record["status"]] += 1
+        style = "green" if record["status"] == "ok" else "red"
+        tokens = sum(t["input"] + t["output"] for t in record.get("tokens", {}).values())
+        self.console.print(f"[{style}]{record['status']:>5}[/] {record['id']} "
+                           f"({record.get('elapsed_s', 0.0):.1f} s, {tokens:,} tokens) "
+                           f"[{self.counts['ok'] + self.counts['error']}/{self.total}]")
+
+    def finish(self, output):
+        self.console.print(f"Batch finished in {time.perf_counter() - self.start:.1f} s: "
+                           f"{self.counts['ok']} ok, {self.counts['error']} failed. Results in {output}")
+        return 1 if self.counts["error"] else 0
+
+
+def pending_tasks(args):
+    tasks = load_tasks(args.tasks)
+    done = finished_ids(args.output, args.retry_failed)
+    pending = [task for task in tasks if task["id"] not in done]
+    Console().print(f"{len(tasks)} tasks, {len(tasks) - len(pending)} already finished, running {len(pending)} "
+                    f"with concurrency {args.concurrency}" + (f" in each of {args.workers} workers" if args.workers > 1 else ""))
+    return pending
+
+
+async def run_task(task, args, semaphore, writer, progress):
+    async with semaphore:
+        record = await execute_task(task, args.max_iterations, args.workspaces)
+        writer.write(record)
+        progress(record)
+        return record
+
+
+async def run_batch(args):
+    pending = pending_tasks(args)
+    progress = BatchProgress(len(pending))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    writer = ResultWriter(args.output)
+    # Dozens of interleaved sessions make the chat panels unreadable; the journals keep everything
+    with nullcontext() if args.verbose else silenced_console():
+        try:
+            await asyncio.gather(*(run_task(task, args, semaphore, writer, progress) for task in pending))
+        finally:
+            writer.close()
+    return progress.finish(args.output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="gemini.py batch", description="Run tasks from a JSONL file as isolated automode sessions")
+    parser.add_argument("tasks", help="JSONL file, one task per line with a 'prompt' (or 'title' and 'body') and an optional 'id'")
+    parser.add_argument("--output", "-o", help="Results JSONL; rerunning with the same file resumes the batch (default: <tasks>.results.jsonl)")
+    parser.add_argument("--concurrency", "-c", type=int, default=BATCH_CONCURRENCY, help="Tasks in flight at once (per worker with --workers)")
+    parser.add_argument("--workers", "-w", type=int, default=BATCH_WORKERS, help="Worker processes; more than 1 spreads sessions across cores")
+    parser.add_argument("--task-timeout", type=float, default=BATCH_TASK_TIMEOUT, help="With --workers, seconds before a task's worker is killed and replaced (0 = never)")
+    parser.add_argument("--max-iterations", type=int, default=MAX_CONTINUATION_ITERATIONS, help="Automode iterations per task")
+    parser.add_argument("--workspaces", default=BATCH_WORKSPACES_DIR, help="Each task runs in its own directory under here")
+    parser.add_argument("--retry-failed", action="store_true", help="Rerun tasks whose earlier result was an error")
+    parser.add_argument("--verbose", action="store_true", help="Show every session's chat output")
+    args = parser.parse_args(argv)
+    args.output = args.output or f"{os.path.splitext(args.tasks)[0]}.results.jsonl"
+    if args.workers > 1:
+        import worker_pool
+        return worker_pool.run_pool(args)
+    return asyncio.run(run_batch(args))
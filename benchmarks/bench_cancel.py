@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MODEL_BACKEND", "fake")
+os.environ.setdefault("WATCH_BACKEND", "off")
+
+from rich.console import Console
+from rich.table import Table
+
+import config
+import gemini
+from cancellation import run_interruptible
+from fake_backend import FakeBackend, install_fake_backend, scripted, text_step, tool_step
+from messages import Message
+from session import Session
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+ORIGINAL = "def first(value):\n    return value + 1\n\n\ndef second(value):\n    return value + 2\n"
+
+
+def scenario_model_call(args, marker):
+    # Ctrl+C while the main model is still answering
+    return [text_step("Too late.", latency=args.stall)], [], "Say something.", None
+
+
+def scenario_command(args, marker):
+    # Ctrl+C while run_command waits on a shell that started a background child of its own
+    command = f"sh -c 'sleep {marker} & sleep {marker}'"
+    main = [tool_step(("run_command", {"command": command})), text_step("Done.")]
+    return main, [], "Run the command.", None
+
+
+def scenario_edit_retry(args, marker):
+    # Ctrl+C while the editor is on its second attempt, after the first applied half of the edit
+    main = [tool_step(("edit_and_apply", {"path": "module.py", "instructions": "Multiply in both functions.",
+                                          "project_context": "Benchmark module."})), text_step("Done.")]
+    editor = [
+        text_step("<SEARCH>\n    return value + 1\n</SEARCH>\n<REPLACE>\n    return value * 1\n</REPLACE>\n\n"
+                  "<SEARCH>\n    return value - 2\n</SEARCH>\n<REPLACE>\n    return value * 2\n</REPLACE>"),
+        text_step("<SEARCH>\n    return value + 2\n</SEARCH>\n<REPLACE>\n    return value * 2\n</REPLACE>", latency=args.stall),
+    ]
+    return main, editor, "Edit module.py.", "module.py"
+
+
+SCENARIOS = {
+    "model call": scenario_model_call,
+    "run_command": scenario_command,
+    "edit retry": scenario_edit_retry,
+}
+
+
+def processes_matching(marker):
+    # Processes still running with marker on their command line
+    count = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if f"sleep\0{marker}".encode() in f.read():
+                    count += 1
+        except OSError:
+            continue
+    return count
+
+
+def consistent(history):
+    # Every message a record with parts, and the history ending on the model's side
+    return all(isinstance(message, Message) and "content" not in message for message in history) and \
+        (not history or history[-1].role == "model")
+
+
+async def run_scenario(name, build, args, index):
+    marker = f"{args.stall + index / 1000:.3f}"
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_cancel_") as workdir:
+        os.chdir(workdir)
+        try:
+            with open("module.py", "w", encoding="utf-8") as f:
+                f.write(ORIGINAL)
+            main, editor, prompt, edited_path = build(args, marker)
+            # A turn before the one interrupted, so there is history for the cancel to leave alone
+            install_fake_backend(FakeBackend(scripted(main=[text_step("Hello.")] + main, code_editor=editor)))
+            session = Session(cwd=workdir)
+            await gemini.chat_with_gemini(session, "Hello.")
+            history_before = len(session.conversation_history)
+
+            async def interrupt():
+                await asyncio.sleep(args.delay)
+                sent = time.perf_counter()
+                os.kill(os.getpid(), signal.SIGINT)
+                return sent
+
+            interrupter = asyncio.create_task(interrupt())
+            _, token = await run_interruptible(session, gemini.chat_with_gemini(session, prompt))
+            returned = time.perf_counter()
+            sent = await interrupter
+            await asyncio.sleep(0.05)  # let killed processes be reaped
+            history = session.conversation_history
+            result = {
+                "scenario": name,
+                "cancelled": token.cancelled,
+                "signal_to_prompt_ms": (returned - sent) * 1000,
+                "unwind_ms": token.stop_ms,
+                "messages_before": history_before,
+                "messages_after": len(history),
+                "history_consistent": consistent(history),
+                "processes_left": processes_matching(marker),
+                "file_restored": None if edited_path is None else open(edited_path, encoding="utf-8").read() == ORIGINAL
+                and session.file_contents.get(edited_path, ORIGINAL) == ORIGINAL,
+            }
+            session.close()
+            return result
+        finally:
+            os.chdir(cwd)
+
+
+async def run(args):
+    config.console.file = open(os.devnull, "w")
+    gemini.console.file = config.console.file
+    results = []
+    for index, (name, build) in enumerate(SCENARIOS.items()):
+        for _ in range(args.repeat):
+            results.append(await run_scenario(name, build, args, index))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="How fast Ctrl+C gets a turn back to the prompt, and what it leaves behind")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--delay", type=float, default=0.3, help="Seconds into the turn to press Ctrl+C")
+    parser.add_argument("--stall", type=float, default=3.0, help="How long the stalled call would take")
+    parser.add_argument("--output", help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"cancel-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"created": datetime.now().isoformat(), "args": vars(args), "results": results}, f, indent=2)
+
+    table = Table(title=f"Cancellation benchmark (Ctrl+C after {args.delay:g} s, {args.repeat} runs each)")
+    for column in ("Scenario", "Cancelled", "Ctrl+C to prompt p50 ms", "max ms", "History consistent", "Processes left", "File restored"):
+        table.add_column(column)
+    for name in SCENARIOS:
+        rows = [result for result in results if result["scenario"] == name]
+        latencies = sorted(result["signal_to_prompt_ms"] for result in rows)
+        restored = [result["file_restored"] for result in rows if result["file_restored"] is not None]
+        table.add_row(
+            name,
+            f"{sum(result['cancelled'] for result in rows)}/{len(rows)}",
+            f"{latencies[len(latencies) // 2]:.1f}",
+            f"{latencies[-1]:.1f}",
+            f"{sum(result['history_consistent'] for result in rows)}/{len(rows)}",
+            str(sum(result["processes_left"] for result in rows)),
+            f"{sum(restored)}/{len(restored)}" if restored else "-",
+        )
+    Console().print(table)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
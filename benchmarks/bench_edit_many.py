@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MODEL_BACKEND", "fake")
+os.environ.setdefault("WATCH_BACKEND", "off")
+
+from rich.console import Console
+from rich.table import Table
+
+import config
+import gemini
+from fake_backend import FakeBackend, install_fake_backend, scripted, text_step, tool_step
+from session import Session
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+INSTRUCTIONS = "Rename compute_total to calculate_total, in its definition and at every call site."
+_FILE_UNDER_EDIT = re.compile(r"Review the entire file content to understand the context:\s*NAME = \"(mod_\d+)\"")
+
+
+def write_modules(workdir, files):
+    # A function defined in mod_0 and called from every other module
+    paths = []
+    for i in range(files):
+        path = f"mod_{i}.py"
+        with open(os.path.join(workdir, path), "w", encoding="utf-8") as f:
+            f.write(f'NAME = "mod_{i}"\n\n')
+            if i == 0:
+                f.write("def compute_total(values):\n    return sum(values)\n")
+            else:
+                f.write(f"from mod_0 import compute_total\n\n\ndef report_{i}(values):\n    return compute_total(values) + {i}\n")
+        paths.append(path)
+    return paths
+
+
+def editor_step(request):
+    # The rename for whichever module this editor request is about; concurrent requests arrive in any order
+    module = _FILE_UNDER_EDIT.search(request["system_instruction"]).group(1)
+    if module == "mod_0":
+        return text_step("<SEARCH>\ndef compute_total(values):\n</SEARCH>\n<REPLACE>\ndef calculate_total(values):\n</REPLACE>")
+    index = module.split("_")[1]
+    return text_step(
+        "<SEARCH>\nfrom mod_0 import compute_total\n</SEARCH>\n<REPLACE>\nfrom mod_0 import calculate_total\n</REPLACE>\n\n"
+        f"<SEARCH>\n    return compute_total(values) + {index}\n</SEARCH>\n<REPLACE>\n    return calculate_total(values) + {index}\n</REPLACE>"
+    )
+
+
+def main_steps(mode, paths):
+    if mode == "edit_and_apply per file":
+        calls = [("edit_and_apply", {"path": path, "instructions": INSTRUCTIONS, "project_context": "Benchmark package."}) for path in paths]
+    else:
+        calls = [("edit_many", {"paths": paths, "instructions": INSTRUCTIONS, "project_context": "Benchmark package."})]
+    return [tool_step(*calls)]
+
+
+async def run_mode(mode, args):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_edit_many_") as workdir:
+        os.chdir(workdir)
+        try:
+            paths = write_modules(workdir, args.files)
+            main = scripted(main=main_steps(mode, paths), default_text="Done.")
+
+            def responder(role, request):
+                return editor_step(request) if role == "code_editor" else main(role, request)
+
+            backend = FakeBackend(responder, latency=args.latency, jitter=args.jitter)
+            install_fake_backend(backend)
+            session = Session(cwd=workdir)
+            start = time.perf_counter()
+            await gemini.chat_with_gemini(session, "Rename compute_total to calculate_total everywhere.")
+            wall = time.perf_counter() - start
+            renamed = sum("compute_total" not in open(path, encoding="utf-8").read() for path in paths)
+            session.close()
+        finally:
+            os.chdir(cwd)
+    roles = {}
+    for call in backend.calls:
+        roles[call["role"]] = roles.get(call["role"], 0) + 1
+    return {
+        "mode": mode,
+        "files": args.files,
+        "wall_s": wall,
+        "model_calls": len(backend.calls),
+        "calls_by_role": roles,
+        "prompt_bytes": sum(call["prompt_bytes"] for call in backend.calls),
+        "files_renamed": renamed,
+    }
+
+
+async def run(args):
+    config.console.file = open(os.devnull, "w")
+    return [await run_mode(mode, args) for mode in ("edit_and_apply per file", "edit_many")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A rename across many files: one edit_and_apply per file against one edit_many call")
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Extra uniform random latency in seconds")
+    parser.add_argument("--output", help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"edit-many-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"created": datetime.now().isoformat(), "args": vars(args), "results": results}, f, indent=2)
+
+    table = Table(title=f"Multi-file edit benchmark ({args.files} files, {args.latency:g} s model latency)")
+    for column in ("Mode", "Wall s", "Model calls", "Editor calls", "Prompt bytes", "Files renamed"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(
+            result["mode"],
+            f"{result['wall_s']:.2f}",
+            str(result["model_calls"]),
+            str(result["calls_by_role"].get("code_editor", 0)),
+            f"{result['prompt_bytes']:,}",
+            f"{result['files_renamed']}/{result['files']}",
+        )
+    Console().print(table)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
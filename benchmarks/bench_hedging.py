@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MODEL_BACKEND", "fake")
+
+from rich.console import Console
+from rich.table import Table
+
+import model_client
+from fake_backend import FakeBackend, FakeGenerativeModel, install_fake_backend, text_step
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run_mode(name, args, hedging, deadline):
+    # A fresh tracker per mode, so hedging starts from the same (empty) history each time
+    model_client.latency = model_client.LatencyTracker()
+    model_client.MODEL_HEDGING = hedging
+    model_client.MODEL_HEDGE_BUDGET = args.budget
+    model_client.MODEL_DEADLINES["code_execution"] = deadline
+    backend = install_fake_backend(FakeBackend(lambda role, request: text_step("ok"), latency=args.latency,
+                                               jitter=args.jitter, tail=(args.tail_probability, args.tail_latency), seed=args.seed))
+    model = FakeGenerativeModel("fake-flash")
+    latencies = []
+    timeouts = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        nonlocal timeouts
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                # Distinct prompts of similar size, so no two requests are deduplicated by the fake backend
+                await model_client.generate_content(model, [{"role": "user", "parts": [f"Analyze run {i:06d}"]}], role="code_execution")
+            except Exception as e:
+                if type(e).__name__ != "DeadlineExceeded":
+                    raise
+                timeouts += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    wall = time.perf_counter() - start
+    hedged = sum(counts[0] for counts in model_client.latency.hedges.values())
+    won = sum(counts[1] for counts in model_client.latency.hedges.values())
+    return {
+        "mode": name,
+        "requests": args.requests,
+        "backend_calls": len(backend.calls),
+        "hedges": hedged,
+        "hedge_wins": won,
+        "timeouts": timeouts,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "wall_s": wall,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Tail latency with and without hedged model calls, against a fake backend with slow outliers")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="Usual model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--tail-probability", type=float, default=0.05, help="Share of responses that are slow")
+    parser.add_argument("--tail-latency", type=float, default=1.0, help="Extra seconds a slow response takes")
+    parser.add_argument("--budget", type=float, default=0.1, help="MODEL_HEDGE_BUDGET for the hedged run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    slow = args.latency + args.jitter + args.tail_latency
+    results = [
+        await run_mode("no hedging", args, hedging=False, deadline=slow * 10),
+        await run_mode("hedging", args, hedging=True, deadline=slow * 10),
+        # A deadline shorter than the outliers: they fail fast instead of stalling the caller
+        await run_mode("deadline only", args, hedging=False, deadline=(args.latency + args.jitter) * 4),
+    ]
+
+    output = args.output or os.path.join(RESULTS_DIR, f"hedging-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"created": datetime.now().isoformat(), "args": vars(args), "results": results}, f, indent=2)
+
+    table = Table(title=f"Hedging benchmark ({args.requests} calls, {args.tail_probability:.0%} take +{args.tail_latency:.1f}s)")
+    for column in ("Mode", "Backend calls", "Hedges (won)", "Timeouts", "p50 ms", "p90 ms", "p99 ms", "Max ms", "Wall s"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(
+            result["mode"],
+            f"{result['backend_calls']:,}",
+            f"{result['hedges']} ({result['hedge_wins']})",
+            str(result["timeouts"]),
+            *(f"{result[key]:,.1f}" for key in ("p50_ms", "p90_ms", "p99_ms", "max_ms")),
+            f"{result['wall_s']:.2f}",
+        )
+    Console().print(table)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MODEL_BACKEND", "fake")
+os.environ.setdefault("WATCH_BACKEND", "off")
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# Each mode runs in its own process, so peak RSS is that mode's alone
+MODES = {
+    "in memory": {"HISTORY_SPILL_AFTER_TURNS": "0"},
+    "spill after 20 turns": {"HISTORY_SPILL_AFTER_TURNS": "20"},
+}
+
+
+def rss_bytes():
+    # Current anonymous resident memory: resident minus file-backed pages, which leaves out the spill file's
+    # pages (clean page cache the kernel can drop). Peak comes from getrusage and counts everything
+    try:
+        with open("/proc/self/statm") as f:
+            fields = f.read().split()
+        return (int(fields[1]) - int(fields[2])) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_bytes():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def history_heap_bytes(history):
+    # Payload bytes the history keeps in memory (spilled payloads excluded)
+    total = 0
+    for message in history:
+        parts = getattr(message, "_parts", None)
+        if parts is None:
+            parts = message.get("parts") if hasattr(message, "get") else None
+        for part in parts if isinstance(parts, list) else [parts]:
+            if isinstance(part, str):
+                total += len(part)
+            for attribute in ("_content", "_args"):
+                value = getattr(part, attribute, None)
+                if isinstance(value, str):
+                    total += len(value)
+                elif isinstance(value, dict):
+                    total += len(json.dumps(value))
+            if hasattr(type(part), "pb"):
+                total += type(part).pb(part).ByteSize()
+    return total
+
+
+async def run_session(args):
+    import config
+    import gemini
+    from session import Session
+    from fake_backend import FakeBackend, install_fake_backend, scripted, text_step, tool_step
+
+    config.console.file = open(os.devnull, "w")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_memory_") as workdir:
+        os.chdir(workdir)
+        lines = args.turns * args.lines_per_read
+        with open("service.log", "w", encoding="utf-8") as f:
+            for i in range(lines):
+                f.write(f"2024-01-01T00:00:{i % 60:02d} worker-{i % 7} handled request {i} in {i % 97} ms\n")
+        main = []
+        for i in range(args.turns):
+            first = i * args.lines_per_read + 1
+            main += [
+                tool_step(("read_file", {"path": "service.log", "start_line": first, "end_line": first + args.lines_per_read - 1})),
+                text_step(f"Lines {first} onwards look normal. " + "Nothing unusual in this window. " * (args.reply_bytes // 32)),
+            ]
+        install_fake_backend(FakeBackend(scripted(main=main)))
+        session = Session(cwd=workdir)
+        # Imports and the workspace are the same in every mode; growth from here is the session's
+        rss_start = rss_bytes()
+        latencies = []
+        start = time.perf_counter()
+        try:
+            for i in range(args.turns):
+                turn_start = time.perf_counter()
+                await gemini.chat_with_gemini(session, f"Check the next {args.lines_per_read} lines of service.log ({i}).")
+                latencies.append(time.perf_counter() - turn_start)
+            history = session.conversation_history
+            result = {
+                "turns": args.turns,
+                "messages": len(history),
+                "wall_s": time.perf_counter() - start,
+                "turn_p50_ms": sorted(latencies)[len(latencies) // 2] * 1000,
+                "turn_max_ms": max(latencies) * 1000,
+                "history_heap_bytes": history_heap_bytes(history),
+                "spilled_bytes": getattr(history, "spilled_bytes", 0),
+                "rss_start_bytes": rss_start,
+                "rss_bytes": rss_bytes(),
+                "peak_rss_bytes": peak_rss_bytes(),
+            }
+        finally:
+            session.close()
+            os.chdir(cwd)
+    return result
+
+
+def run_mode(name, env, args):
+    command = [sys.executable, os.path.abspath(__file__), "--child", "--turns", str(args.turns),
+               "--lines-per-read", str(args.lines_per_read), "--reply-bytes", str(args.reply_bytes)]
+    completed = subprocess.run(command, env={**os.environ, **env}, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{name} failed:\n{completed.stderr[-2000:]}")
+    return {"mode": name, **json.loads(completed.stdout.strip().splitlines()[-1])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory use of a long synthetic session against the fake backend")
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--lines-per-read", type=int, default=200, help="Lines of log each turn's read_file returns")
+    parser.add_argument("--reply-bytes", type=int, default=600, help="Size of each model reply")
+    parser.add_argument("--output", help="Where to write the JSON results")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(run_session(args))))
+        return
+
+    from rich.console import Console
+    from rich.table import Table
+    from project_tree import format_size
+
+    results = [run_mode(name, env, args) for name, env in MODES.items()]
+
+    output = args.output or os.path.join(RESULTS_DIR, f"memory-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"created": datetime.now().isoformat(), "args": vars(args), "results": results}, f, indent=2)
+
+    table = Table(title=f"Memory benchmark ({args.turns} turns)")
+    for column in ("Mode", "Messages", "History in heap", "Spilled", "RSS growth", "Peak RSS", "Turn p50 ms", "Wall s"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(
+            result["mode"],
+            f"{result['messages']:,}",
+            format_size(result["history_heap_bytes"]),
+            format_size(result["spilled_bytes"]),
+            format_size(result["rss_bytes"] - result["rss_start_bytes"]) if result["rss_bytes"] else "n/a",
+            format_size(result["peak_rss_bytes"]),
+            f"{result['turn_p50_ms']:,.1f}",
+            f"{result['wall_s']:.1f}",
+        )
+    Console().print(table)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
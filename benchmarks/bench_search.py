@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rich.console import Console
+from rich.table import Table
+
+import code_index
+from project_tree import iter_files
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+WORDS = ["value", "handler", "request", "response", "config", "session", "result", "buffer", "stream", "token",
+         "parser", "render", "update", "delete", "create", "index", "cache", "queue", "worker", "event"]
+
+
+def build_repo(root, files):
+    # Files of ordinary-looking code; every 997th defines a symbol the searches look for
+    for i in range(files):
+        directory = os.path.join(root, "src", f"pkg_{i // 500}", f"mod_{i // 50 % 10}")
+        os.makedirs(directory, exist_ok=True)
+        body = []
+        for j in range(30):
+            a, b = WORDS[(i + j) % len(WORDS)], WORDS[(i * 7 + j * 3) % len(WORDS)]
+            body.append(f"def {a}_{b}_{j}(self, {b}):\n    return self.{a}.get({b}, {i * j % 101})\n")
+        if i % 997 == 0:
+            body.append(f"class RareSymbolHandler{i}:\n    pass\n")
+        extension = ".py" if i % 4 else ".ts"
+        with open(os.path.join(directory, f"file_{i}{extension}"), "w", encoding="utf-8") as f:
+            f.write("\n".join(body))
+
+
+def brute_force(root, pattern, glob_regex=None):
+    # What the model would otherwise do: open every file and scan every line
+    matcher = re.compile(pattern)
+    matches = 0
+    for path in iter_files(root):
+        if glob_regex and not glob_regex.match(os.path.basename(path)):
+            continue
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if matcher.search(line):
+                    matches += 1
+    return matches
+
+
+def timed(function, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="search_code against a brute-force scan on a synthetic repository")
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--output", help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    searches = {
+        "rare symbol": {"pattern": "RareSymbolHandler"},
+        "rare symbol, regex": {"pattern": r"class RareSymbol\w+\d+:", "is_regex": True},
+        "common word in *.ts": {"pattern": "self.cache.get", "glob": "*.ts"},
+        "no match": {"pattern": "nothing_defines_this"},
+    }
+    results = {"searches": {}}
+    with tempfile.TemporaryDirectory(prefix="bench_search_") as root:
+        config_dir = code_index.CODE_INDEX_DIR
+        code_index.CODE_INDEX_DIR = os.path.join(root, ".code_index")
+        build_repo(root, args.files)
+
+        start = time.perf_counter()
+        index = code_index.get_index(root)
+        index.refresh(force=True)
+        results["build_s"] = time.perf_counter() - start
+        results["trigrams"] = len(index.postings)
+        start = time.perf_counter()
+        index.save()
+        results["save_s"] = time.perf_counter() - start
+        results["index_bytes"] = os.path.getsize(code_index.index_path(index.root))
+
+        # A fresh process: load from disk, then confirm nothing changed with one stat pass
+        code_index._indexes.clear()
+        start = time.perf_counter()
+        index = code_index.get_index(root)
+        results["load_s"] = time.perf_counter() - start
+        start = time.perf_counter()
+        index.refresh(force=True)
+        results["stat_pass_s"] = time.perf_counter() - start
+
+        for name, kwargs in searches.items():
+            output = code_index.search_code(root, **kwargs)
+            warm = timed(lambda: code_index.search_code(root, **kwargs), args.runs)
+            glob_regex = re.compile(re.escape(kwargs["glob"]).replace(r"\*", ".*") + "$") if "glob" in kwargs else None
+            pattern = kwargs["pattern"] if kwargs.get("is_regex") else re.escape(kwargs["pattern"])
+            brute = timed(lambda: brute_force(root, pattern, glob_regex), max(1, args.runs // 10))
+            results["searches"][name] = {
+                "indexed_median_ms": statistics.median(warm),
+                "indexed_max_ms": max(warm),
+                "brute_force_median_ms": statistics.median(brute),
+                "output_bytes": len(output),
+            }
+
+        # One edited file is reindexed on the next search without a full rescan
+        touched = os.path.join(root, "src", "pkg_0", "mod_0", "file_1.py")
+        with open(touched, "a", encoding="utf-8") as f:
+            f.write("\nclass JustAddedSymbol:\n    pass\n")
+        # The tools' own-write path; a full rescan is timed above as the stat pass
+        index.dirty_paths.add(touched)
+        start = time.perf_counter()
+        found = "JustAddedSymbol" in code_index.search_code(root, "JustAddedSymbol")
+        results["after_edit_ms"] = (time.perf_counter() - start) * 1000
+        results["after_edit_found"] = found
+        code_index._indexes.clear()
+        code_index.CODE_INDEX_DIR = config_dir
+
+    output_path = args.output or os.path.join(RESULTS_DIR, f"search-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump({"created": datetime.now().isoformat(), "args": vars(args), "results": results}, f, indent=2)
+
+    console = Console()
+    console.print(f"Index of {args.files:,} files: built in {results['build_s']:.1f}s, {results['trigrams']:,} trigrams, "
+                  f"{results['index_bytes'] / 1024 / 1024:.1f} MB on disk, loaded in {results['load_s']:.2f}s, "
+                  f"stat pass {results['stat_pass_s']:.2f}s")
+    table = Table(title="search_code vs brute-force scan")
+    for column in ("Search", "Indexed ms (median)", "Indexed ms (max)", "Brute force ms", "Speedup", "Output bytes"):
+        table.add_column(column)
+    for name, result in results["searches"].items():
+        speedup = result["brute_force_median_ms"] / result["indexed_median_ms"] if result["indexed_median_ms"] else 0.0
+        table.add_row(name, f"{result['indexed_median_ms']:,.2f}", f"{result['indexed_max_ms']:,.2f}",
+                      f"{result['brute_force_median_ms']:,.0f}", f"{speedup:,.0f}x", f"{result['output_bytes']:,}")
+    console.print(table)
+    console.print(f"Search right after an edit: {results['after_edit_ms']:.1f} ms, new symbol found: {results['after_edit_found']}")
+    print(f"Results saved to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MODEL_BACKEND", "fake")
+
+import aiohttp
+from aiohttp import web
+from rich.console import Console
+from rich.table import Table
+
+import config
+import server
+from fake_backend import FakeBackend, install_fake_backend
+from bench_sessions import responder
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def client(http, base, index, turns, stats):
+    # One editor plugin: a session, an event stream, and a message per turn followed to turn_complete
+    async with http.post(f"{base}/sessions") as response:
+        session_id = (await response.json())["session_id"]
+    async with http.ws_connect(f"{base}/sessions/{session_id}/events") as ws:
+        for note in range(turns):
+            start = time.perf_counter()
+            while True:
+                async with http.post(f"{base}/sessions/{session_id}/messages", json={"message": f"Write note {note} for session {index}."}) as response:
+                    if response.status != 503:
+                        break
+                    stats["rejected"] += 1
+                    await asyncio.sleep(float(response.headers.get("Retry-After", 1)) / 10)
+            first_event = None
+            async for message in ws:
+                event = json.loads(message.data)
+                if first_event is None and event["event"] != "turn_started":
+                    first_event = time.perf_counter() - start
+                stats["events"] += 1
+                if event["event"] in ("turn_complete", "turn_error", "turn_cancelled"):
+                    break
+            stats["latencies"].append(time.perf_counter() - start)
+            stats["first_event"].append(first_event or 0.0)
+            if event["event"] != "turn_complete":
+                stats["failed"] += 1
+    async with http.delete(f"{base}/sessions/{session_id}"):
+        pass
+
+
+async def run_level(base, token, clients, turns):
+    stats = {"latencies": [], "first_event": [], "events": 0, "rejected": 0, "failed": 0}
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, headers={"Authorization": f"Bearer {token}"}) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http, base, index, turns, stats) for index in range(clients)))
+        wall = time.perf_counter() - start
+    return {
+        "clients": clients,
+        "turns": len(stats["latencies"]),
+        "wall_s": wall,
+        "turns_per_s": len(stats["latencies"]) / wall if wall else 0.0,
+        "latency_p50_ms": percentile(stats["latencies"], 50) * 1000,
+        "latency_p95_ms": percentile(stats["latencies"], 95) * 1000,
+        "first_event_p50_ms": percentile(stats["first_event"], 50) * 1000,
+        "events": stats["events"],
+        "rejected": stats["rejected"],
+        "failed": stats["failed"],
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the serve mode against a fake backend")
+    parser.add_argument("--clients", type=int, action="append", help="Concurrent clients (repeat for several levels; default 1, 8, 32)")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per client")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated model latency in seconds")
+    parser.add_argument("--max-in-flight", type=int, default=config.SERVER_MAX_IN_FLIGHT)
+    parser.add_argument("--output", help="Where to write the JSON results")
+    args = parser.parse_args()
+    levels = args.clients or [1, 8, 32]
+
+    config.console.file = open(os.devnull, "w")
+    install_fake_backend(FakeBackend(responder, latency=args.latency))
+
+    cwd = os.getcwd()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_server_") as root:
+        # Journals and workspaces land in the process directory
+        os.chdir(root)
+        session_server = server.SessionServer(max_sessions=max(levels), max_in_flight=args.max_in_flight)
+        app = server.create_app(session_server)
+        runner = web.AppRunner(app, keepalive_timeout=config.SERVER_KEEPALIVE_TIMEOUT)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        try:
+            for clients in levels:
+                results.append(await run_level(f"http://{host}:{port}", session_server.token, clients, args.turns))
+        finally:
+            await runner.cleanup()
+            os.chdir(cwd)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"server-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"created": datetime.now().isoformat(), "args": vars(args), "results": results}, f, indent=2)
+
+    table = Table(title=f"Server load test ({args.latency * 1000:.0f} ms model latency, {args.max_in_flight} turns in flight max)")
+    for column in ("Clients", "Turns", "Turns/s", "p50 ms", "p95 ms", "First event p50 ms", "503s", "Failed"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(
+            str(result["clients"]), str(result["turns"]), f"{result['turns_per_s']:,.1f}",
+            f"{result['latency_p50_ms']:,.1f}", f"{result['latency_p95_ms']:,.1f}",
+            f"{result['first_event_p50_ms']:,.1f}", str(result["rejected"]), str(result["failed"]),
+        )
+    Console().print(table)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MODEL_BACKEND", "fake")
+
+from rich.console import Console
+
+import config
+import gemini
+from session import Session
+from fake_backend import FakeBackend, install_fake_backend, text_step, tool_step
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+TASK_PATTERN = re.compile(r"Write note (\d+) for session (\d+)\.")
+
+
+def responder(role, request):
+    # Stateless: decide from the last message alone, so concurrent sessions cannot share a script
+    last = request["contents"][-1]
+    if any("function_response" in part for part in last["parts"]):
+        return text_step("Note written.")
+    text = " ".join(part.get("text", "") for part in last["parts"])
+    match = TASK_PATTERN.search(text)
+    if not match:
+        return text_step("Nothing to do.")
+    note, session_index = match.groups()
+    return tool_step(("create_file", {
+        "path": f"note_{note}.txt",
+        "content": f"session {session_index} note {note}\n",
+    }))
+
+
+async def run_session(index, workdir, turns):
+    session = Session(cwd=workdir)
+    try:
+        for note in range(turns):
+            await gemini.chat_with_gemini(session, f"Write note {note} for session {index}.")
+    finally:
+        session.close()
+    return session
+
+
+def check_isolation(index, session, workdir, turns):
+    problems = []
+    expected = {f"note_{note}.txt": f"session {index} note {note}\n" for note in range(turns)}
+    on_disk = {name: open(os.path.join(workdir, name), encoding="utf-8").read() for name in os.listdir(workdir) if name.startswith("note_")}
+    if on_disk != expected:
+        problems.append("workspace files")
+    if {os.path.basename(path): content for path, content in session.file_contents.items()} != expected:
+        problems.append("file_contents")
+    for message in session.conversation_history:
+        if isinstance(message.get("parts"), str) and "for session" in message["parts"] and f"for session {index}." not in message["parts"]:
+            problems.append("conversation_history")
+            break
+    # Each turn is one main model call plus one reply to the tool result
+    if session.main_model_tokens['output'] != turns * 64 or session.tool_checker_tokens['output'] != turns * 64:
+        problems.append("token counts")
+    return problems
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run many sessions concurrently in one process against a fake backend")
+    parser.add_argument("--sessions", type=int, default=32)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated model latency in seconds")
+    parser.add_argument("--output", help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    config.console.file = open(os.devnull, "w")
+    backend = install_fake_backend(FakeBackend(responder, latency=args.latency))
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_sessions_") as root:
+        # Journals (and traces, with TRACE_DIR set) land in the process directory
+        os.chdir(root)
+        try:
+            workdirs = []
+            for index in range(args.sessions):
+                workdirs.append(os.path.join(root, f"session_{index}"))
+                os.makedirs(workdirs[-1])
+            start = time.perf_counter()
+            sessions = await asyncio.gather(*(run_session(index, workdir, args.turns) for index, workdir in enumerate(workdirs)))
+            wall = time.perf_counter() - start
+            problems = {index: check_isolation(index, session, workdir, args.turns)
+                        for index, (session, workdir) in enumerate(zip(sessions, workdirs))}
+        finally:
+            os.chdir(cwd)
+
+    serial = sum(call["latency"] for call in backend.calls)
+    failed = {index: names for index, names in problems.items() if names}
+    result = {
+        "created": datetime.now().isoformat(),
+        "args": vars(args),
+        "model_calls": len(backend.calls),
+        "wall_s": wall,
+        "serial_model_time_s": serial,
+        "speedup": serial / wall if wall else 0.0,
+        "isolation_failures": failed,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"sessions-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+
+    console = Console()
+    console.print(f"{args.sessions} sessions x {args.turns} turns: {len(backend.calls)} model calls in {wall:,.2f} s "
+                  f"(model time alone would take {serial:,.2f} s serially, {result['speedup']:,.1f}x)")
+    if failed:
+        for index, names in failed.items():
+            console.print(f"[red]Session {index} leaked state: {', '.join(names)}[/]")
+    else:
+        console.print("[green]All sessions kept their history, files and token counts to themselves[/]")
+    console.print(f"Results saved to {output}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
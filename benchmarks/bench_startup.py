@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from rich.console import Console
+from rich.table import Table
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+TARGET_MS = 300
+
+# Everything the CLI does before the first prompt appears
+TO_PROMPT_SNIPPET = (
+    "import gemini; gemini.show_welcome(); "
+    "from prompt_toolkit import PromptSession; from prompt_toolkit.styles import Style"
+)
+
+
+def bench_env():
+    env = dict(os.environ)
+    env.setdefault("API_KEY", "startup-benchmark")
+    env["PYTHONWARNINGS"] = "ignore"
+    return env
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time:   self [us] | cumulative | imported package"
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def measure_imports(runs):
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import gemini"],
+            cwd=ROOT, env=bench_env(), capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr[-2000:])
+        samples.append(parse_importtime(result.stderr))
+
+    names = set().union(*samples)
+    medians = {
+        name: statistics.median(sample[name][1] for sample in samples if name in sample) / 1000
+        for name in names
+    }
+    return medians
+
+
+def measure_time_to_prompt(runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", TO_PROMPT_SNIPPET],
+            cwd=ROOT, env=bench_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark for gemini.py")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15, help="Slowest modules to report")
+    parser.add_argument("--output", help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    imports = measure_imports(args.runs)
+    timings = measure_time_to_prompt(args.runs)
+    slowest = sorted(imports.items(), key=lambda item: item[1], reverse=True)[:args.top]
+    heavy = {name: name in imports for name in ("google.generativeai", "aiohttp", "prompt_toolkit", "rich.markdown", "rich.syntax", "rich.progress")}
+    result = {
+        "created": datetime.now().isoformat(),
+        "python": sys.version,
+        "runs": args.runs,
+        "import_gemini_ms": imports.get("gemini", 0.0),
+        "time_to_prompt_ms": {
+            "median": statistics.median(timings),
+            "max": max(timings),
+            "samples": timings,
+        },
+        "target_ms": TARGET_MS,
+        "slowest_imports_ms": dict(slowest),
+        "heavy_modules_imported": heavy,
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"startup-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+
+    console = Console()
+    table = Table(title="Slowest imports (cumulative, median)")
+    table.add_column("Module")
+    table.add_column("ms", justify="right")
+    for name, ms in slowest:
+        table.add_row(name, f"{ms:,.1f}")
+    console.print(table)
+    console.print(f"import gemini: {result['import_gemini_ms']:,.1f} ms")
+    for name, loaded in heavy.items():
+        console.print(f"{name}: {'imported at startup' if loaded else 'deferred'}")
+    median = result["time_to_prompt_ms"]["median"]
+    status = "[green]within" if median <= TARGET_MS else "[red]over"
+    console.print(f"Time to prompt: {median:,.1f} ms median ({status} the {TARGET_MS} ms target[/])")
+    console.print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
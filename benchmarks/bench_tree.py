@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rich.console import Console
+from rich.table import Table
+
+import project_tree
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+
+def build_monorepo(root, packages, files_per_package, vendored_files):
+    with open(os.path.join(root, ".gitignore"), "w", encoding="utf-8") as f:
+        f.write("build/\n*.log\n")
+    for p in range(packages):
+        for sub in ("src", "tests", "build"):
+            os.makedirs(os.path.join(root, "packages", f"pkg_{p}", sub))
+        for i in range(files_per_package):
+            sub = "tests" if i % 5 == 0 else "src"
+            with open(os.path.join(root, "packages", f"pkg_{p}", sub, f"module_{i}.py"), "w", encoding="utf-8") as f:
+                f.write("def handler(value):\n    return value\n" * 20)
+        with open(os.path.join(root, "packages", f"pkg_{p}", "build", "out.log"), "w", encoding="utf-8") as f:
+            f.write("ignored\n")
+    # Dependency folders the tree should skip without reading
+    for i in range(vendored_files):
+        directory = os.path.join(root, "node_modules", f"dep_{i // 100}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"index_{i}.js"), "w", encoding="utf-8") as f:
+            f.write("module.exports = {};\n")
+
+
+def time_call(runs, **kwargs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = project_tree.render_tree(**kwargs)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples, output
+
+
+def reset_caches():
+    project_tree._dir_cache.clear()
+    project_tree._ignore_cache.clear()
+    project_tree._line_cache.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold and warm project_tree timings on a synthetic monorepo")
+    parser.add_argument("--packages", type=int, default=200)
+    parser.add_argument("--files", type=int, default=50, help="Files per package")
+    parser.add_argument("--vendored", type=int, default=20000, help="Files under node_modules")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--output", help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    cases = {
+        "depth 3": {"depth": 3},
+        "glob tests/*.py, depth 10": {"depth": 10, "glob": "*/tests/*.py"},
+        "depth 10": {"depth": 10},
+    }
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench_tree_") as root:
+        build_monorepo(root, args.packages, args.files, args.vendored)
+        for name, kwargs in cases.items():
+            reset_caches()
+            cold, output = time_call(1, path=root, **kwargs)
+            warm, _ = time_call(args.runs, path=root, **kwargs)
+            # One edited file: its directory listing is still cached, only its line count is redone
+            touched = os.path.join(root, "packages", "pkg_0", "src", "module_1.py")
+            with open(touched, "a", encoding="utf-8") as f:
+                f.write("# edited\n")
+            after_edit, _ = time_call(1, path=root, **kwargs)
+            results[name] = {
+                "cold_ms": cold[0],
+                "warm_median_ms": statistics.median(warm),
+                "after_edit_ms": after_edit[0],
+                "output_lines": output.count("\n") + 1,
+                "output_bytes": len(output),
+            }
+
+    output_path = args.output or os.path.join(RESULTS_DIR, f"tree-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump({"created": datetime.now().isoformat(), "args": vars(args), "results": results}, f, indent=2)
+
+    table = Table(title=f"project_tree on {args.packages * args.files:,} source files + {args.vendored:,} vendored")
+    for column in ("Call", "Cold ms", "Warm ms (median)", "After one edit ms", "Lines", "Bytes"):
+        table.add_column(column)
+    for name, result in results.items():
+        table.add_row(name, f"{result['cold_ms']:,.1f}", f"{result['warm_median_ms']:,.1f}",
+                      f"{result['after_edit_ms']:,.1f}", str(result["output_lines"]), f"{result['output_bytes']:,}")
+    Console().print(table)
+    print(f"Results saved to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
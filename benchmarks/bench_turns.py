@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MODEL_BACKEND", "fake")
+
+from rich.console import Console
+from rich.table import Table
+
+import config
+import gemini
+from session import Session
+from fake_backend import FakeBackend, install_fake_backend, scripted, text_step, tool_step
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+CONTINUE_PROMPT = "Continue with the next step."
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def turn(calls, reply="Done."):
+    # One main-model response with tool calls, followed by one reply per tool result
+    return [tool_step(*calls)] + [text_step(reply) for _ in calls]
+
+
+class TurnRecorder:
+    def __init__(self, backend):
+        self.backend = backend
+        self.turns = []
+        self._tool_time = 0.0
+        self._chat = gemini.chat_with_gemini
+        self._execute_tool = gemini.execute_tool
+
+    async def chat(self, *args, **kwargs):
+        first_call = len(self.backend.calls)
+        self._tool_time = 0.0
+        start = time.perf_counter()
+        result = await self._chat(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        calls = self.backend.calls[first_call:]
+        self.turns.append({
+            "latency": elapsed,
+            "tool_time": self._tool_time,
+            "model_calls": len(calls),
+            "model_time": sum(call["latency"] for call in calls),
+            "prompt_bytes": sum(call["prompt_bytes"] for call in calls),
+            "input_tokens": sum(call["input_tokens"] for call in calls),
+            "output_tokens": sum(call["output_tokens"] for call in calls),
+        })
+        return result
+
+    async def execute_tool(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self._execute_tool(*args, **kwargs)
+        finally:
+            self._tool_time += time.perf_counter() - start
+
+    def __enter__(self):
+        gemini.chat_with_gemini = self.chat
+        gemini.execute_tool = self.execute_tool
+        return self
+
+    def __exit__(self, *exc):
+        gemini.chat_with_gemini = self._chat
+        gemini.execute_tool = self._execute_tool
+
+
+# Scenarios: each returns (responder, coroutine factory) and may prepare the session's workspace
+
+def scenario_multi_tool(session, turns):
+    main = []
+    for i in range(turns):
+        main += turn([
+            ("create_file", {"path": f"module_{i}.py", "content": f"VALUE = {i}\n" * 50}),
+            ("read_file", {"path": f"module_{i}.py"}),
+            ("project_tree", {"path": "."}),
+        ])
+
+    async def run():
+        for i in range(turns):
+            await gemini.chat_with_gemini(session, f"Create module_{i}.py, read it back and list the directory.")
+
+    return scripted(main=main), run
+
+
+def scenario_large_file_edit(session, turns, lines=5000):
+    with open(session.resolve("big_module.py"), "w", encoding="utf-8") as f:
+        for i in range(lines):
+            f.write(f"def function_{i}(value):\n    return value + {i}\n\n")
+
+    main = turn([("read_file", {"path": "big_module.py"})])
+    editor = []
+    for i in range(turns):
+        main += turn([("edit_and_apply", {
+            "path": "big_module.py",
+            "instructions": f"Make function_{i} multiply instead of add.",
+            "project_context": "Synthetic benchmark module.",
+        })])
+        editor.append(text_step(
+            f"<SEARCH>\n    return value + {i}\n</SEARCH>\n<REPLACE>\n    return value * {i}\n</REPLACE>"
+        ))
+
+    async def run():
+        await gemini.chat_with_gemini(session, "Read big_module.py.")
+        for i in range(turns):
+            await gemini.chat_with_gemini(session, f"Change function_{i} to multiply.")
+
+    return scripted(main=main, code_editor=editor), run
+
+
+def scenario_long_history(session, turns, history_turns=200):
+    filler = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 30
+
+    async def run():
+        for i in range(history_turns):
+            session.conversation_history.add("user", f"Question {i}: {filler}")
+            session.conversation_history.add("model", f"Answer {i}: {filler}")
+        for i in range(turns):
+            await gemini.chat_with_gemini(session, f"Follow-up question {i}")
+
+    return scripted(), run
+
+
+def scenario_repeat_reads(session, turns, lines=2000):
+    # Automode habitually re-lists and re-reads files it has already seen
+    with open(session.resolve("service.py"), "w", encoding="utf-8") as f:
+        for i in range(lines):
+            f.write(f"HANDLER_{i} = 'handler_{i}'\n")
+
+    main = []
+    for i in range(turns):
+        main += turn([
+            ("project_tree", {"path": "."}),
+            ("read_file", {"path": "service.py"}),
+        ])
+
+    async def run():
+        for i in range(turns):
+            await gemini.chat_with_gemini(session, f"Check service.py again ({i}).")
+
+    return scripted(main=main), run
+
+
+def scenario_many_files(session, turns, files=60):
+    # A long session that reads a few modules a turn and keeps coming back to the first one
+    def module(i):
+        functions = "".join(
+            f"def handler_{i}_{j}(request, retries=3):\n"
+            f'    """Handle request {j} of module {i}, retrying transient failures."""\n'
+            f"    for attempt in range(retries):\n"
+            f"        result = request.send(timeout={j + 1})\n"
+            f"        if result.ok:\n"
+            f"            return result.value * {j}\n"
+            f"    raise RuntimeError('handler_{i}_{j} failed')\n\n\n"
+            for j in range(40)
+        )
+        return f'"""Module {i}."""\nimport os\n\nLIMIT = {i}\n\n\n{functions}'
+
+    for i in range(files):
+        with open(session.resolve(f"module_{i}.py"), "w", encoding="utf-8") as f:
+            f.write(module(i))
+    per_turn = -(-files // turns)
+    main = []
+    for i in range(turns):
+        main += turn([("read_multiple_files", {"paths": [f"module_{n}.py" for n in range(i * per_turn, min(files, (i + 1) * per_turn))]})])
+
+    async def run():
+        for i in range(turns):
+            await gemini.chat_with_gemini(session, f"Read the next modules; keep module_0.py in mind ({i}).")
+
+    return scripted(main=main), run
+
+
+def scenario_automode(session, turns):
+    main = []
+    for i in range(turns - 1):
+        main += turn([
+            ("create_folder", {"path": f"pkg_{i}"}),
+            ("create_file", {"path": f"pkg_{i}/__init__.py", "content": f"NAME = 'pkg_{i}'\n"}),
+            ("run_command", {"command": "ls"}),
+        ], reply=f"Step {i + 1} done.")
+    main.append(text_step(config.CONTINUATION_EXIT_PHRASE))
+
+    async def run():
+        await gemini.run_automode(session, "Scaffold a few packages.", max_iterations=turns)
+
+    return scripted(main=main), run
+
+
+SCENARIOS = {
+    "multi_tool": scenario_multi_tool,
+    "large_file_edit": scenario_large_file_edit,
+    "long_history": scenario_long_history,
+    "automode": scenario_automode,
+    "repeat_reads": scenario_repeat_reads,
+    "many_files": scenario_many_files,
+}
+
+
+def summarize(turns):
+    latencies = [t["latency"] for t in turns]
+    count = len(turns) or 1
+    return {
+        "turns": len(turns),
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p95_ms": percentile(latencies, 95) * 1000,
+        "tool_time_ms_per_turn": sum(t["tool_time"] for t in turns) / count * 1000,
+        "model_time_ms_per_turn": sum(t["model_time"] for t in turns) / count * 1000,
+        "model_calls_per_turn": sum(t["model_calls"] for t in turns) / count,
+        "prompt_bytes_per_turn": sum(t["prompt_bytes"] for t in turns) / count,
+        "prompt_bytes_max": max((t["prompt_bytes"] for t in turns), default=0),
+        "input_tokens_per_turn": sum(t["input_tokens"] for t in turns) / count,
+        "output_tokens_per_turn": sum(t["output_tokens"] for t in turns) / count,
+    }
+
+
+async def run_scenario(name, args):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix=f"bench_{name}_") as workdir:
+        # The journal (and traces, with TRACE_DIR set) land in the process directory, so keep them in the workspace too
+        os.chdir(workdir)
+        session = Session(cwd=workdir)
+        try:
+            responder, run = SCENARIOS[name](session, args.turns)
+            backend = install_fake_backend(FakeBackend(responder, latency=args.latency, jitter=args.jitter))
+            with TurnRecorder(backend) as recorder:
+                await run()
+        finally:
+            session.close()
+            os.chdir(cwd)
+    return {"summary": summarize(recorder.turns), "turns": recorder.turns}
+
+
+def print_results(results, baseline=None):
+    table = Table(title="Turn benchmark")
+    for column in ("Scenario", "Turns", "p50 ms", "p95 ms", "Tool ms/turn", "Prompt bytes/turn", "In tok/turn", "Out tok/turn"):
+        table.add_column(column)
+    for name, result in results.items():
+        summary = result["summary"]
+        row = [
+            summary["latency_p50_ms"],
+            summary["latency_p95_ms"],
+            summary["tool_time_ms_per_turn"],
+            summary["prompt_bytes_per_turn"],
+            summary["input_tokens_per_turn"],
+            summary["output_tokens_per_turn"],
+        ]
+        cells = [f"{value:,.1f}" for value in row]
+        if baseline and name in baseline:
+            old = baseline[name]["summary"]
+            keys = ["latency_p50_ms", "latency_p95_ms", "tool_time_ms_per_turn", "prompt_bytes_per_turn", "input_tokens_per_turn", "output_tokens_per_turn"]
+            cells = [
+                f"{cell} ({(value / old[key] - 1) * 100:+.0f}%)" if old.get(key) else cell
+                for cell, value, key in zip(cells, row, keys)
+            ]
+        table.add_row(name, str(summary["turns"]), *cells)
+    Console().print(table)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Offline per-turn benchmark against a scripted fake Gemini backend")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run (default: all)")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra uniform random latency in seconds")
+    parser.add_argument("--output", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Earlier JSON results to compare against")
+    parser.add_argument("--show-output", action="store_true", help="Keep the CLI's Rich output on the terminal")
+    args = parser.parse_args()
+
+    if not args.show_output:
+        # Still render everything, just into the void, so rendering cost stays in the numbers
+        config.console.file = open(os.devnull, "w")
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        results[name] = await run_scenario(name, args)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"turns-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "created": datetime.now().isoformat(),
+            "args": vars(args),
+            "results": results,
+        }, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MODEL_BACKEND", "fake")
+os.environ.setdefault("WATCH_BACKEND", "off")
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# A snippet importing a package that depends on another, neither of them installed anywhere
+SNIPPET = "import benchwidgets\nprint(benchwidgets.describe([3, 1, 2]))\n"
+EXPECTED = "3 widgets, largest 3"
+
+PACKAGES = {
+    "benchcore": ("", "def largest(values):\n    return max(values)\n"),
+    "benchwidgets": ("Requires-Dist: benchcore\n",
+                     "from benchcore import largest\n\n\ndef describe(values):\n"
+                     "    return f\"{len(values)} widgets, largest {largest(values)}\"\n"),
+}
+
+
+def build_wheel(directory, name, requires, source):
+    # A minimal pure-Python wheel: the module, METADATA, WHEEL and a RECORD with hashes
+    dist_info = f"{name}-1.0.dist-info"
+    files = {
+        f"{name}/__init__.py": source,
+        f"{dist_info}/METADATA": f"Metadata-Version: 2.1\nName: {name}\nVersion: 1.0\n{requires}",
+        f"{dist_info}/WHEEL": "Wheel-Version: 1.0\nGenerator: bench_venv\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+    }
+    record = []
+    for path, content in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(content.encode()).digest()).rstrip(b"=").decode()
+        record.append(f"{path},sha256={digest},{len(content.encode())}")
+    files[f"{dist_info}/RECORD"] = "\n".join(record + [f"{dist_info}/RECORD,,"]) + "\n"
+    with zipfile.ZipFile(os.path.join(directory, f"{name}-1.0-py3-none-any.whl"), "w") as wheel:
+        for path, content in files.items():
+            wheel.writestr(path, content)
+
+
+async def run_execution(args):
+    # The first execute_code in a fresh project directory, then a second one in the same venv
+    import config
+    import tools
+    from session import Session
+
+    config.console.file = open(os.devnull, "w")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_venv_") as workdir:
+        os.chdir(workdir)
+        session = Session(cwd=workdir)
+        try:
+            timings = []
+            for _ in range(2):
+                start = time.perf_counter()
+                _, output = await tools.execute_code(session, SNIPPET, timeout=args.timeout)
+                timings.append((time.perf_counter() - start, output))
+        finally:
+            session.close()
+            os.chdir(cwd)
+    (first_s, first_output), (second_s, second_output) = timings
+    return {
+        "first_s": first_s,
+        "second_s": second_s,
+        "succeeded": EXPECTED in first_output and EXPECTED in second_output,
+        "environment": first_output.split("\n\n")[0] if first_output.startswith("Environment:") else None,
+    }
+
+
+def run_mode(name, env, args):
+    command = [sys.executable, os.path.abspath(__file__), "--child", "--timeout", str(args.timeout)]
+    completed = subprocess.run(command, env={**os.environ, **env}, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{name} failed:\n{completed.stderr[-2000:]}")
+    return {"mode": name, **json.loads(completed.stdout.strip().splitlines()[-1])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to a snippet's first successful run in a fresh code_execution_env")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=30, help="execute_code timeout in seconds")
+    parser.add_argument("--output", help="Where to write the JSON results")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(run_execution(args))))
+        return
+
+    from rich.console import Console
+    from rich.table import Table
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_venv_cache_") as cache:
+        wheelhouse = os.path.join(cache, "wheelhouse")
+        os.makedirs(wheelhouse)
+        for name, (requires, source) in PACKAGES.items():
+            build_wheel(wheelhouse, name, requires, source)
+        snapshots = os.path.join(cache, "snapshots")
+        # Each run in its own process and project directory; "cold" fills the snapshot directory "warm" then uses
+        modes = [
+            ("no wheelhouse", {"CODE_WHEELHOUSE": "", "CODE_VENV_SNAPSHOT_DIR": ""}, None),
+            ("wheelhouse", {"CODE_WHEELHOUSE": wheelhouse, "CODE_VENV_SNAPSHOT_DIR": ""}, None),
+            ("wheelhouse + snapshots, cold", {"CODE_WHEELHOUSE": wheelhouse, "CODE_VENV_SNAPSHOT_DIR": snapshots}, snapshots),
+            ("wheelhouse + snapshots, warm", {"CODE_WHEELHOUSE": wheelhouse, "CODE_VENV_SNAPSHOT_DIR": snapshots}, None),
+        ]
+        for _ in range(args.repeat):
+            for name, env, clear in modes:
+                if clear:
+                    shutil.rmtree(clear, ignore_errors=True)
+                results.append(run_mode(name, env, args))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"venv-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"created": datetime.now().isoformat(), "args": vars(args), "results": results}, f, indent=2)
+
+    table = Table(title=f"First execution in a fresh venv ({args.repeat} runs each)")
+    for column in ("Mode", "Import works", "First run p50 s", "Second run p50 s"):
+        table.add_column(column)
+    for name, _, _ in modes:
+        rows = [result for result in results if result["mode"] == name]
+        first = sorted(result["first_s"] for result in rows)
+        second = sorted(result["second_s"] for result in rows)
+        table.add_row(
+            name,
+            f"{sum(result['succeeded'] for result in rows)}/{len(rows)}",
+            f"{first[len(first) // 2]:.2f}",
+            f"{second[len(second) // 2]:.2f}",
+        )
+    Console().print(table)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class CancelToken:
+    # One per running turn. Cancelling it runs the cleanups registered by what the turn has in flight (killing
+    # a command's process group, say) right away, then cancels the turn's task, which unwinds at its next await
+    def __init__(self, task):
+        self.task = task
+        self.cancelled_at = None  # perf_counter time of the cancel
+        self.stopped_at = None  # and of the turn having unwound, when run_interruptible ran it
+        self._cleanups = []
+        self._lock = threading.Lock()  # worker threads register cleanups too
+
+    @property
+    def cancelled(self):
+        return self.cancelled_at is not None
+
+    @property
+    def stop_ms(self):
+        # How long the turn took to unwind after the cancel
+        if self.cancelled_at is None or self.stopped_at is None:
+            return None
+        return (self.stopped_at - self.cancelled_at) * 1000
+
+    def on_cancel(self, callback):
+        # Runs callback on cancel, or at once if that already happened; returns it for remove()
+        with self._lock:
+            if not self.cancelled:
+                self._cleanups.append(callback)
+                return callback
+        callback()
+        return callback
+
+    def remove(self, callback):
+        with self._lock:
+            if callback in self._cleanups:
+                self._cleanups.remove(callback)
+
+    def run_cleanups(self):
+        with self._lock:
+            cleanups, self._cleanups = self._cleanups, []
+        for callback in reversed(cleanups):
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def cancel(self):
+        if self.cancelled:
+            return False
+        self.cancelled_at = time.perf_counter()
+        self.run_cleanups()
+        self.task.cancel()
+        return True
+
+
+@contextmanager
+def cancel_scope(session, token=None):
+    # session.cancel_token for the turn running in the current task. The task may also be cancelled directly
+    # rather than through the token; cleanups still registered when it unwinds run then
+    token = token or CancelToken(asyncio.current_task())
+    session.cancel_token = token
+    try:
+        yield token
+    finally:
+        token.run_cleanups()
+        session.cancel_token = None
+
+
+def kill_process_group(process):
+    # A process started in its own session, and whatever it started in turn (a Popen or an asyncio Process)
+    if process.returncode is not None:
+        return
+    try:
+        if sys.platform == "win32":
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+async def run_interruptible(session, turn):
+    # Runs the turn coroutine as its own task so Ctrl+C cancels the turn instead of the program; a second
+    # Ctrl+C while it winds down interrupts as usual. Returns (result, token); the result is None if cancelled
+    async def scoped():
+        with cancel_scope(session, token):
+            return await turn
+
+    loop = asyncio.get_running_loop()
+    task = asyncio.create_task(scoped())
+    token = CancelToken(task)
+    previous = signal.getsignal(signal.SIGINT)
+
+    def interrupt(signum, frame):
+        if token.cancelled:
+            raise KeyboardInterrupt
+        loop.call_soon_threadsafe(token.cancel)
+
+    signal.signal(signal.SIGINT, interrupt)
+    try:
+        await asyncio.wait({task})
+    except asyncio.CancelledError:
+        token.cancel()
+        raise
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    token.stopped_at = time.perf_counter()
+    if task.cancelled():
+        return None, token
+    return task.result(), token
@@ -0,0 +1,389 @@
+import atexit
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python 3.10 and older
+    import sre_parse
+
+from config import (
+    CODE_INDEX_DIR, CODE_INDEX_MAX_FILE_BYTES, CODE_INDEX_SAVE_INTERVAL,
+    CODE_SEARCH_CONTEXT_LINES, CODE_SEARCH_MAX_MATCHES, CODE_SEARCH_MAX_BYTES,
+)
+from file_watcher import get_watcher
+from project_tree import iter_files
+from tool_memo import PATH_MUTATING_TOOLS, SUBPROCESS_TOOLS, tool_paths
+
+INDEX_VERSION = 2
+# The index file: magic, version and the length of a JSON header holding the file table, then the posting lists
+# as raw arrays (trigram keys, list lengths, file ids). Plain data, so a planted index can't run anything
+INDEX_MAGIC = b"GEIDX\0"
+INDEX_HEADER = struct.Struct("<6sIQ")
+MAX_LINE_CHARS = 300
+
+
+def trigrams(data):
+    # Lowercased so one index serves case-sensitive and case-insensitive searches
+    data = data.lower()
+    return set(zip(data, data[1:], data[2:]))
+
+
+def required_literals(pattern, is_regex):
+    # Substrings every match must contain; an empty list means the index can't narrow the search
+    if not is_regex:
+        return [pattern]
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return []
+    literals = []
+    run = []
+    for op, value in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(chr(value))
+            continue
+        # Anything else (classes, repeats, groups, alternation) ends the current run
+        literals.append("".join(run))
+        run = []
+    literals.append("".join(run))
+    return [literal for literal in literals if len(literal) >= 3]
+
+
+class CodeIndex:
+    # Trigram -> ids of files containing it; changed files get a fresh id and their old one is retired
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.paths = []  # id -> path relative to root, None once retired
+        self.files = {}  # absolute path -> (id, mtime_ns, size)
+        self.postings = {}
+        self.unsearchable = set()  # ids of binary and oversized files
+        self.retired = 0
+        self.last_refresh = None
+        self.watch = None
+        self.last_save = time.monotonic()
+        self.dirty_paths = set()
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def _add(self, path, st):
+        file_id = len(self.paths)
+        self.paths.append(os.path.relpath(path, self.root).replace(os.sep, "/"))
+        self.files[path] = (file_id, st.st_mtime_ns, st.st_size)
+        if st.st_size > CODE_INDEX_MAX_FILE_BYTES:
+            self.unsearchable.add(file_id)
+            return
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            self.unsearchable.add(file_id)
+            return
+        if b"\0" in data[:8192]:
+            self.unsearchable.add(file_id)
+            return
+        for key in trigrams(data):
+            posting = self.postings.get(key)
+            if posting is None:
+                self.postings[key] = array("I", (file_id,))
+            else:
+                posting.append(file_id)
+
+    def _retire(self, path):
+        file_id = self.files.pop(path)[0]
+        self.paths[file_id] = None
+        self.unsearchable.discard(file_id)
+        self.retired += 1
+
+    def _update(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        entry = self.files.get(path)
+        if entry is not None and st is not None and entry[1:] == (st.st_mtime_ns, st.st_size):
+            return False
+        if entry is not None:
+            self._retire(path)
+        if st is not None:
+            self._add(path, st)
+        return True
+
+    def refresh(self, force=False):
+        changed = False
+        if self.watch is not None:
+            watched, rescan = self.watch.drain()
+            self.dirty_paths.update(watched)
+            force = force or rescan
+        for path in list(self.dirty_paths):
+            self.dirty_paths.discard(path)
+            if os.path.isdir(path):
+                force = True
+            elif self._update(path):
+                changed = True
+        # The whole tree is only rescanned on first use, when the watcher lost events, and after commands that
+        # could have changed anything the watcher doesn't cover; otherwise the changes it reports are enough
+        if force or self.last_refresh is None:
+            seen = set()
+            for path in iter_files(self.root):
+                seen.add(path)
+                if self._update(path):
+                    changed = True
+            for path in [path for path in self.files if path not in seen]:
+                self._retire(path)
+                changed = True
+            self.last_refresh = time.monotonic()
+        if self.retired > max(1000, len(self.files) // 4):
+            self._compact()
+        self.changed = self.changed or changed
+        return changed
+
+    def _compact(self):
+        # Renumber the live files and drop retired ids from every posting list
+        mapping = {}
+        paths = []
+        for old_id, path in enumerate(self.paths):
+            if path is not None:
+                mapping[old_id] = len(paths)
+                paths.append(path)
+        postings = {}
+        for key, posting in self.postings.items():
+            kept = array("I", (mapping[file_id] for file_id in posting if file_id in mapping))
+            if kept:
+                postings[key] = kept
+        self.files = {path: (mapping[entry[0]], *entry[1:]) for path, entry in self.files.items()}
+        self.unsearchable = {mapping[file_id] for file_id in self.unsearchable}
+        self.paths = paths
+        self.postings = postings
+        self.retired = 0
+
+    def candidates(self, literals):
+        # Live file ids containing every trigram of every required literal, lazily and in id order
+        keys = set()
+        for literal in literals:
+            keys.update(trigrams(literal.encode("utf-8")))
+        postings = []
+        for key in keys:
+            posting = self.postings.get(key)
+            if posting is None:
+                return
+            postings.append(posting)
+        if not postings:
+            for file_id, path in enumerate(self.paths):
+                if path is not None and file_id not in self.unsearchable:
+                    yield file_id
+            return
+        # Posting lists are sorted, so the others are probed by bisection instead of being intersected
+        # up front; a search that fills its output early only pays for the candidates it looked at
+        postings.sort(key=len)
+        others = postings[1:]
+        for file_id in postings[0]:
+            if self.paths[file_id] is None:
+                continue
+            for posting in others:
+                position = bisect_left(posting, file_id)
+                if position == len(posting) or posting[position] != file_id:
+                    break
+            else:
+                yield file_id
+
+    def search(self, pattern, glob=None, is_regex=False, case_sensitive=True, context=CODE_SEARCH_CONTEXT_LINES,
+               max_matches=CODE_SEARCH_MAX_MATCHES, max_bytes=CODE_SEARCH_MAX_BYTES):
+        flags = 0 if case_sensitive else re.IGNORECASE
+        matcher = re.compile(pattern if is_regex else re.escape(pattern), flags)
+        glob_regex = re.compile(fnmatch.translate(glob)) if glob else None
+
+        literals = required_literals(pattern, is_regex)
+        if matcher.flags & re.IGNORECASE:
+            # The index only folds ASCII case
+            literals = [literal for literal in literals if literal.isascii()]
+        files = (self.paths[file_id] for file_id in self.candidates(literals))
+        if glob_regex:
+            files = (relative for relative in files if glob_regex.match(relative) or glob_regex.match(relative.rpartition("/")[2]))
+
+        output = []
+        size = 0
+        matches = 0
+        matched_files = 0
+        truncated = False
+        for relative in files:
+            try:
+                with open(os.path.join(self.root, relative), "r", encoding="utf-8", errors="replace") as f:
+                    lines = f.read().splitlines()
+            except OSError:
+                continue
+            hits = [number for number, line in enumerate(lines) if matcher.search(line)]
+            if not hits:
+                continue
+            hit_set = set(hits)
+            matched_files += 1
+            if output:
+                output.append("--")
+            last_shown = -1
+            for number in hits:
+                if matches >= max_matches:
+                    truncated = True
+                    break
+                start, end = max(last_shown + 1, number - context), min(len(lines), number + context + 1)
+                if last_shown >= 0 and start > last_shown + 1:
+                    output.append("--")
+                block = []
+                for index in range(start, end):
+                    marker = ":" if index in hit_set else "-"
+                    block.append(f"{relative}{marker}{index + 1}{marker} {lines[index][:MAX_LINE_CHARS]}")
+                block_size = sum(len(line) + 1 for line in block)
+                if size + block_size > max_bytes and matches:
+                    truncated = True
+                    break
+                output.extend(block)
+                size += block_size
+                matches += 1
+                last_shown = max(last_shown, end - 1)
+            if truncated:
+                break
+
+        if not output:
+            return f"No matches for {pattern!r}" + (f" in files matching {glob!r}" if glob else "") + "."
+        summary = f"{matches} matching line{'s' if matches != 1 else ''} in {matched_files} file{'s' if matched_files != 1 else ''}"
+        if truncated:
+            summary += " (results capped; refine the pattern or glob to see more)"
+        return summary + "\n\n" + "\n".join(output)
+
+    def save(self):
+        path = index_path(self.root)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        keys = list(self.postings)
+        header = json.dumps({
+            "root": self.root,
+            "byteorder": sys.byteorder,
+            "paths": self.paths,
+            "files": [[file_path, *entry] for file_path, entry in self.files.items()],
+            "unsearchable": sorted(self.unsearchable),
+            "retired": self.retired,
+            "postings": len(keys),
+        }).encode("utf-8")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(header)))
+            f.write(header)
+            f.write(bytes(byte for key in keys for byte in key))
+            array("I", (len(self.postings[key]) for key in keys)).tofile(f)
+            for key in keys:
+                self.postings[key].tofile(f)
+        os.replace(tmp_path, path)
+        self.changed = False
+        self.last_save = time.monotonic()
+
+    @classmethod
+    def load(cls, root):
+        # An index file that is missing, stale or doesn't add up is ignored and the tree rescanned
+        index = cls(root)
+        try:
+            with open(index_path(index.root), "rb") as f:
+                magic, version, header_size = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                    return index
+                state = json.loads(f.read(header_size))
+                if state["root"] != index.root or state["byteorder"] != sys.byteorder:
+                    return index
+                count = state["postings"]
+                keys = f.read(3 * count)
+                lengths = array("I")
+                lengths.fromfile(f, count)
+                ids = array("I")
+                ids.frombytes(f.read())
+            paths = state["paths"]
+            files = {file_path: (file_id, mtime_ns, size) for file_path, file_id, mtime_ns, size in state["files"]}
+            if len(keys) != 3 * count or sum(lengths) != len(ids) or (ids and max(ids) >= len(paths)) \
+                    or any(not 0 <= entry[0] < len(paths) for entry in files.values()):
+                return index
+        except (OSError, ValueError, TypeError, KeyError, EOFError, struct.error):
+            return index
+        postings = {}
+        offset = 0
+        for i, length in enumerate(lengths):
+            postings[tuple(keys[3 * i:3 * i + 3])] = ids[offset:offset + length]
+            offset += length
+        index.paths = paths
+        index.files = files
+        index.postings = postings
+        index.unsearchable = set(state["unsearchable"])
+        index.retired = state["retired"]
+        return index
+
+
+def index_path(root):
+    return os.path.join(CODE_INDEX_DIR, f"{hashlib.sha256(root.encode('utf-8')).hexdigest()[:16]}.index")
+
+
+# One index per project root, shared by every session working in it
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(root):
+    root = os.path.abspath(root)
+    with _indexes_lock:
+        return _get_index(root)
+
+
+def _get_index(root):
+    index = _indexes.get(root)
+    if index is None:
+        # Watch before the first scan so nothing changed in between is missed
+        watcher = get_watcher()
+        watch = watcher.subscribe(root) if watcher is not None else None
+        index = _indexes[root] = CodeIndex.load(root)
+        index.watch = watch
+    return index
+
+
+def search_code(root, pattern, glob=None, is_regex=False, case_sensitive=True):
+    index = get_index(root)
+    # Sessions sharing a root search from worker threads; one refresh at a time
+    with index.lock:
+        index.refresh()
+        result = index.search(pattern, glob, is_regex, case_sensitive)
+        if index.changed and time.monotonic() - index.last_save >= CODE_INDEX_SAVE_INTERVAL:
+            index.save()
+    return result
+
+
+def invalidate_for_tool(session, tool_name, tool_input):
+    # Our own writes are picked up on the next search without waiting for the watcher. Searches refresh
+    # indexes from worker threads, so each one is only touched under its lock
+    if tool_name not in SUBPROCESS_TOOLS and tool_name not in PATH_MUTATING_TOOLS:
+        return
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    paths = [os.path.normpath(session.resolve(path)) for path in tool_paths(tool_name, tool_input)]
+    for index in indexes:
+        with index.lock:
+            if tool_name in SUBPROCESS_TOOLS:
+                if index.watch is None or not index.watch.complete:
+                    index.last_refresh = None
+            else:
+                index.dirty_paths.update(path for path in paths if path.startswith(index.root + os.sep))
+
+
+@atexit.register
+def _save_changed():
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        with index.lock:
+            if not index.changed:
+                continue
+            try:
+                index.save()
+            except OSError:
+                pass
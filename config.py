@@ -1,57 +1,213 @@
 from dotenv import load_dotenv
 from rich.console import Console
 from rich.panel import Panel
-from rich.syntax import Syntax
-from rich.markdown import Markdown
 
-import google.generativeai as genai
 import os
+from contextlib import contextmanager
 
 load_dotenv()
-console = Console()
-automode = False
-MAX_CONTINUATION_ITERATIONS = 25
-CONTINUATION_EXIT_PHRASE = "AUTOMODE_COMPLETE"
 
-# Token tracking variables
-main_model_tokens = {'input': 0, 'output': 0}
-tool_checker_tokens = {'input': 0, 'output': 0}
-code_editor_tokens = {'input': 0, 'output': 0}
-code_execution_tokens = {'input': 0, 'output': 0}
+# Spans of the last TRACE_MAX_TRACES turns are kept for /profile; with TRACE_DIR set, every trace is also written
+# there as OpenTelemetry JSON lines, one file per process
+TRACE_DIR = os.getenv("TRACE_DIR") or None
+TRACE_MAX_TRACES = int(os.getenv("TRACE_MAX_TRACES", 200))
+
+
+class TracedConsole(Console):
+    # Rendering inside a turn shows up as its own span in /profile
+    def print(self, *objects, **kwargs):
+        # Imported here: tracing reads its settings from this module
+        from tracing import span, current_span
+
+        if current_span() is None:
+            return super().print(*objects, **kwargs)
+        with span("render", renderable=type(objects[0]).__name__ if objects else ""):
+            return super().print(*objects, **kwargs)
 
-# Set up the conversation memory (maintains context for MAINMODEL)
-conversation_history = []
 
-# Store file contents (part of the context for MAINMODEL)
-file_contents = {}
+console = TracedConsole()
 
-# Code editor memory (maintains some context for CODEEDITORMODEL between calls)
-code_editor_memory = []
 
-# Files already present in code editor's context
-code_editor_files = set()
+@contextmanager
+def silenced_console():
+    # Chat output goes nowhere while the block runs, e.g. with many sessions sharing one terminal
+    with open(os.devnull, "w") as sink:
+        original = console.file
+        console.file = sink
+        try:
+            yield
+        finally:
+            console.file = original
 
-# automode flag
-automode = False
 
-# Store file contents
-file_contents = {}
+# Syntax pulls in pygments and Markdown pulls in markdown-it, so both are imported on first use
+def Syntax(*args, **kwargs):
+    from rich.syntax import Syntax
+    return Syntax(*args, **kwargs)
 
-# Global dictionary to store running processes
-running_processes = {}
+
+def Markdown(*args, **kwargs):
+    from rich.markdown import Markdown
+    return Markdown(*args, **kwargs)
+
+
+# Conversation state (history, file contents, token counts, processes) lives on session.Session
 
 # Constants
 CONTINUATION_EXIT_PHRASE = "AUTOMODE_COMPLETE"
 MAX_CONTINUATION_ITERATIONS = 25
+# Closes a turn the user cancelled after some of its tools ran
+CANCELLED_TURN_MESSAGE = "The user cancelled this turn before it finished; the tool results above are all that got done."
 MAX_CONTEXT_TOKENS = 200000  # Reduced to 200k tokens for context window
 
+# Model request cache: "passthrough" (off), "record" (serve hits, store misses) or "replay" (offline, hits only)
+MODEL_CACHE_MODE = os.getenv("MODEL_CACHE_MODE", "passthrough").lower()
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", ".model_cache")
+MODEL_CACHE_MAX_BYTES = int(os.getenv("MODEL_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# "gemini" talks to the API, "fake" runs against the scripted backend in fake_backend.py
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini").lower()
+
+# Model calls run on their own thread pool so many sessions can wait on the API at once
+MODEL_MAX_CONCURRENT_REQUESTS = int(os.getenv("MODEL_MAX_CONCURRENT_REQUESTS", 32))
+
+# Requests per minute shared by every session in the process (0 = no limit)
+MODEL_REQUESTS_PER_MINUTE = int(os.getenv("MODEL_REQUESTS_PER_MINUTE", 0))
+
+# Seconds a model call may take, by role, before it fails with DeadlineExceeded
+MODEL_DEADLINES = {
+    "main": float(os.getenv("MODEL_DEADLINE", 180)),
+    "tool_checker": 90.0,
+    "code_editor": 180.0,
+    "code_execution": 60.0,
+}
+# Hedging: a call still running after the p90 latency seen for its model, role and prompt size gets a duplicate,
+# and whichever answers first wins. At most MODEL_HEDGE_BUDGET of calls are hedged
+MODEL_HEDGING = os.getenv("MODEL_HEDGING", "off").lower() == "on"
+MODEL_HEDGE_BUDGET = float(os.getenv("MODEL_HEDGE_BUDGET", 0.1))
+MODEL_HEDGE_PERCENTILE = 90
+MODEL_HEDGE_MIN_SAMPLES = 20  # latencies needed before hedging a bucket
+MODEL_LATENCY_WINDOW = 200  # recent latencies kept per bucket
+
+# Headless batch runs: tasks in flight at once, and where each task gets its workspace
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+BATCH_WORKSPACES_DIR = os.getenv("BATCH_WORKSPACES_DIR", "batch_workspaces")
+# Worker processes for batch runs, and how long one task may run before its worker is killed
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 1))
+BATCH_TASK_TIMEOUT = float(os.getenv("BATCH_TASK_TIMEOUT", 1800))
+
+# Server mode: sessions kept open, turns running at once, and per-client event buffering
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 8765))
+SERVER_MAX_SESSIONS = int(os.getenv("SERVER_MAX_SESSIONS", 64))
+SERVER_MAX_IN_FLIGHT = int(os.getenv("SERVER_MAX_IN_FLIGHT", 16))
+SERVER_WORKSPACES_DIR = os.getenv("SERVER_WORKSPACES_DIR", "server_workspaces")
+# Clients send "Authorization: Bearer <token>"; without SERVER_TOKEN one is generated at startup and printed. Requests
+# must name one of the allowed hosts in Host, and browsers may only call in from the allowed origins
+SERVER_TOKEN = os.getenv("SERVER_TOKEN") or None
+SERVER_ALLOWED_HOSTS = [host.strip() for host in os.getenv("SERVER_ALLOWED_HOSTS", "").split(",") if host.strip()]
+SERVER_ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv("SERVER_ALLOWED_ORIGINS", "").split(",") if origin.strip()]
+SERVER_KEEPALIVE_TIMEOUT = 75  # seconds an idle HTTP connection stays open
+SESSION_EVENT_QUEUE_SIZE = 256  # events buffered per client before the session waits for it
+SESSION_EVENT_TIMEOUT = 30  # seconds a session waits on a full client before dropping it
+
+# project_tree tool: default depth, entries listed before truncating, largest file whose lines are counted
+PROJECT_TREE_DEPTH = 3
+PROJECT_TREE_MAX_ENTRIES = 400
+PROJECT_TREE_LINE_COUNT_MAX_BYTES = 1024 * 1024
+
+# read_file / read_multiple_files: bytes returned per file and per call, when to mmap, and reader threads
+READ_MAX_FILE_BYTES = int(os.getenv("READ_MAX_FILE_BYTES", 256 * 1024))
+READ_MAX_TOTAL_BYTES = int(os.getenv("READ_MAX_TOTAL_BYTES", 1024 * 1024))
+READ_MMAP_THRESHOLD = 1024 * 1024
+READ_WORKERS = 8
+# Ranged reads: lines returned when only start_line is given, and context around each around_pattern match
+READ_DEFAULT_RANGE_LINES = 200
+READ_PATTERN_CONTEXT_LINES = 20
+READ_PATTERN_MAX_MATCHES = 10
+
+# edit_and_apply on files of EDIT_WINDOW_MIN_LINES or more sends the editor only the lines around what the
+# instructions mention, up to EDIT_WINDOW_MAX_LINES
+EDIT_WINDOW_MIN_LINES = int(os.getenv("EDIT_WINDOW_MIN_LINES", 400))
+EDIT_WINDOW_CONTEXT_LINES = 60
+EDIT_WINDOW_MAX_LINES = 600
+# edit_many: files per call, all edited concurrently and written together
+EDIT_MANY_MAX_FILES = int(os.getenv("EDIT_MANY_MAX_FILES", 20))
+
+# The editor's memory of earlier edits: applied-diff summaries kept per file within a token budget, and
+# only those for the file being edited and the files importing it (or imported by it) are sent
+EDITOR_MEMORY_TOKEN_BUDGET = int(os.getenv("EDITOR_MEMORY_TOKEN_BUDGET", 4000))
+EDITOR_MEMORY_ENTRY_TOKENS = 300
+EDITOR_MEMORY_MAX_AGE = 20  # turns
+
+# A file the model has seen comes back as a diff against that version, unless the diff is over this share of the
+# file (or the diffs since the last full copy add up to more than the file), when the whole file is resent
+FILE_STATE_MAX_DIFF_RATIO = 0.5
+
+# Files the model hasn't read, edited or mentioned for CONTEXT_OUTLINE_AFTER_TURNS turns are cut down to an outline
+# (signatures, classes, line spans) in the history, as are the least recently used ones while the files in context
+# come to more than CONTEXT_FILE_TOKEN_BUDGET; mentioning or editing one brings the full text back
+CONTEXT_OUTLINE_AFTER_TURNS = int(os.getenv("CONTEXT_OUTLINE_AFTER_TURNS", 5))
+CONTEXT_FILE_TOKEN_BUDGET = int(os.getenv("CONTEXT_FILE_TOKEN_BUDGET", MAX_CONTEXT_TOKENS // 2))
+
+# execute_code installs the third-party packages a snippet imports from CODE_WHEELHOUSE (a directory of .whl files,
+# installed offline) before running it. With CODE_VENV_SNAPSHOT_DIR set, a copy of code_execution_env is kept for
+# each set of installed packages, and a new venv needing a set already seen is cloned from it
+CODE_WHEELHOUSE = os.path.expanduser(os.getenv("CODE_WHEELHOUSE", "")) or None
+CODE_VENV_SNAPSHOT_DIR = os.path.expanduser(os.getenv("CODE_VENV_SNAPSHOT_DIR", "")) or None
+CODE_VENV_INSTALL_TIMEOUT = float(os.getenv("CODE_VENV_INSTALL_TIMEOUT", 300))
+
+# Images are downscaled and recompressed before upload, and an upload is reused while the same image is sent again
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", ".image_cache")
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1568))  # longest side in pixels
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 1024 * 1024))  # JPEG quality is lowered until it fits
+IMAGE_JPEG_QUALITY = 85
+
+# Filesystem watcher keeping file_contents and the code index in step with edits made outside the tools
+WATCH_BACKEND = os.getenv("WATCH_BACKEND", "auto")  # auto | inotify | poll | off
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", 1.0))  # seconds between polls without inotify
+WATCH_POLL_BATCH = 2000  # files stat'ed per poll, on top of the ones in context
+WATCH_MAX_DIRS = 4096  # bigger trees only get the files in context watched
+
+# search_code tool: trigram index location and upkeep, and how much a search may return
+CODE_INDEX_DIR = os.path.expanduser(os.getenv("CODE_INDEX_DIR", os.path.join(os.getenv("XDG_CACHE_HOME", "~/.cache"), "gemini-engineer", "code_index")))
+CODE_INDEX_MAX_FILE_BYTES = int(os.getenv("CODE_INDEX_MAX_FILE_BYTES", 2 * 1024 * 1024))
+CODE_INDEX_SAVE_INTERVAL = 60  # seconds between writing an updated index to disk
+CODE_SEARCH_CONTEXT_LINES = 2
+CODE_SEARCH_MAX_MATCHES = 50
+CODE_SEARCH_MAX_BYTES = 8000
+
+# Session journal: every message, tool call and token delta is appended as it happens
+SESSIONS_DIR = os.getenv("SESSIONS_DIR", "sessions")
+JOURNAL_FSYNC_EVERY = 32  # records between fsyncs
+JOURNAL_FSYNC_INTERVAL = 1.0  # seconds between fsyncs
+JOURNAL_INLINE_BYTES = 4096  # larger payloads go to the content-addressed blob store
+
+# Conversation history: payloads of turns older than HISTORY_SPILL_AFTER_TURNS (0 keeps everything in memory) move
+# to a memory-mapped scratch file, read back when a request needs them
+HISTORY_SPILL_AFTER_TURNS = int(os.getenv("HISTORY_SPILL_AFTER_TURNS", 20))
+HISTORY_SPILL_MIN_BYTES = 1024  # smaller payloads stay in memory
+HISTORY_SPILL_DIR = os.getenv("HISTORY_SPILL_DIR") or None  # default: the system temp directory
 
 
 #Configure the API key directly in the script
 API_KEY = os.getenv("API_KEY")
-if not API_KEY:
-    raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
-genai.configure(api_key=API_KEY)
+_genai_configured = False
+
+
+def load_genai():
+    # google.generativeai takes most of a second to import, so it is loaded and configured on first use
+    global _genai_configured
+    import google.generativeai as genai
+    if not _genai_configured:
+        if API_KEY:
+            genai.configure(api_key=API_KEY)
+        elif MODEL_CACHE_MODE != "replay" and MODEL_BACKEND != "fake":
+            # Replay mode and the fake backend answer every request locally, so they can run offline
+            raise ValueError("API_KEY not found in environment variables")
+        _genai_configured = True
+    return genai
+
 # Model name
 MAINMODEL = "gemini-1.5-pro-latest"
 
@@ -60,6 +216,29 @@ TOOLCHECKERMODEL = "gemini-1.5-pro-latest"
 CODEEDITORMODEL = "gemini-1.5-pro-latest"
 CODEEXECUTIONMODEL = "gemini-1.5-pro-latest"
 
+# "adaptive" picks a tier per call (model_router.py); "fixed" always uses the four models above
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "adaptive").lower()
+MODEL_FIXED = {"main": MAINMODEL, "tool_checker": TOOLCHECKERMODEL, "code_editor": CODEEDITORMODEL, "code_execution": CODEEXECUTIONMODEL}
+# Cheapest first; an answer that fails validation is retried on the next one up
+MODEL_TIERS = {
+    "flash": os.getenv("FLASH_MODEL", "gemini-1.5-flash-latest"),
+    "pro": os.getenv("PRO_MODEL", "gemini-1.5-pro-latest"),
+}
+# Per role: usual tier, prompt bytes above which flash is skipped (None = no limit), latency SLO in seconds
+# past which a pro role drops to flash (None = never)
+MODEL_ROUTES = {
+    "main": ("pro", None, None),
+    "tool_checker": ("flash", 200_000, 20),
+    "code_editor": ("flash", int(os.getenv("ROUTER_EDIT_FLASH_MAX_BYTES", 60_000)), 45),
+    "code_execution": ("flash", None, 20),
+}
+ROUTER_ESCALATION_RATE = 0.3  # flash recently failing validation this often sends the role straight to pro
+ROUTER_MIN_SAMPLES = 5  # calls before a tier's stats count
+ROUTER_EWMA_WEIGHT = 0.2
+ROUTER_PROBE_INTERVAL = 10  # calls the stats route away from a role's usual tier before one goes back to it
+# USD per million input/output tokens, for the 'models' report
+MODEL_TIER_COSTS = {"flash": (0.075, 0.30), "pro": (1.25, 5.00)}
+
 
 BASE_SYSTEM_PROMPT = """
 You are Gemini an AI assistant powered by Google's Gemini 1.5 pro latest model, specialized in software development with access to a variety of tools and the ability to instruct and direct a coding agent and a code execution one. Your capabilities include:
@@ -83,16 +262,19 @@ Available tools and their optimal use cases:
    - Include ALL the snippets of code to change, along with the desired modifications.
    - Specify coding standards, naming conventions, or architectural patterns to be followed.
    - Anticipate potential issues or conflicts that might arise from the changes and provide guidance on how to handle them.
-4. execute_code: Run Python code exclusively in the 'code_execution_env' virtual environment and analyze its output. Use this when you need to test code functionality or diagnose issues. Remember that all code execution happens in this isolated environment. This tool now returns a process ID for long-running processes.
-5. stop_process: Stop a running process by its ID. Use this when you need to terminate a long-running process started by the execute_code tool.
-6. read_file: Read the contents of an existing file.
-7. read_multiple_files: Read the contents of multiple existing files at once. Use this when you need to examine or work with multiple files simultaneously.
-8. list_files: List all files and directories in a specified folder.
-9. tavily_search: Perform a web search using the Tavily API for up-to-date information.
+4. edit_many: Apply the same change across several files in one call, e.g. renaming a function and its callers. The files are edited concurrently and written together only if every edit applies cleanly; otherwise nothing is written and the failures are listed.
+5. execute_code: Run Python code exclusively in the 'code_execution_env' virtual environment and analyze its output. Use this when you need to test code functionality or diagnose issues. Remember that all code execution happens in this isolated environment. This tool now returns a process ID for long-running processes.
+6. stop_process: Stop a running process by its ID. Use this when you need to terminate a long-running process started by the execute_code tool.
+7. read_file: Read the contents of an existing file. Binary files are described instead of shown, and very large files are cut off with a marker. For large files, pass start_line/end_line or around_pattern to read only the part you need.
+8. read_multiple_files: Read the contents of multiple existing files at once. Use this when you need to examine or work with multiple files simultaneously. Files are read in parallel within a total size budget; list the most important files first.
+9. project_tree: Show the project layout recursively with file sizes and line counts, skipping .gitignore'd and dependency folders. Use a glob to find files by name and a path to zoom into a subdirectory.
+10. search_code: Search file contents across the project for a literal string or, with regex set, a regular expression, optionally limited to files matching a glob. Returns matching lines with surrounding context. Prefer this over reading many files to find where something is defined or used.
+11. tavily_search: Perform a web search using the Tavily API for up-to-date information.
 
 Tool Usage Guidelines:
 - Always use the most appropriate tool for the task at hand.
-- Provide detailed and clear instructions when using tools, especially for edit_and_apply.
+- Provide detailed and clear instructions when using tools, especially for edit_and_apply and edit_many.
+- When one change spans several files, use edit_many rather than one edit_and_apply call per file.
 - After making changes, always review the output to ensure accuracy and alignment with intentions.
 - Use execute_code to run and test code within the 'code_execution_env' virtual environment, then analyze the results.
 - For long-running processes, use the process ID returned by execute_code to stop them later if needed.
@@ -159,8 +341,8 @@ Remember: Focus on completing the established goals efficiently and effectively.
 """
 
 
-def update_system_prompt(automode=False, current_iteration=None, max_iterations=None):
-    global file_contents
+def update_system_prompt(file_contents=None, automode=False, current_iteration=None, max_iterations=None):
+    file_contents = file_contents or {}
     chain_of_thought_prompt = """
     Answer the user's request using relevant tools (if they are available). Before calling a tool, do some analysis within <thinking></thinking> tags. First, think about which of the provided tools is the relevant tool to answer the user's request. Second, go through each of the required parameters of the relevant tool and determine if the user has directly provided or given enough information to infer a value. When deciding if the parameter can be inferred, carefully consider all the context to see if it supports a specific value. If all of the required parameters are present or can be reasonably inferred, close the thinking tag and proceed with the tool call. BUT, if one of the values for a required parameter is missing, DO NOT invoke the function (not even with fillers for the missing params) and instead, ask the user to provide the missing parameters. DO NOT ask for more information on optional parameters if it is not provided.
 
@@ -180,17 +362,24 @@ def update_system_prompt(automode=False, current_iteration=None, max_iterations=
         return BASE_SYSTEM_PROMPT + file_contents_prompt + "\n\n" + chain_of_thought_prompt
 
 # Generation configuration
-generation_config = genai.types.GenerationConfig(
-    temperature=0,
-    top_k= 64,
-    top_p= 0.95,
-    max_output_tokens=10000,
-    candidate_count=1
-)
-
-# Create the model
-main_model = genai.GenerativeModel(
-    model_name=MAINMODEL,
-    generation_config=generation_config,
-    system_instruction=update_system_prompt(),
-)
+generation_config = {
+    "temperature": 0,
+    "top_k": 64,
+    "top_p": 0.95,
+    "max_output_tokens": 10000,
+    "candidate_count": 1,
+}
+
+# Models are created on the first request rather than at import, one per model name
+_main_models = {}
+
+
+def get_main_model(model_name=MAINMODEL):
+    if model_name not in _main_models:
+        genai = load_genai()
+        _main_models[model_name] = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            system_instruction=update_system_prompt(),
+        )
+    return _main_models[model_name]
@@ -0,0 +1,175 @@
+import ast
+import copy
+import os
+import re
+
+from config import CONTEXT_OUTLINE_AFTER_TURNS, CONTEXT_FILE_TOKEN_BUDGET
+from editor_memory import estimate_tokens
+
+# Declarations worth keeping from files ast can't read: functions, classes, types and the like in the
+# C family, JS/TS, Go, Rust, Ruby, shell and SQL
+_DECLARATION = re.compile(
+    r"^\s*(?:export\s+(?:default\s+)?)?(?:(?:public|private|protected|internal|static|final|abstract|async|"
+    r"pub(?:\(\w+\))?|unsafe|override|virtual|inline|extern)\s+)*"
+    r"(?:(?:function\*?|class|interface|struct|enum|trait|impl|fn|func|def|module|namespace|package|type|"
+    r"create\s+(?:or\s+replace\s+)?(?:table|view|function|procedure|index))\b|"
+    r"(?:const|let|var)\s+\w+\s*=\s*(?:async\s*)?(?:function\b|\([^)]*\)\s*=>|\w+\s*=>))"
+    r"|^\s*(?!(?:if|else|for|while|switch|return|do|catch|new|delete)\b)\w[\w:<>,\s*&]*\s+\**[\w:~]+\s*\([^;]*\)\s*(?:const\s*)?\{?\s*$"
+    r"|^\s*\w[\w-]*\s*\(\)\s*\{",
+    re.IGNORECASE,
+)
+_MAX_HEURISTIC_INDENT = 8
+
+
+def _signature(node):
+    # The def/class line(s) as written, decorators included, without the body
+    stub = copy.copy(node)
+    stub.body = [ast.Expr(ast.Constant(...))]
+    lines = ast.unparse(stub).splitlines()
+    return lines[:-1]
+
+
+def _outline_python(content):
+    tree = ast.parse(content)
+    lines = []
+    imported = []
+
+    def visit(body, indent):
+        for node in body:
+            span = f"lines {node.lineno}-{node.end_lineno}" if node.end_lineno != node.lineno else f"line {node.lineno}"
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                signature = _signature(node)
+                lines.extend(indent + line for line in signature[:-1])
+                lines.append(f"{indent}{signature[-1]}  # {span}")
+                if isinstance(node, ast.ClassDef):
+                    visit(node.body, indent + "    ")
+            elif isinstance(node, ast.Import) and not indent:
+                imported.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and not indent:
+                imported.append("." * node.level + (node.module or ""))
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                names = [ast.unparse(target) for target in targets]
+                lines.append(f"{indent}{' = '.join(names)} = ...  # {span}")
+
+    visit(tree.body, "")
+    if imported:
+        lines.insert(0, f"imports: {', '.join(dict.fromkeys(imported))}")
+    return lines
+
+
+def _indent(line):
+    return len(line) - len(line.lstrip())
+
+
+def _block_end(lines, start):
+    # Last line of the block opened at lines[start]: where its braces balance if it opens one within two
+    # lines, else before the next line indented no deeper than it (closing "}" / "end" lines included)
+    depth = 0
+    opened = False
+    for index in range(start, len(lines)):
+        depth += lines[index].count("{") - lines[index].count("}")
+        opened = opened or "{" in lines[index]
+        if opened and depth <= 0:
+            return index
+        if not opened and index >= start + 1:
+            break
+    indent = _indent(lines[start])
+    end = start
+    for index in range(start + 1, len(lines)):
+        line = lines[index]
+        if not line.strip():
+            continue
+        if _indent(line) <= indent:
+            if line.strip() in ("}", "};", "end", "fi", "esac"):
+                end = index
+            break
+        end = index
+    return end
+
+
+def _outline_heuristic(content):
+    # Declaration lines with their span, for languages ast can't read
+    all_lines = content.splitlines()
+    lines = []
+    for index, line in enumerate(all_lines):
+        if _indent(line) <= _MAX_HEURISTIC_INDENT and _DECLARATION.match(line):
+            end = _block_end(all_lines, index)
+            text = line.rstrip().rstrip("{").rstrip()
+            lines.append(f"{text}  # lines {index + 1}-{end + 1}" if end > index else f"{text}  # line {index + 1}")
+    return lines
+
+
+def outline(path, content):
+    # Signatures, class structure and line spans; None when there is nothing to outline
+    lines = None
+    if path.endswith((".py", ".pyi")):
+        try:
+            lines = _outline_python(content)
+        except (SyntaxError, ValueError, RecursionError):
+            lines = None
+    if lines is None:
+        lines = _outline_heuristic(content)
+    if not lines:
+        return None
+    return f"{content.count(chr(10)) + 1} lines, {len(content):,} bytes\n" + "\n".join(lines)
+
+
+def _tokens(state):
+    # What a file costs in the history: its last full copy plus the diffs sent since
+    return estimate_tokens(state.content) + state.drift // 4
+
+
+def mentioned(path, text):
+    # Whether text names the file, by its path or by a file name unlikely to be a plain word
+    if path in text:
+        return True
+    name = os.path.basename(path)
+    return "." in name and re.search(rf"(?<![\w./-]){re.escape(name)}(?![\w-])", text) is not None
+
+
+class ContextCompressor:
+    # Keeps the files in the main model's history within budget: files it hasn't looked at for a while go
+    # down to an outline, and come back whole when the user mentions them or a tool reads or edits them
+    def __init__(self):
+        self.outlined = []  # paths outlined at the start of the last turn
+        self.saved_tokens = 0  # estimated, over the session
+        self._not_worth = {}  # path -> version whose outline came out too close to the file to be worth it
+
+    def start_turn(self, session, user_input):
+        # Returns full copies of the outlined files user_input mentions, for the model to read with it
+        tracker = session.file_state
+        promoted = []
+        for path, content in session.file_contents.items():
+            if tracker.outlined(path) and mentioned(path, user_input):
+                promoted.append(tracker.show(path, content))
+        for path, state in tracker.shown():
+            if mentioned(path, user_input):
+                state.touched = session.turn
+
+        self.outlined = []
+        shown = sorted(tracker.shown(), key=lambda item: item[1].touched)
+        tokens = sum(_tokens(state) for _, state in shown)
+        for path, state in shown:
+            stale = session.turn - state.touched >= CONTEXT_OUTLINE_AFTER_TURNS
+            if not stale and (tokens <= CONTEXT_FILE_TOKEN_BUDGET or state.touched == session.turn):
+                continue
+            if self._not_worth.get(path) == state.version:
+                continue
+            text = outline(path, state.content)
+            if text is None or len(text) * 2 > len(state.content):
+                self._not_worth[path] = state.version
+                continue
+            size = _tokens(state)
+            tracker.outline(path, text)
+            tokens -= size
+            self.saved_tokens += size - estimate_tokens(text)
+            self.outlined.append(path)
+        if not promoted:
+            return None
+        return "Files mentioned above, in full again after being outlined:\n" + "\n".join(promoted)
+
+    def clear(self):
+        self.outlined = []
+        self.saved_tokens = 0
+        self._not_worth.clear()
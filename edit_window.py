@@ -0,0 +1,100 @@
+import re
+
+from config import EDIT_WINDOW_MIN_LINES, EDIT_WINDOW_CONTEXT_LINES, EDIT_WINDOW_MAX_LINES
+
+# Words in edit instructions that look like code rather than prose
+_QUOTED = re.compile(r"`([^`\n]+)`|'([^'\n]{3,})'|\"([^\"\n]{3,})\"")
+_IDENTIFIER = re.compile(r"\b[A-Za-z_][A-Za-z0-9_]*\b")
+_DEFINITION = re.compile(r"^\s*(?:async\s+def|def|class|function|const|let|var|func|fn|type|interface|struct)\s+([A-Za-z_][A-Za-z0-9_]*)"
+                         r"|^\s*([A-Za-z_][A-Za-z0-9_]*)\s*[:=(]", re.MULTILINE)
+
+
+def _terms(instructions, content):
+    terms = set()
+    for match in _QUOTED.finditer(instructions):
+        terms.add(next(group for group in match.groups() if group).strip())
+    defined = {name for match in _DEFINITION.finditer(content) for name in match.groups() if name}
+    for word in _IDENTIFIER.findall(instructions):
+        # snake_case, camelCase, or a name the file defines
+        if len(word) >= 3 and ("_" in word or word[1:] != word[1:].lower() or word in defined):
+            terms.add(word)
+    return {term for term in terms if len(term) >= 3}
+
+
+def relevant_windows(content, instructions, start_line=None, end_line=None):
+    # Line ranges (1-based, inclusive) of a large file worth showing the editor, or None for the whole file
+    lines = content.split("\n")
+    total = len(lines)
+    if total < EDIT_WINDOW_MIN_LINES:
+        return None
+    if start_line or end_line:
+        start = max(1, int(start_line or 1) - EDIT_WINDOW_CONTEXT_LINES)
+        end = min(total, int(end_line or total) + EDIT_WINDOW_CONTEXT_LINES)
+        return None if start <= 1 and end >= total else [(start, end)]
+
+    terms = _terms(instructions, content)
+    if not terms:
+        return None
+    # Whole words for identifiers, so function_1 doesn't pull in function_10 .. function_19
+    matcher = re.compile("|".join(rf"\b{re.escape(term)}\b" if _IDENTIFIER.fullmatch(term) else re.escape(term)
+                                  for term in sorted(terms, key=len, reverse=True)))
+    hits = [number for number, line in enumerate(lines, 1) if matcher.search(line)]
+    if not hits:
+        return None
+
+    # Merge overlapping windows around the hits, keeping count of hits per window
+    windows = []
+    for number in hits:
+        start, end = max(1, number - EDIT_WINDOW_CONTEXT_LINES), min(total, number + EDIT_WINDOW_CONTEXT_LINES)
+        if windows and start <= windows[-1][1] + 1:
+            windows[-1][1] = end
+            windows[-1][2] += 1
+        else:
+            windows.append([start, end, 1])
+    # The windows with the most hits, up to the line budget; past it the whole file is the safer bet
+    chosen = []
+    size = 0
+    for start, end, _ in sorted(windows, key=lambda window: -window[2]):
+        if size + end - start + 1 > EDIT_WINDOW_MAX_LINES:
+            continue
+        chosen.append((start, end))
+        size += end - start + 1
+    if not chosen or size >= total * 0.8:
+        return None
+    return sorted(chosen)
+
+
+def render_windows(content, windows):
+    # The windows as the editor sees them, with the lines left out marked
+    lines = content.split("\n")
+    parts = []
+    previous_end = 0
+    for start, end in windows:
+        if start > previous_end + 1:
+            parts.append(f"... (lines {previous_end + 1}-{start - 1} not shown) ...")
+        parts.append("\n".join(lines[start - 1:end]))
+        previous_end = end
+    if previous_end < len(lines):
+        parts.append(f"... (lines {previous_end + 1}-{len(lines)} not shown) ...")
+    return "\n".join(parts)
+
+
+def split_segments(content, windows):
+    # [(text, editable)] covering the whole file; joining the texts gives the content back
+    if not windows:
+        return [(content, True)]
+    lines = content.split("\n")
+    segments = []
+    previous_end = 0
+    for start, end in windows:
+        if start > previous_end + 1:
+            segments.append(("\n".join(lines[previous_end:start - 1]), False))
+        segments.append(("\n".join(lines[start - 1:end]), True))
+        previous_end = end
+    if previous_end < len(lines):
+        segments.append(("\n".join(lines[previous_end:]), False))
+    return segments
+
+
+def join_segments(segments):
+    return "\n".join(text for text, _ in segments)
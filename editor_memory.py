@@ -0,0 +1,105 @@
+import os
+import re
+from collections import OrderedDict
+
+from config import EDITOR_MEMORY_TOKEN_BUDGET, EDITOR_MEMORY_ENTRY_TOKENS, EDITOR_MEMORY_MAX_AGE
+from file_state import diff_lines
+
+
+def estimate_tokens(text):
+    return len(text) // 4
+
+
+def summarize_edit(path, instructions, original, edited, turn):
+    # What was asked and the applied diff without context lines, cut to EDITOR_MEMORY_ENTRY_TOKENS
+    request = " ".join(instructions.split())
+    if len(request) > 200:
+        request = request[:200] + "..."
+    diff = [line for line in diff_lines(original.splitlines(), edited.splitlines(), context=0)
+            if not line.startswith(("---", "+++"))]
+    added = sum(1 for line in diff if line.startswith("+"))
+    removed = sum(1 for line in diff if line.startswith("-"))
+    lines = [f"Edit to {path} (turn {turn}, +{added} -{removed} lines): {request}"]
+    budget = EDITOR_MEMORY_ENTRY_TOKENS * 4 - len(lines[0])
+    for index, line in enumerate(diff):
+        if len(line) + 1 > budget:
+            lines.append(f"... ({len(diff) - index} more diff lines)")
+            break
+        lines.append(line)
+        budget -= len(line) + 1
+    return "\n".join(lines)
+
+
+def _module_names(path):
+    # Names another file would import this one by: the stem and the dotted path (a.b.c for a/b/c.py)
+    stem, _ = os.path.splitext(os.path.normpath(path))
+    names = {os.path.basename(stem)}
+    if os.path.basename(stem) == "__init__":
+        names = {os.path.basename(os.path.dirname(stem))}
+    names.add(stem.replace(os.sep, ".").lstrip("."))
+    return {name for name in names if name}
+
+
+def imports(content, path):
+    # Whether content imports the module at path (Python imports, JS/TS import/require)
+    for name in _module_names(path):
+        escaped = re.escape(name)
+        if re.search(rf"^\s*(?:from\s+[\w.]*\b{escaped}\b|import\s+[\w., ]*\b{escaped}\b)", content, re.MULTILINE):
+            return True
+        if re.search(rf"(?:from\s+|require\(\s*|import\s*\(\s*)['\"][^'\"]*\b{escaped}(?:\.\w+)?['\"]", content):
+            return True
+    return False
+
+
+class EditorMemory:
+    # The editor's memory of earlier edits: applied-diff summaries by file, least recently used file first,
+    # within EDITOR_MEMORY_TOKEN_BUDGET
+    def __init__(self, budget=EDITOR_MEMORY_TOKEN_BUDGET):
+        self.budget = budget
+        self.tokens = 0
+        self._files = OrderedDict()  # path -> [(turn, summary, tokens)]
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._files.values())
+
+    def record(self, path, instructions, original, edited, turn):
+        summary = summarize_edit(path, instructions, original, edited, turn)
+        tokens = estimate_tokens(summary)
+        self._files.setdefault(path, []).append((turn, summary, tokens))
+        self._files.move_to_end(path)
+        self.tokens += tokens
+        self._evict(turn)
+
+    def _evict(self, turn):
+        # Entries past EDITOR_MEMORY_MAX_AGE turns go first, then the oldest entries of the least recently used files
+        for path, entries in list(self._files.items()):
+            kept = [entry for entry in entries if turn - entry[0] <= EDITOR_MEMORY_MAX_AGE]
+            self.tokens -= sum(entry[2] for entry in entries) - sum(entry[2] for entry in kept)
+            if kept:
+                self._files[path] = kept
+            else:
+                del self._files[path]
+        while self.tokens > self.budget and self._files:
+            path, entries = next(iter(self._files.items()))
+            self.tokens -= entries.pop(0)[2]
+            if not entries:
+                del self._files[path]
+
+    def forget(self, path):
+        # The file changed outside the editor, so the remembered diffs no longer describe it
+        for _, _, tokens in self._files.pop(path, []):
+            self.tokens -= tokens
+
+    def context(self, path, file_contents):
+        # Memories of path and of the files that import it or that it imports, oldest first
+        target = file_contents.get(path, "")
+        related = [other for other in self._files
+                   if other == path or imports(file_contents.get(other, ""), path) or imports(target, other)]
+        if path in self._files:
+            self._files.move_to_end(path)
+        entries = sorted((entry for other in related for entry in self._files[other]), key=lambda entry: entry[0])
+        return "\n\n".join(summary for _, summary, _ in entries)
+
+    def clear(self):
+        self._files.clear()
+        self.tokens = 0
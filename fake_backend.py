@@ -0,0 +1,164 @@
+import json
+import random
+import threading
+import time
+
+import google.generativeai as genai
+from google.generativeai import protos
+from google.generativeai.types import file_types
+from google.generativeai.types.generation_types import GenerateContentResponse
+
+import model_cache
+
+
+def classify_request(prompt_text):
+    # The editor and execution agents are recognisable by the instructions they send
+    if "SEARCH/REPLACE" in prompt_text:
+        return "code_editor"
+    if "Analyze this code execution" in prompt_text:
+        return "code_execution"
+    return "main"
+
+
+def text_step(text, **kwargs):
+    return {"text": text, **kwargs}
+
+
+def tool_step(*calls, text="", **kwargs):
+    # calls are (name, args) pairs
+    return {"text": text, "function_calls": [{"name": name, "args": args} for name, args in calls], **kwargs}
+
+
+def scripted(main=(), code_editor=(), code_execution=(), default_text="Done."):
+    # Build a responder that pops the next step for each role, falling back to a plain text reply
+    queues = {
+        "main": list(main),
+        "code_editor": list(code_editor),
+        "code_execution": list(code_execution),
+    }
+
+    def responder(role, request):
+        queue = queues.get(role)
+        if queue:
+            return queue.pop(0)
+        return text_step(default_text)
+
+    return responder
+
+
+class FakeBackend:
+    def __init__(self, responder, latency=0.0, jitter=0.0, output_tokens=64, seed=0, tail=(0.0, 0.0)):
+        self.responder = responder
+        self.latency = latency
+        self.jitter = jitter
+        # (probability, extra seconds): the occasional very slow response that hedging is for
+        self.tail = tail
+        # Steps handed out for requests still being answered, so a hedged duplicate gets the same step
+        self._in_flight = {}
+        self.output_tokens = output_tokens
+        self.calls = []
+        self.uploads = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def respond(self, model, contents):
+        request = {
+            "model": model.model_name,
+            "system_instruction": model_cache.normalize(model._system_instruction),
+            "contents": model_cache.normalize_contents(contents),
+        }
+        prompt_text = json.dumps(request, ensure_ascii=False)
+        role = classify_request(prompt_text)
+        with self._lock:
+            in_flight = self._in_flight.get(prompt_text)
+            if in_flight is None:
+                in_flight = self._in_flight[prompt_text] = [self.responder(role, request), 0]
+            in_flight[1] += 1
+            step = in_flight[0]
+            delay = step.get("latency", self.latency) + self._random.uniform(0, self.jitter)
+            if self._random.random() < self.tail[0]:
+                delay += self.tail[1]
+
+        start = time.perf_counter()
+        try:
+            if delay:
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                in_flight[1] -= 1
+                if not in_flight[1]:
+                    del self._in_flight[prompt_text]
+
+        prompt_bytes = len(prompt_text.encode("utf-8"))
+        input_tokens = step.get("input_tokens", prompt_bytes // 4)
+        output_tokens = step.get("output_tokens", self.output_tokens)
+        parts = []
+        if step.get("text"):
+            parts.append({"text": step["text"]})
+        for call in step.get("function_calls", []):
+            parts.append({"function_call": {"name": call["name"], "args": call["args"]}})
+
+        with self._lock:
+            self.calls.append({
+                "role": role,
+                "model": model.model_name,
+                "prompt_bytes": prompt_bytes,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "latency": time.perf_counter() - start,
+            })
+
+        return GenerateContentResponse.from_response(protos.GenerateContentResponse({
+            "candidates": [{"content": {"role": "model", "parts": parts}, "finish_reason": 1}],
+            "usage_metadata": {
+                "prompt_token_count": input_tokens,
+                "candidates_token_count": output_tokens,
+                "total_token_count": input_tokens + output_tokens,
+            },
+        }))
+
+    def upload_file(self, path, *, mime_type=None, display_name=None, **kwargs):
+        # Stands in for genai.upload_file; the handle points nowhere but looks like a real one
+        if hasattr(path, "read"):
+            data = path.read()
+        else:
+            with open(path, "rb") as f:
+                data = f.read()
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.uploads.append({"display_name": display_name, "mime_type": mime_type, "bytes": len(data)})
+            name = f"files/fake-{len(self.uploads)}"
+        return file_types.File({
+            "name": name,
+            "display_name": display_name or "",
+            "mime_type": mime_type or "application/octet-stream",
+            "size_bytes": len(data),
+            "uri": f"https://generativelanguage.googleapis.com/v1beta/{name}",
+            "state": protos.File.State.ACTIVE,
+        })
+
+
+class FakeGenerativeModel:
+    backend = None
+
+    def __init__(self, model_name="fake-model", generation_config=None, system_instruction=None, **kwargs):
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self._generation_config = generation_config
+        self._system_instruction = system_instruction
+
+    def generate_content(self, contents, **kwargs):
+        if FakeGenerativeModel.backend is None:
+            raise RuntimeError("No fake backend installed")
+        return FakeGenerativeModel.backend.respond(self, contents)
+
+
+def install_fake_backend(backend):
+    # Route every GenerativeModel the app builds, including the cached main model, to the backend
+    import config
+
+    FakeGenerativeModel.backend = backend
+    genai.GenerativeModel = FakeGenerativeModel
+    genai.upload_file = backend.upload_file
+    config._main_models.clear()
+    return backend
@@ -0,0 +1,224 @@
+import codecs
+import contextvars
+import mimetypes
+import mmap
+import os
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from config import READ_MAX_FILE_BYTES, READ_MAX_TOTAL_BYTES, READ_MMAP_THRESHOLD, READ_WORKERS
+from project_tree import format_size
+from tracing import span
+
+_executor = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="read")
+
+SNIFF_BYTES = 8192
+
+# Longest first, so UTF-32 LE isn't taken for UTF-16 LE
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+class FileRead:
+    __slots__ = ("path", "content", "size", "read_bytes", "truncated", "binary", "encoding", "error", "elapsed_ms")
+
+    def __init__(self, path):
+        self.path = path
+        self.content = None
+        self.size = 0
+        self.read_bytes = 0
+        self.truncated = False
+        self.binary = False
+        self.encoding = None
+        self.error = None
+        self.elapsed_ms = 0.0
+
+
+def sniff_encoding(data):
+    # None means binary
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+    head = data[:SNIFF_BYTES]
+    if b"\0" in head:
+        return None
+    try:
+        head.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off by the sniff window is still UTF-8
+        if e.start >= len(head) - 3 and len(data) > len(head):
+            return "utf-8"
+    # Lots of control characters that aren't whitespace: not text in any 8-bit encoding
+    control = sum(1 for byte in head if byte < 32 and byte not in (9, 10, 12, 13))
+    if control > len(head) // 10:
+        return None
+    return "cp1252" if _decodes(head, "cp1252") else "latin-1"
+
+
+def _decodes(data, encoding):
+    try:
+        data.decode(encoding)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def decode(data, encoding):
+    text = data.decode(encoding, errors="replace")
+    # Same newlines as reading in text mode
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _cut(data, encoding):
+    # End on a line break so no line (or UTF-8 character) is split; wide encodings end on a whole code unit
+    width = {"utf-16": 2, "utf-32": 4}.get(encoding)
+    if width:
+        return data[:len(data) - len(data) % width]
+    cut = data.rfind(b"\n")
+    return data[:cut + 1] if cut > len(data) // 2 else data
+
+
+def read_text(path, budget=READ_MAX_FILE_BYTES):
+    # One file as text, at most `budget` bytes of it (None for no limit)
+    result = FileRead(path)
+    start = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            result.size = os.fstat(f.fileno()).st_size
+            limit = result.size if budget is None else min(result.size, budget)
+            if result.size >= READ_MMAP_THRESHOLD:
+                # Big files: map them and copy out only the part that fits the budget
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    encoding = sniff_encoding(mapped[:SNIFF_BYTES + 4])
+                    data = None if encoding is None else mapped[:limit]
+            else:
+                data = f.read(limit if limit < result.size else -1)
+                encoding = sniff_encoding(data)
+        if encoding is None:
+            result.binary = True
+        else:
+            if len(data) < result.size:
+                data = _cut(data, encoding)
+                result.truncated = True
+            result.encoding = encoding
+            result.read_bytes = len(data)
+            result.content = decode(data, encoding)
+    except (OSError, ValueError) as e:
+        result.error = str(e)
+    result.elapsed_ms = (time.perf_counter() - start) * 1000
+    return result
+
+
+def _read_traced(path, budget):
+    with span("read_file", path=path) as s:
+        result = read_text(path, budget)
+        s.set(bytes=result.read_bytes, size=result.size, truncated=result.truncated, binary=result.binary)
+        return result
+
+
+def read_files(paths, per_file=READ_MAX_FILE_BYTES, total=READ_MAX_TOTAL_BYTES):
+    # Read concurrently; budgets are handed out in the order given, so earlier files get theirs in full
+    budgets = []
+    remaining = total
+    for path in paths:
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = 0
+        budget = max(0, min(per_file, remaining))
+        budgets.append(budget)
+        remaining -= min(size, budget)
+
+    with span("read_files", files=len(paths)) as s:
+        futures = []
+        for path, budget in zip(paths, budgets):
+            if budget == 0:
+                futures.append(None)
+                continue
+            # Each read's span lands under this one
+            context = contextvars.copy_context()
+            futures.append(_executor.submit(context.run, _read_traced, path, budget))
+        results = []
+        for path, future in zip(paths, futures):
+            if future is None:
+                result = FileRead(path)
+                result.error = f"skipped, the {format_size(total)} total read budget is used up"
+            else:
+                result = future.result()
+            results.append(result)
+        s.set(bytes=sum(result.read_bytes for result in results))
+    return results
+
+
+def describe_binary(path, size):
+    kind = mimetypes.guess_type(path)[0] or "binary data"
+    return f"binary file ({kind}, {format_size(size)}); contents not shown"
+
+
+def truncation_marker(result):
+    return (f"\n[... truncated: showing the first {format_size(result.read_bytes)} of {format_size(result.size)}; "
+            f"read the rest with start_line/end_line or around_pattern]")
+
+
+# Line start offsets by path, reused until the file's mtime or size changes
+_line_indexes = {}  # path -> (mtime_ns, size, encoding, offsets)
+
+
+def line_index(path):
+    # (encoding, offsets): offsets[n] is the byte where line n + 1 starts, and the last entry is the file size,
+    # so any line range is one seek and one read. Offsets are None for binary and UTF-16/32 files
+    st = os.stat(path)
+    cached = _line_indexes.get(path)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2], cached[3]
+    with open(path, "rb") as f:
+        if st.st_size >= READ_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                encoding, offsets = _offsets(mapped, st.st_size)
+        else:
+            encoding, offsets = _offsets(f.read(), st.st_size)
+    _line_indexes[path] = (st.st_mtime_ns, st.st_size, encoding, offsets)
+    return encoding, offsets
+
+
+def _offsets(data, size):
+    encoding = sniff_encoding(data[:SNIFF_BYTES + 4])
+    if encoding in (None, "utf-16", "utf-32"):
+        return encoding, None
+    offsets = array("Q", [0])
+    find = data.find
+    position = find(b"\n")
+    while position != -1:
+        offsets.append(position + 1)
+        position = find(b"\n", position + 1)
+    if offsets[-1] != size:
+        offsets.append(size)
+    return encoding, offsets
+
+
+def read_lines(path, start, end):
+    # Lines start..end (1-based, inclusive, clamped to the file) and the file's line count
+    encoding, offsets = line_index(path)
+    if encoding is None:
+        raise ValueError("binary file")
+    if offsets is None:
+        lines = read_text(path, budget=None).content.split("\n")
+        if lines and lines[-1] == "":
+            lines.pop()
+        return lines[max(1, start) - 1:end], len(lines)
+    total = len(offsets) - 1
+    start, end = max(1, start), min(total, end)
+    if start > end:
+        return [], total
+    with open(path, "rb") as f:
+        f.seek(offsets[start - 1])
+        data = f.read(offsets[end] - offsets[start - 1])
+    lines = decode(data, encoding).split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines, total
+
@@ -0,0 +1,227 @@
+import difflib
+import re
+
+from config import FILE_STATE_MAX_DIFF_RATIO
+from messages import Spilled, ToolResult, text_of
+
+
+class FileVersion:
+    __slots__ = ("version", "content", "drift", "touched")
+
+    def __init__(self, version, content, touched=0):
+        self.version = version  # latest version shown to the model
+        self.content = content  # its text, or None when only the number is known (resumed, outlined)
+        self.drift = 0  # diff bytes sent since the file was last shown in full
+        self.touched = touched  # turn the model last read, edited or mentioned the file
+
+
+def full_block(path, version, content):
+    return f"--- {path} (version {version}) ---\n{content.rstrip(chr(10))}\n--- end of {path} ---"
+
+
+def outline_block(path, version, outline):
+    return (f"--- {path} (version {version}, outline) ---\nOutline only; read the file again for its full text.\n"
+            f"{outline}\n--- end of {path} ---")
+
+
+def diff_block(path, old_version, new_version, diff):
+    return f"--- {path}: changes from version {old_version} to {new_version} ---\n{diff}\n--- end of {path} ---"
+
+
+_HUNK = re.compile(r"^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@")
+
+
+def diff_lines(old_lines, new_lines, fromfile="", tofile="", context=3):
+    # difflib.unified_diff, minus the time it spends on the unchanged start and end of a large file
+    limit = min(len(old_lines), len(new_lines))
+    start = 0
+    while start < limit and old_lines[start] == new_lines[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old_lines[-1 - end] == new_lines[-1 - end]:
+        end += 1
+    skip_start, skip_end = max(0, start - context), max(0, end - context)
+    lines = difflib.unified_diff(old_lines[skip_start:len(old_lines) - skip_end], new_lines[skip_start:len(new_lines) - skip_end],
+                                 fromfile, tofile, n=context, lineterm="")
+    if not skip_start:
+        return list(lines)
+
+    def shift(match):
+        return (f"@@ -{int(match.group(1)) + skip_start}{match.group(2) or ''} "
+                f"+{int(match.group(3)) + skip_start}{match.group(4) or ''} @@")
+
+    return [_HUNK.sub(shift, line) if line.startswith("@@") else line for line in lines]
+
+
+def unified_diff(path, old, new):
+    return "\n".join(diff_lines(old.splitlines(), new.splitlines(), f"a/{path}", f"b/{path}"))
+
+
+_HEADER = re.compile(r"^--- (.+?)(?: \(version (\d+)(, outline)?\)|: changes from version \d+ to (\d+)) ---$", re.MULTILINE)
+
+
+class FileStateTracker:
+    # What the model has seen of each file, by version. Later looks at a file get a diff against the version
+    # it last saw; a full body goes out the first time, on request, or once the diffs add up to more than
+    # the file. Each full body supersedes the earlier bodies and diffs of that file in the history
+    def __init__(self, on_supersede=None):
+        self.turn = 0
+        # Called with the path whenever copies of it in the history are superseded or outlined
+        self.on_supersede = on_supersede
+        self._files = {}  # path -> FileVersion
+        self._superseded = {}  # path -> versions below this are stubs in the history
+        self._outlines = {}  # path -> (version, outline) standing in for that version in the history
+        self._dirty = False
+
+    def show(self, path, content, full=False):
+        # The text to give the model for the current content of path
+        state = self._files.get(path)
+        if state is None or state.content is None or full:
+            return self._full(path, content, state)
+        state.touched = self.turn
+        if content == state.content:
+            return f"'{path}' is unchanged since version {state.version}, shown earlier in the conversation."
+        diff = unified_diff(path, state.content, content)
+        if len(diff) > FILE_STATE_MAX_DIFF_RATIO * len(content) or state.drift + len(diff) > len(content):
+            return self._full(path, content, state)
+        old_version = state.version
+        state.version += 1
+        state.content = content
+        state.drift += len(diff)
+        return diff_block(path, old_version, state.version, diff)
+
+    def show_edit(self, path, original, edited):
+        # After an edit: a diff against what the model last saw (the whole file again if it was outlined),
+        # or of the edit alone if it never saw the file
+        if path in self._outlines or (path in self._files and self._files[path].content is not None):
+            return self.show(path, edited)
+        diff = unified_diff(path, original, edited)
+        return f"Applied diff (read the file to see it whole):\n{diff}" if diff else ""
+
+    def saw(self, path, content):
+        # The model wrote this content itself (create_file), so it needs no copy
+        state = self._files.get(path)
+        version = state.version + 1 if state else 1
+        self._files[path] = FileVersion(version, content, self.turn)
+        self._supersede(path, version)
+
+    def _full(self, path, content, state):
+        version = state.version + 1 if state else 1
+        self._files[path] = FileVersion(version, content, self.turn)
+        self._supersede(path, version)
+        return full_block(path, version, content)
+
+    def _supersede(self, path, version):
+        self._outlines.pop(path, None)
+        if version > 1:
+            self._superseded[path] = version
+            self._dirty = True
+            if self.on_supersede:
+                self.on_supersede(path)
+
+    def forget(self, path):
+        state = self._files.get(path)
+        if state is not None:
+            # Keep the number so versions stay unique in the history; the next look sends the file in full
+            state.content = None
+
+    def shown(self):
+        # (path, FileVersion) for the files whose current text the history holds in full or as diffs
+        return [(path, state) for path, state in self._files.items() if state.content is not None]
+
+    def outlined(self, path):
+        return path in self._outlines
+
+    def outline(self, path, outline):
+        # Stand the outline in for the file's latest version in the history, and stub the earlier ones;
+        # the next look at the file sends it whole
+        state = self._files[path]
+        self._outlines[path] = (state.version, outline)
+        self._superseded[path] = state.version
+        state.content = None
+        state.drift = 0
+        self._dirty = True
+        if self.on_supersede:
+            self.on_supersede(path)
+
+    def collapse(self, messages):
+        # Replace superseded bodies and diffs in the history with a one-line stub, and outlined ones with
+        # their outline; returns bytes saved
+        if not self._dirty:
+            return 0
+        self._dirty = False
+        saved = 0
+        for message in messages:
+            parts = message.parts
+            if isinstance(parts, str):
+                text, replaced = self._collapse_text(parts)
+                if replaced:
+                    saved += len(parts) - len(text)
+                    message.parts = text
+                continue
+            for index, part in enumerate(parts):
+                if isinstance(part, (str, Spilled)):
+                    content = text_of(part)
+                    text, replaced = self._collapse_text(content)
+                    if replaced:
+                        saved += len(content) - len(text)
+                        parts[index] = text
+                elif isinstance(part, ToolResult):
+                    content = part.content
+                    text, replaced = self._collapse_text(content)
+                    if replaced:
+                        saved += len(content) - len(text)
+                        part.content = text
+        return saved
+
+    def _collapse_text(self, text):
+        if "--- end of " not in text:
+            return text, False
+        pieces = []
+        position = 0
+        for header in _HEADER.finditer(text):
+            if header.start() < position:
+                continue
+            path = header.group(1)
+            version = int(header.group(2) or header.group(4))
+            latest = self._superseded.get(path)
+            outline = self._outlines.get(path)
+            if latest is not None and version < latest:
+                replacement = f"--- {path} (version {version}): superseded by version {latest}, shown later ---"
+            elif outline is not None and version == outline[0] and not header.group(3):
+                replacement = outline_block(path, version, outline[1])
+            else:
+                continue
+            end = text.find(f"\n--- end of {path} ---", header.end())
+            if end == -1:
+                continue
+            pieces.append(text[position:header.start()])
+            pieces.append(replacement)
+            position = end + len(f"\n--- end of {path} ---")
+        if not pieces:
+            return text, False
+        pieces.append(text[position:])
+        return "".join(pieces), True
+
+    def resume(self, messages):
+        # After replaying a journal: carry on numbering from the versions already in the history
+        for message in messages:
+            parts = message.parts if isinstance(message.parts, list) else [message.parts]
+            for part in parts:
+                if isinstance(part, (str, Spilled)):
+                    text = text_of(part)
+                elif isinstance(part, ToolResult):
+                    text = part.content
+                else:
+                    continue
+                for header in _HEADER.finditer(text):
+                    path, version = header.group(1), int(header.group(2) or header.group(4))
+                    state = self._files.get(path)
+                    if state is None or state.version < version:
+                        self._files[path] = FileVersion(version, None)
+
+    def clear(self):
+        self._files.clear()
+        self._superseded.clear()
+        self._outlines.clear()
+        self._dirty = False
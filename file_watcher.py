@@ -0,0 +1,345 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from config import WATCH_BACKEND, WATCH_POLL_INTERVAL, WATCH_POLL_BATCH, WATCH_MAX_DIRS
+from project_tree import walk, iter_files, is_ignored
+from tool_memo import stamp
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT = struct.Struct("iIII")
+
+
+class Subscription:
+    # Paths changed under one root since the last drain(); filled in from the watcher's thread
+    def __init__(self, watcher, root, full):
+        self.watcher = watcher
+        self.root = root
+        # Whole tree watched, or only the hot paths when the tree is too big
+        self.full = full
+        # True when every change on disk is reported by the time drain() returns
+        self.complete = False
+        self.hot = set()
+        self._changed = set()
+        self._rescan = False
+        self._lock = threading.Lock()
+
+    def push(self, path, is_dir=False):
+        if not path.startswith(self.root + os.sep):
+            return
+        if is_dir:
+            # A directory moved or removed takes its files with it, without an event for each
+            if self.full and not is_ignored(self.root, path, is_dir=True):
+                self.overflow()
+            return
+        if self.full:
+            if is_ignored(self.root, path):
+                return
+        elif path not in self.hot:
+            return
+        with self._lock:
+            self._changed.add(path)
+
+    def overflow(self):
+        with self._lock:
+            self._rescan = True
+
+    def set_hot(self, paths):
+        # Absolute paths of the files the subscriber holds copies of
+        self.hot = set(paths)
+        self.watcher.watch_hot(self)
+
+    def drain(self):
+        # Returns (changed paths, whether changes were lost and everything should be rechecked)
+        self.watcher.sync(self)
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            rescan, self._rescan = self._rescan, False
+        return changed, rescan
+
+    def close(self):
+        self.watcher.unsubscribe(self)
+
+
+class Watcher(ABC):
+    # Subclasses supply _run, the loop on the watcher's thread
+    def __init__(self):
+        self._subscriptions = []
+        self._lock = threading.RLock()
+        self._thread = threading.Thread(target=self._run, name=f"{type(self).__name__}", daemon=True)
+        self._thread.start()
+
+    def subscribe(self, root):
+        root = os.path.abspath(root)
+        # Count directories up to the limit; a home directory shouldn't get a watch on every folder
+        directories = []
+        for directory, _, _ in walk(root):
+            directories.append(directory)
+            if len(directories) > WATCH_MAX_DIRS:
+                break
+        subscription = Subscription(self, root, full=len(directories) <= WATCH_MAX_DIRS)
+        with self._lock:
+            self._subscribed(subscription, directories)
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def _subscribed(self, subscription, directories):
+        pass
+
+    def watch_hot(self, subscription):
+        pass
+
+    def sync(self, subscription):
+        pass
+
+    @abstractmethod
+    def _run(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    # One inotify instance for the process; every subscription's directories share it
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}  # wd -> directory
+        self._watched = set()
+        super().__init__()
+
+    def _add_watch(self, directory):
+        if directory in self._watched:
+            return
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self._directories[wd] = directory
+        self._watched.add(directory)
+
+    def _add_tree(self, root, path):
+        # A directory created or moved in under root, and what's below it, minus what root's ignore rules hide
+        for directory, dirs, _ in walk(path):
+            dirs[:] = [name for name in dirs if not is_ignored(root, os.path.join(directory, name), is_dir=True)]
+            try:
+                self._add_watch(directory)
+            except FileNotFoundError:
+                continue
+
+    def unsubscribe(self, subscription):
+        # Drop the watches no remaining subscription needs
+        with self._lock:
+            super().unsubscribe(subscription)
+            roots = [other.root for other in self._subscriptions if other.full]
+            hot = {os.path.dirname(path) for other in self._subscriptions for path in other.hot}
+            for wd, directory in list(self._directories.items()):
+                if directory in hot or any(directory == root or directory.startswith(root + os.sep) for root in roots):
+                    continue
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._directories[wd]
+                self._watched.discard(directory)
+
+    def _subscribed(self, subscription, directories):
+        if not subscription.full:
+            return
+        try:
+            for directory in directories:
+                try:
+                    self._add_watch(directory)
+                except FileNotFoundError:
+                    continue
+            subscription.complete = True
+        except OSError:
+            # Out of watches (fs.inotify.max_user_watches): fall back to the files in context
+            subscription.full = False
+
+    def watch_hot(self, subscription):
+        if subscription.full:
+            return
+        with self._lock:
+            for path in subscription.hot:
+                try:
+                    self._add_watch(os.path.dirname(path))
+                except OSError:
+                    continue
+
+    def sync(self, subscription):
+        # Deliver whatever the kernel has queued so a drain right after a write sees it
+        self._read()
+
+    def _read(self):
+        with self._lock:
+            while True:
+                try:
+                    data = os.read(self._fd, 65536)
+                except BlockingIOError:
+                    return
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = EVENT.unpack_from(data, offset)
+                    name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                    offset += EVENT.size + length
+                    self._handle(wd, mask, os.fsdecode(name))
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            for subscription in self._subscriptions:
+                subscription.overflow()
+            return
+        directory = self._directories.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self._directories[wd]
+            self._watched.discard(directory)
+            return
+        path = os.path.join(directory, name) if name else directory
+        is_dir = bool(mask & IN_ISDIR) or not name
+        if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+            for subscription in self._subscriptions:
+                if subscription.full and path.startswith(subscription.root + os.sep) \
+                        and not is_ignored(subscription.root, path, is_dir=True):
+                    try:
+                        self._add_tree(subscription.root, path)
+                    except OSError:
+                        pass
+                    break
+        for subscription in self._subscriptions:
+            subscription.push(path, is_dir)
+
+    def _run(self):
+        while True:
+            select.select([self._fd], [], [])
+            self._read()
+
+
+class PollingWatcher(Watcher):
+    # Where inotify isn't available: listings show created and deleted files, stat() shows edits.
+    # Each poll stats the hot paths plus the next slice of the tree, so a big tree costs the same per poll
+    def __init__(self):
+        self._state = {}  # subscription -> {"stamps", "scanned", "cursor"}
+        super().__init__()
+
+    def _subscribed(self, subscription, directories):
+        self._state[subscription] = {"stamps": {}, "scanned": False, "cursor": 0}
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            super().unsubscribe(subscription)
+            self._state.pop(subscription, None)
+
+    def watch_hot(self, subscription):
+        with self._lock:
+            stamps = self._state[subscription]["stamps"]
+            for path in subscription.hot:
+                if path not in stamps:
+                    stamps[path] = stamp(path)
+
+    def _check(self, subscription, stamps, paths):
+        for path in paths:
+            current = stamp(path)
+            if path in stamps and stamps[path] != current:
+                subscription.push(path)
+            stamps[path] = current
+
+    def sync(self, subscription):
+        # The files in context are few; check them now instead of waiting for the next poll
+        with self._lock:
+            if subscription in self._state:
+                self._check(subscription, self._state[subscription]["stamps"], subscription.hot)
+
+    def _poll(self, subscription):
+        # The listing and the slice's stat() calls run outside the lock, so sync() never waits on a poll;
+        # what they saw is merged in under it. Hot paths are left to sync() and checked under the lock
+        with self._lock:
+            state = self._state.get(subscription)
+            if state is None:
+                return
+            scanned, cursor, known = state["scanned"], state["cursor"], set(state["stamps"])
+        observed = {}
+        files = []
+        if subscription.full:
+            files = list(iter_files(subscription.root))
+            if scanned:
+                start = cursor % max(1, len(files))
+                cursor = start + WATCH_POLL_BATCH
+                paths = set(files[start:cursor]).union(path for path in files if path not in known)
+            else:
+                # The first look only records what's there
+                paths = files
+            observed = {path: stamp(path) for path in paths}
+        with self._lock:
+            if subscription not in self._state:
+                return
+            stamps = state["stamps"]
+            hot = subscription.hot
+            for path, current in observed.items():
+                if path in hot:
+                    continue
+                if scanned and (path not in stamps or stamps[path] != current):
+                    subscription.push(path)
+                stamps[path] = current
+            if scanned and subscription.full:
+                current_files = set(files)
+                for path in [path for path in known if path not in current_files and path not in hot and path in stamps]:
+                    del stamps[path]
+                    subscription.push(path)
+            state["scanned"] = True
+            state["cursor"] = cursor
+            self._check(subscription, stamps, hot)
+
+    def _run(self):
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            with self._lock:
+                subscriptions = list(self._subscriptions)
+            for subscription in subscriptions:
+                self._poll(subscription)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_watcher():
+    # The process-wide watcher, started on first use; None when WATCH_BACKEND is off
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None and WATCH_BACKEND != "off":
+            if WATCH_BACKEND in ("auto", "inotify"):
+                try:
+                    _watcher = InotifyWatcher()
+                except (OSError, AttributeError):
+                    _watcher = None
+            if _watcher is None:
+                _watcher = PollingWatcher()
+        return _watcher
@@ -1,89 +1,84 @@
-from google.api_core.exceptions import ResourceExhausted, GoogleAPIError
 import os
+import sys
 import json
-from google.generativeai.protos import ToolConfig, FunctionCallingConfig, FunctionResponse, Part
-from tools import tool_list, execute_tool
+from tools import get_tool_list, execute_tool
+import model_client
+import model_router
+from model_router import require_content
+from tracing import traced, recent_traces
+from journal import pack_text, journal_path, export_markdown, list_sessions
+from messages import ToolCall, ToolResult
+from session import Session
+from image_cache import start_upload
+from cancellation import run_interruptible
 
 import asyncio
-import aiohttp
 
 from rich.console import Console
 from rich.panel import Panel
-from rich.syntax import Syntax
-from rich.markdown import Markdown
 
-from prompt_toolkit import PromptSession
-from prompt_toolkit.styles import Style
+_prompt_session = None
+
 async def get_user_input(prompt="You: "):
-    style = Style.from_dict({
-        'prompt': 'cyan bold',
-    })
-    session = PromptSession(style=style)
-    return await session.prompt_async(prompt, multiline=False)
-from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn
+    # prompt_toolkit is only needed once the first prompt is shown
+    global _prompt_session
+    if _prompt_session is None:
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.styles import Style
+        style = Style.from_dict({
+            'prompt': 'cyan bold',
+        })
+        _prompt_session = PromptSession(style=style)
+    return await _prompt_session.prompt_async(prompt, multiline=False)
 import datetime
 import time
 from datetime import datetime
 
 from config import *
 
-def save_chat():
-    # Generate filename
-    now = datetime.now()
-    filename = f"Chat_{now.strftime('%H%M')}.md"
-    
-    # Format conversation history
-    formatted_chat = "# Gemini Engineer Chat Log\n\n"
-    for message in conversation_history:
-        if message['role'] == 'user':
-            formatted_chat += f"## User\n\n{message['parts']}\n\n"
-        elif message['role'] == 'model':
-            if isinstance(message['parts'], str):
-                formatted_chat += f"## Gemini\n\n{message['parts']}\n\n"
-            elif isinstance(message['parts'], list):
-                for content in message['parts']:
-                    if content['type'] == 'function_call':
-                        formatted_chat += f"### Tool Use: {content['name']}\n\n```json\n{json.dumps(content['input'], indent=2)}\n```\n\n"
-                    elif content['type'] == 'text':
-                        formatted_chat += f"## Gemini\n\n{content['text']}\n\n"
-        elif message['role'] == 'user' and isinstance(message['parts'], list):
-            for content in message['parts']:
-                if content['type'] == 'function_call':
-                    formatted_chat += f"### Tool Result\n\n```\n{content['parts']}\n```\n\n"
-    
-    # Save to file
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(formatted_chat)
-    
-    return filename
+def save_chat(session):
+    journal = session.journal
+    journal.sync()
+    if not os.path.exists(journal.path):
+        return None
+
+    # Include seconds, and never overwrite an earlier export
+    base = f"Chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    filename = f"{base}.md"
+    suffix = 1
+    while os.path.exists(filename):
+        filename = f"{base}_{suffix}.md"
+        suffix += 1
+    return export_markdown(journal.path, filename)
+
+def resume_session(session, session_ref):
+    path = journal_path(session_ref)
+    if not os.path.isfile(path):
+        console.print(Panel(f"No session journal found for '{session_ref}'.", title="Error", style="bold red"))
+        return
+
+    session.restore(path)
+    console.print(Panel(f"Resumed session {session.session_id}: {len(session.conversation_history)} messages, {len(session.file_contents)} files in context.", title="Session Resumed", style="bold green"))
+    display_token_usage(session)
+
+def display_sessions():
+    sessions = list_sessions()
+    if sessions:
+        console.print(Panel("\n".join(sessions), title="Recent Sessions (resume <session>)", title_align="left", style="cyan"))
+    else:
+        console.print(Panel("No saved sessions yet.", title="Sessions", style="yellow"))
 
-def reset_code_editor_memory():
-    global code_editor_memory
-    code_editor_memory = []
+def reset_code_editor_memory(session):
+    session.code_editor_memory.clear()
     console.print(Panel("Code editor memory has been reset.", title="Reset", style="bold green"))
 
-def reset_conversation():
-    global conversation_history, main_model_tokens, tool_checker_tokens, code_editor_tokens, code_execution_tokens, file_contents, code_editor_files
-    conversation_history = []
-    main_model_tokens = {'input': 0, 'output': 0}
-    tool_checker_tokens = {'input': 0, 'output': 0}
-    code_editor_tokens = {'input': 0, 'output': 0}
-    code_execution_tokens = {'input': 0, 'output': 0}
-    file_contents = {}
-    code_editor_files = set()
-    reset_code_editor_memory()
+def reset_conversation(session):
+    session.reset()
+    reset_code_editor_memory(session)
     console.print(Panel("Conversation history, token counts, file contents, code editor memory, and code editor files have been reset.", title="Reset", style="bold green"))
-    display_token_usage()
+    display_token_usage(session)
 
-def upload_image_to_gemini(image_path):
-    try:
-        image_file = genai.upload_file(path=image_path, display_name="Upload image")
-        return image_file
-
-    except Exception:
-        console.print(Panel(f"Error encoding image: {image_path}", title="Error", style="bold red"))
-
-def display_token_usage():
+def display_token_usage(session):
     from rich.table import Table
     from rich.panel import Panel
     from rich.box import ROUNDED
@@ -108,10 +103,10 @@ def display_token_usage():
     total_cost = 0
     total_context_tokens = 0
 
-    for model, tokens in [("Main Model", main_model_tokens),
-                          ("Tool Checker", tool_checker_tokens),
-                          ("Code Editor", code_editor_tokens),
-                          ("Code Execution", code_execution_tokens)]:
+    for model, tokens in [("Main Model", session.main_model_tokens),
+                          ("Tool Checker", session.tool_checker_tokens),
+                          ("Code Editor", session.code_editor_tokens),
+                          ("Code Execution", session.code_execution_tokens)]:
         input_tokens = tokens['input']
         output_tokens = tokens['output']
         total_tokens = input_tokens + output_tokens
@@ -155,71 +150,205 @@ def display_token_usage():
     console.print(table)        
            
             
-async def chat_with_gemini(user_input, image_path=None, current_iteration=None, max_iterations=None):
-    global conversation_history, automode, main_model_tokens
+def display_profile(turns=5):
+    from rich.table import Table
+    from rich.box import ROUNDED
+
+    traces = recent_traces(turns, name="chat_with_gemini")
+    if not traces:
+        console.print(Panel("No turns have been traced yet.", title="Profile", style="yellow"))
+        return
+
+    spans = [s for root in traces for s in root.walk()]
+    total_time = sum(root.duration for root in traces)
+
+    slowest = Table(box=ROUNDED, title=f"Slowest spans (last {len(traces)} turns)")
+    slowest.add_column("Span", style="cyan")
+    slowest.add_column("Detail", style="white")
+    slowest.add_column("Duration (ms)", style="magenta", justify="right")
+    slowest.add_column("Bytes in/out", style="green", justify="right")
+    slowest.add_column("Tokens in/out", style="yellow", justify="right")
+    for s in sorted(spans, key=lambda s: s.duration, reverse=True)[:10]:
+        attributes = s.attributes
+        slowest.add_row(
+            s.name,
+            str(attributes.get("tool") or attributes.get("model") or attributes.get("renderable") or ""),
+            f"{s.duration * 1000:,.1f}",
+            f"{attributes.get('bytes_in', 0):,}/{attributes.get('bytes_out', 0):,}",
+            f"{attributes.get('input_tokens', 0):,}/{attributes.get('output_tokens', 0):,}",
+        )
 
-    # This function uses MAINMODEL, which maintains context across calls
-    current_conversation = []
+    # Self time per span name, so nested spans are not counted twice
+    breakdown = {}
+    for s in spans:
+        entry = breakdown.setdefault(s.name, {"count": 0, "self": 0.0})
+        entry["count"] += 1
+        entry["self"] += s.self_time
+
+    summary = Table(box=ROUNDED, title=f"Time breakdown ({total_time * 1000:,.1f} ms total)")
+    summary.add_column("Span", style="cyan")
+    summary.add_column("Calls", style="white", justify="right")
+    summary.add_column("Self time (ms)", style="magenta", justify="right")
+    summary.add_column("% of turn time", style="green", justify="right")
+    for name, entry in sorted(breakdown.items(), key=lambda item: item[1]["self"], reverse=True):
+        percentage = (entry["self"] / total_time * 100) if total_time else 0
+        summary.add_row(name, str(entry["count"]), f"{entry['self'] * 1000:,.1f}", f"{percentage:.1f}%")
+
+    console.print(slowest)
+    console.print(summary)
+
+def display_models():
+    from rich.table import Table
+    from rich.box import ROUNDED
+
+    if not model_router.router.stats:
+        console.print(Panel("No model calls yet." if MODEL_ROUTING != "fixed" else "Model routing is off (MODEL_ROUTING=fixed).", title="Models", style="yellow"))
+        return
+    table = Table(box=ROUNDED, title=f"Model calls by role and tier ({', '.join(f'{tier}: {name}' for tier, name in MODEL_TIERS.items())})")
+    table.add_column("Role", style="cyan")
+    table.add_column("Tier", style="white")
+    table.add_column("Calls", style="magenta", justify="right")
+    table.add_column("Failed validation", style="red", justify="right")
+    table.add_column("Latency (s, EWMA)", style="yellow", justify="right")
+    table.add_column("Tokens in/out", style="green", justify="right")
+    table.add_column("Est. cost ($)", style="green", justify="right")
+    table.add_column("Hedged (won)", style="white", justify="right")
+    table.add_column("Timeouts", style="red", justify="right")
+    # model_client keys its counts by the SDK's model name ("models/...")
+    hedges = {(model.split("/")[-1], role): counts for (model, role), counts in model_client.latency.hedges.items()}
+    timeouts = {(model.split("/")[-1], role): count for (model, role), count in model_client.latency.timeouts.items()}
+    for (role, tier), stats in sorted(model_router.router.stats.items()):
+        hedged, won = hedges.get((MODEL_TIERS[tier], role), (0, 0))
+        input_cost, output_cost = MODEL_TIER_COSTS.get(tier, (0, 0))
+        cost = (stats.input_tokens * input_cost + stats.output_tokens * output_cost) / 1_000_000
+        table.add_row(
+            role,
+            tier,
+            f"{stats.calls:,}",
+            f"{stats.failures:,} ({stats.failure_rate:.0%})",
+            f"{stats.latency:.2f}" if stats.latency is not None else "-",
+            f"{stats.input_tokens:,}/{stats.output_tokens:,}",
+            f"{cost:.4f}",
+            f"{hedged:,} ({won:,})",
+            f"{timeouts.get((MODEL_TIERS[tier], role), 0):,}",
+        )
+    console.print(table)
+
+def rollback_turn(session, turn_start):
+    # Drop the turn's messages from the history and the journal; files the turn showed go out whole next time
+    session.conversation_history.rollback(turn_start)
+    session.journal.append("rollback", messages=turn_start)
+    for path, state in session.file_state.shown():
+        if state.touched == session.turn:
+            session.file_state.forget(path)
+    session.tool_memo.rollback(session.turn)
+    session.turn -= 1
+    session.file_state.turn = session.turn
+
+
+@traced("chat_with_gemini")
+async def chat_with_gemini(session, user_input, image_path=None, current_iteration=None, max_iterations=None, image_upload=None):
+    # The turn appends to the history as it goes; one that fails part way leaves the history as it found it
+    turn_start = len(session.conversation_history)
+    try:
+        return await _chat_turn(session, user_input, image_path, current_iteration, max_iterations, image_upload, turn_start)
+    except asyncio.CancelledError:
+        # Tool calls and their results go in as pairs, so what is there is whole; tools that did run keep
+        # their exchange (their effects are real) and a note closes the turn
+        if len(session.conversation_history) > turn_start + 1:
+            session.conversation_history.add("model", CANCELLED_TURN_MESSAGE, session.turn)
+            session.journal.append("message", role="model", text=CANCELLED_TURN_MESSAGE)
+        else:
+            rollback_turn(session, turn_start)
+        raise
+    except BaseException:
+        rollback_turn(session, turn_start)
+        raise
+
+
+async def _chat_turn(session, user_input, image_path, current_iteration, max_iterations, image_upload, turn_start):
+    from google.api_core.exceptions import ResourceExhausted, GoogleAPIError, DeadlineExceeded
+    from google.generativeai.protos import ToolConfig, FunctionCallingConfig
+
+    # The image is shrunk and uploaded in the background while the rest of the request is put together;
+    # callers that know the path early pass in the task from start_upload
+    if image_path and image_upload is None:
+        image_upload = start_upload(image_path)
+
+    # This function uses MAINMODEL, which maintains context across calls. The turn's messages are appended to the
+    # history itself, which is what the model is sent
+    messages = session.conversation_history
+    session.turn += 1
+    session.file_state.turn = session.turn
+
+    # Kept for a retry, which sends the caller's text again rather than what this turn added to it
+    requested_input = user_input
+
+    # Edits made by the user's editor or a command since the last turn, so nothing stale gets edited
+    external_changes = session.external_changes()
+    if external_changes:
+        console.print(Panel(external_changes, title="Files Changed Externally", title_align="left", style="yellow"))
+        await session.emit("files_changed", summary=external_changes)
+        user_input = f"{external_changes}\n\n{user_input}"
+
+    # Files the model hasn't looked at for a while go down to an outline; the ones the user mentions come back whole
+    promoted = session.context_compressor.start_turn(session, user_input)
+    if session.context_compressor.outlined:
+        console.print(Panel(", ".join(session.context_compressor.outlined), title="Files Outlined In Context", title_align="left", style="dim"))
+    if promoted:
+        user_input = f"{user_input}\n\n{promoted}"
 
     if image_path:
         console.print(Panel(f"Processing image at path: {image_path}", title_align="left", title="Image Processing", expand=False, style="yellow"))
-        image_upload = upload_image_to_gemini(image_path)
+        upload = await image_upload
+        if upload.error:
+            console.print(Panel(upload.summary(), title="Error", style="bold red"))
+            return "I'm sorry, there was an error processing the image. Please try again.", False
+        request_content = [user_input, upload.file]
 
-        if type(image_upload) == str:
-            return "I'm sorry, there was an error processing the image. Please try again.", False   
-        request_content = [user_input, image_upload]
-        
-        console.print(Panel("Image message added to conversation history", title_align="left", title="Image Added", style="green"))
+        console.print(Panel(upload.summary(), title_align="left", title="Image Added", style="green"))
     else:
         request_content = user_input
         
-    current_conversation.append({
-        "role": "user",
-        "parts": request_content
-    })
+    messages.add("user", request_content, session.turn)
+    if image_path:
+        session.journal.append("message", role="user", image_path=image_path, **pack_text(user_input))
+    else:
+        session.journal.append("message", role="user", **pack_text(user_input))
         
     
-    # Filter conversation history to maintain context
-    filtered_conversation_history = []
-    for message in conversation_history:
-        if isinstance(message['parts'], list):
-            filtered_content = [
-                content for content in message['parts']
-                if content.get('type') != 'tool_result' or (
-                    content.get('type') == 'tool_result' and
-                    not any(keyword in content.get('output', '') for keyword in [
-                        "File contents updated in system prompt",
-                        "File created and added to system prompt",
-                        "has been read and stored in the system prompt"
-                    ])
-                )
-            ]
-            if filtered_content:
-                filtered_conversation_history.append({**message, 'parts': filtered_content})
-        else:
-            filtered_conversation_history.append(message)
-
-    # Combine filtered history with current conversation to maintain context
-    messages = filtered_conversation_history + current_conversation
+    # Older copies of files the model has since been shown again in full are cut down to a stub
+    session.file_state.collapse(messages)
     try:
     
         # MAINMODEL call, which maintains context
-        response = main_model.generate_content(
-            contents =messages,
+        response = await model_router.generate(
+            "main",
+            get_main_model,
+            messages,
             tool_config= ToolConfig(
             function_calling_config=FunctionCallingConfig(
                 mode=FunctionCallingConfig.Mode.AUTO)
             ),
-            tools= tool_list
+            tools=get_tool_list()
         )
         # Update token usage for MAINMODEL
-        main_model_tokens['input'] += response.usage_metadata.prompt_token_count
-        main_model_tokens['output'] += response.usage_metadata.candidates_token_count
+        session.main_model_tokens['input'] += response.usage_metadata.prompt_token_count
+        session.main_model_tokens['output'] += response.usage_metadata.candidates_token_count
         
+    except DeadlineExceeded as e:
+        rollback_turn(session, turn_start)
+        console.print(Panel(str(e), title="API Error", style="bold red"))
+        return "I'm sorry, the model took too long to answer. Please try again.", False
     except ResourceExhausted as e:
+        rollback_turn(session, turn_start)
         console.print(Panel("Rate limit exceeded. Retrying after a short delay...", title="API Error", style="bold yellow"))
-        time.sleep(5)
-        return await chat_with_gemini(user_input, image_path, current_iteration, max_iterations)
+        await asyncio.sleep(5)
+        # The changes were drained from the watcher already, so their note goes along with the retry
+        if external_changes:
+            requested_input = f"{external_changes}\n\n{requested_input}"
+        # Straight back into the turn, so a failed retry is rolled back once, by the caller's chat_with_gemini
+        return await _chat_turn(session, requested_input, image_path, current_iteration, max_iterations, None, turn_start)
     # except GoogleAPIError as e:
     #     console.print(Panel(f"API Error: {str(e)}", title="API Error", style="bold red"))
     #     return "I'm sorry, there was an error communicating with the AI. Please try again.", False
@@ -231,6 +360,7 @@ async def chat_with_gemini(user_input, image_path=None, current_iteration=None,
     for content_block in response.candidates[0].content.parts:
         if content_block.text:
             assistant_response += content_block.text + "\n"
+            await session.emit("chunk", text=content_block.text)
             if CONTINUATION_EXIT_PHRASE in content_block.text:
                 exit_continuation = True
         elif content_block.function_call:
@@ -239,37 +369,36 @@ async def chat_with_gemini(user_input, image_path=None, current_iteration=None,
     console.print(Panel(Markdown(assistant_response), title="Gemini's Response", title_align="left", border_style="blue", expand=False))
 
     # Display files in context
-    if file_contents:
-        files_in_context = "\n".join(file_contents.keys())
+    if session.file_contents:
+        files_in_context = "\n".join(session.file_contents.keys())
     else:
         files_in_context = "No files in context. Read, create, or edit files to add."
     console.print(Panel(files_in_context, title="Files in Context", title_align="left", border_style="white", expand=False))
 
     for tool_use in tool_uses:
         tool_name = tool_use.function_call.name
-        tool_input = {key: value for key, value in tool_use.function_call.args.items()}
+        # Plain dicts and lists, not proto containers, so the input prints as JSON and list arguments behave
+        tool_input = type(tool_use.function_call).to_dict(tool_use.function_call)["args"]
+        await session.emit("tool_call", name=tool_name, input=tool_input)
         
 
         console.print(Panel(f"Tool Used: {tool_name}", style="green"))
         console.print(Panel(f"Tool Input: {json.dumps(tool_input, indent=2)}", style="green"))
 
-        tool_result = await execute_tool(tool_name, tool_input)
-                
+        tool_result = await execute_tool(session, tool_name, tool_input)
+        # Into the history before the next await, so a cancel can't lose a result the file state already counts
+        messages.add("model", [ToolCall(tool_name, tool_input)], session.turn)
+        messages.add("user", [ToolResult(tool_name, tool_result["content"], tool_result["is_error"])], session.turn)
+        session.journal.append("tool_call", name=tool_name, args=tool_input)
+        session.journal.append("tool_result", name=tool_name, is_error=tool_result["is_error"], **pack_text(str(tool_result["content"])))
+        session.journal_state_changes()
+
+        await session.emit("tool_result", name=tool_name, content=str(tool_result["content"]), is_error=tool_result["is_error"])
         if tool_result["is_error"]:
             console.print(Panel(tool_result["content"], title="Tool Execution Error", style="bold red"))
         else:
             console.print(Panel(tool_result["content"], title_align="left", title="Tool Result", style="green"))
 
-        current_conversation.append({
-            "role": "model",
-            "parts": [tool_use]
-        })
-
-        current_conversation.append({
-            "role": "user",
-            "parts": [Part(function_response= FunctionResponse(name=tool_name, response={"result": tool_result}))]
-        })
-
         # Update the file_contents dictionary if applicable
         if tool_name in ['create_file', 'edit_and_apply', 'read_file'] and not tool_result["is_error"]:
             if 'path' in tool_input:
@@ -280,20 +409,23 @@ async def chat_with_gemini(user_input, image_path=None, current_iteration=None,
                     # The file_contents dictionary is already updated in the tool function
                     pass
 
-        messages = filtered_conversation_history + current_conversation
+        session.file_state.collapse(messages)
 
         try:
-            tool_response = main_model.generate_content(
-                contents =messages,
+            tool_response = await model_router.generate(
+                "tool_checker",
+                get_main_model,
+                messages,
+                validate=require_content,
                 tool_config= ToolConfig(
                     function_calling_config=FunctionCallingConfig(
                         mode=FunctionCallingConfig.Mode.AUTO)
                 ),
-                tools= tool_list
+                tools=get_tool_list()
             )
             # Update token usage for tool checker
-            tool_checker_tokens['input'] += tool_response.usage_metadata.prompt_token_count
-            tool_checker_tokens['output'] += tool_response.usage_metadata.candidates_token_count
+            session.tool_checker_tokens['input'] += tool_response.usage_metadata.prompt_token_count
+            session.tool_checker_tokens['output'] += tool_response.usage_metadata.candidates_token_count
             
             tool_checker_response = ""
             for tool_content_block in tool_response.candidates[0].content.parts:
@@ -301,100 +433,143 @@ async def chat_with_gemini(user_input, image_path=None, current_iteration=None,
                     tool_checker_response += tool_content_block.text
             console.print(Panel(Markdown(tool_checker_response), title="Gemini's Response to Tool Result",  title_align="left", border_style="blue", expand=False))
             assistant_response += "\n\n" + tool_checker_response
+            await session.emit("chunk", text=tool_checker_response)
         except GoogleAPIError as e:
             error_message = f"Error in tool response: {str(e)}"
             console.print(Panel(error_message, title="Error", style="bold red"))
             assistant_response += f"\n\n{error_message}"
 
-    if assistant_response:
-        current_conversation.append({"role": "model", "parts": assistant_response})
-
-    conversation_history = messages + [{"role": "model", "parts": assistant_response}]
+    messages.add("model", assistant_response, session.turn)
+    # Old turns' payloads move out of the heap; they are read back from the spill file for each request
+    messages.spill(session.turn)
+    session.journal.append("message", role="model", **pack_text(assistant_response))
+    session.journal_state_changes()
+    session.journal.sync()
 
     # Display token usage at the end
-    display_token_usage()
+    display_token_usage(session)
 
     return assistant_response, exit_continuation
     
-async def main():
+async def run_automode(session, user_input, max_iterations=MAX_CONTINUATION_ITERATIONS):
+    session.automode = True
+    iteration_count = 0
+    while session.automode and iteration_count < max_iterations:
+        response, exit_continuation = await chat_with_gemini(session, user_input, current_iteration=iteration_count+1, max_iterations=max_iterations)
+        await session.emit("automode_iteration", iteration=iteration_count + 1, max_iterations=max_iterations)
+        
+        if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
+            console.print(Panel("Automode completed.", title_align="left", title="Automode", style="green"))
+            session.automode = False
+        else:
+            console.print(Panel(f"Continuation iteration {iteration_count + 1} completed. Press Ctrl+C to exit automode. ", title_align="left", title="Automode", style="yellow"))
+            user_input = "Continue with the next step. Or STOP by saying 'AUTOMODE_COMPLETE' if you think you've achieved the results established in the original request."                        
+        iteration_count += 1
+        
+        if iteration_count >= max_iterations:
+            console.print(Panel("Max iterations reached. Exiting automode.", title_align="left", title="Automode", style="bold red"))
+            session.automode = False
+    return iteration_count
+
+def show_welcome():
     console.print(Panel("Welcome to the Gemini Engineer Chat with Multi-Agent and Image Support!", title="Welcome", style="bold green"))
     console.print("Type 'exit' to end the conversation.")
     console.print("Type 'image' to include an image in your message.")
     console.print("Type 'automode [number]' to enter Autonomous mode with a specific number of iterations.")
     console.print("Type 'reset' to clear the conversation history.")
     console.print("Type 'save chat' to save the conversation to a Markdown file.")
-    console.print("While in automode, press Ctrl+C at any time to exit the automode to return to regular chat.")  
+    console.print("Type 'resume [session]' to list saved sessions or continue one.")
+    console.print("Type 'profile [turns]' to see where the time went in the last turns.")
+    console.print("Type 'models' to see which model tiers handled each role and how they did.")
+    console.print("Press Ctrl+C to cancel a running turn; in automode it also exits automode and returns to regular chat.")  
+
+async def main():
+    show_welcome()
+    session = Session()
     while True:
         user_input = await get_user_input()
         
         if user_input.lower() == 'exit':
+            session.close()
             console.print(Panel("Thank you for chatting. Goodbye!", title_align="left", title="Goodbye", style="bold green"))
             break
 
         if user_input.lower() == 'reset':
-            reset_conversation()
+            reset_conversation(session)
             continue
 
         if user_input.lower() == 'save chat':
-            filename = save_chat()
-            console.print(Panel(f"Chat saved to {filename}", title="Chat Saved", style="bold green"))
+            filename = save_chat(session)
+            if filename:
+                console.print(Panel(f"Chat saved to {filename}", title="Chat Saved", style="bold green"))
+            else:
+                console.print(Panel("Nothing to save yet.", title="Chat Not Saved", style="yellow"))
+            continue
+
+        if user_input.lower().startswith('resume'):
+            parts = user_input.split(maxsplit=1)
+            if len(parts) > 1:
+                resume_session(session, parts[1].strip())
+            else:
+                display_sessions()
             continue
         
+        if user_input.lower().startswith('profile'):
+            parts = user_input.split()
+            display_profile(int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 5)
+            continue
+        
+        if user_input.lower() == 'models':
+            display_models()
+            continue
+
         if user_input.lower() == 'image':
             image_path = (await get_user_input("Drag and drop your image here, then press enter: ")).strip().replace("'", "")
             
             if os.path.isfile(image_path):
+                # Upload while the prompt is being typed
+                image_upload = start_upload(image_path)
                 user_input = await get_user_input("You (prompt for image): ")
-                response, _ = await chat_with_gemini(user_input, image_path)
+                _, token = await run_interruptible(session, chat_with_gemini(session, user_input, image_path, image_upload=image_upload))
+                if token.cancelled:
+                    console.print(Panel(f"Turn cancelled in {token.stop_ms:.0f} ms.", title="Cancelled", style="bold red"))
             else:
                 console.print(Panel("Invalid image path. Please try again.", title="Error", style="bold red"))
                 continue
         elif user_input.lower().startswith('automode'):
-            try:
-                parts = user_input.split()
-                if len(parts) > 1 and parts[1].isdigit():
-                    max_iterations = int(parts[1])
-                else:
-                    max_iterations = MAX_CONTINUATION_ITERATIONS
-                
-                automode = True
-                console.print(Panel(f"Entering automode with {max_iterations} iterations. Please provide the goal of the automode.", title_align="left", title="Automode", style="bold yellow"))
-                console.print(Panel("Press Ctrl+C at any time to exit the automode loop.", style="bold yellow"))
-                user_input = await get_user_input()
-                
-                iteration_count = 0
-                try:
-                    while automode and iteration_count < max_iterations:
-                        response, exit_continuation = await chat_with_gemini(user_input, current_iteration=iteration_count+1, max_iterations=max_iterations)
-                        
-                        if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
-                            console.print(Panel("Automode completed.", title_align="left", title="Automode", style="green"))
-                            automode = False
-                        else:
-                            console.print(Panel(f"Continuation iteration {iteration_count + 1} completed. Press Ctrl+C to exit automode. ", title_align="left", title="Automode", style="yellow"))
-                            user_input = "Continue with the next step. Or STOP by saying 'AUTOMODE_COMPLETE' if you think you've achieved the results established in the original request."                        
-                        iteration_count += 1
-                        
-                        if iteration_count >= max_iterations:
-                            console.print(Panel("Max iterations reached. Exiting automode.", title_align="left", title="Automode", style="bold red"))
-                            automode = False
-                except KeyboardInterrupt:
-                    console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))
-                    automode = False
-                    # Ensure the conversation history ends with an assistant message
-                    if conversation_history and conversation_history[-1]["role"] == "user":
-                        conversation_history.append({"role": "model", "content": "Automode interrupted. How can I assist you further?"})
-            except KeyboardInterrupt:
-                console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))
-                automode = False
-                # Ensure the conversation history ends with an assistant message
-                if conversation_history and conversation_history[-1]["role"] == "user":
-                    conversation_history.append({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})
-            
+            parts = user_input.split()
+            if len(parts) > 1 and parts[1].isdigit():
+                max_iterations = int(parts[1])
+            else:
+                max_iterations = MAX_CONTINUATION_ITERATIONS
+
+            console.print(Panel(f"Entering automode with {max_iterations} iterations. Please provide the goal of the automode.", title_align="left", title="Automode", style="bold yellow"))
+            console.print(Panel("Press Ctrl+C at any time to exit the automode loop.", style="bold yellow"))
+            user_input = await get_user_input()
+
+            _, token = await run_interruptible(session, run_automode(session, user_input, max_iterations))
+            if token.cancelled:
+                session.automode = False
+                console.print(Panel(f"\nAutomode interrupted by user (stopped in {token.stop_ms:.0f} ms). Exiting automode.", title_align="left", title="Automode", style="bold red"))
+
             console.print(Panel("Exited automode. Returning to regular chat.", style="green"))
         else:
-            response, _ = await chat_with_gemini(user_input)
+            _, token = await run_interruptible(session, chat_with_gemini(session, user_input))
+            if token.cancelled:
+                console.print(Panel(f"Turn cancelled in {token.stop_ms:.0f} ms.", title="Cancelled", style="bold red"))
             
 if __name__ == "__main__":
+    if MODEL_BACKEND == "fake":
+        from fake_backend import FakeBackend, install_fake_backend, scripted
+        install_fake_backend(FakeBackend(scripted()))
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        import batch
+        sys.exit(batch.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        import server
+        sys.exit(server.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "venv":
+        import venv_manager
+        sys.exit(venv_manager.main(sys.argv[2:]))
     asyncio.run(main())
     
@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import threading
+import time
+
+from config import IMAGE_CACHE_DIR, IMAGE_MAX_DIMENSION, IMAGE_MAX_BYTES, IMAGE_JPEG_QUALITY, load_genai
+from project_tree import format_size
+from tracing import span
+
+# Uploaded files expire after 48 hours; stop reusing them an hour before that
+UPLOAD_LIFETIME = 47 * 3600
+PNG_MAX_COLORS = 4096
+ORIENTATION_TAG = 0x0112
+
+_lock = threading.Lock()
+_uploads = None  # content key -> {"name", "uri", "mime_type", "expires", ...}
+
+
+class ImageUpload:
+    __slots__ = ("path", "file", "error", "cached", "original_bytes", "uploaded_bytes", "size", "prepare_ms", "upload_ms")
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.error = None
+        self.cached = False
+        self.original_bytes = 0
+        self.uploaded_bytes = 0
+        self.size = None
+        self.prepare_ms = 0.0
+        self.upload_ms = 0.0
+
+    def summary(self):
+        if self.error:
+            return f"Image upload failed: {self.error}"
+        saved = self.original_bytes - self.uploaded_bytes
+        text = f"{os.path.basename(self.path)}: {format_size(self.original_bytes)} -> {format_size(self.uploaded_bytes)}"
+        if saved > 0:
+            text += f" ({saved / self.original_bytes:.0%} saved"
+            text += f", {self.size[0]}x{self.size[1]})" if self.size else ")"
+        if self.cached:
+            return text + ", reused an earlier upload of the same image"
+        return text + f", prepared in {self.prepare_ms:,.0f} ms, uploaded in {self.upload_ms:,.0f} ms"
+
+
+def _index_path():
+    return os.path.join(IMAGE_CACHE_DIR, "uploads.json")
+
+
+def _load():
+    global _uploads
+    if _uploads is None:
+        try:
+            with open(_index_path(), "r", encoding="utf-8") as f:
+                _uploads = json.load(f)
+        except (OSError, ValueError):
+            _uploads = {}
+    return _uploads
+
+
+def _save():
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    now = time.time()
+    live = {key: entry for key, entry in _uploads.items() if entry["expires"] > now}
+    tmp_path = f"{_index_path()}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(live, f, indent=2)
+    os.replace(tmp_path, _index_path())
+
+
+def prepare_image(data):
+    # Downscale to IMAGE_MAX_DIMENSION and recompress; returns (bytes, mime type, (width, height), whether the
+    # image was turned upright). Screenshots and diagrams (few colours, sharp edges, maybe transparency) stay
+    # lossless PNG; anything else is treated as a photo and becomes JPEG, which is far smaller and quicker to encode
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    # JPEGs can be decoded straight at a fraction of their size, which is most of the work for camera photos
+    image.draft("RGB", (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+    image.load()
+    # Phones store photos sideways with an EXIF orientation tag, which re-encoding would drop
+    rotated = image.getexif().get(ORIENTATION_TAG, 1) != 1
+    if rotated:
+        image = ImageOps.exif_transpose(image)
+    if max(image.size) > IMAGE_MAX_DIMENSION:
+        image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+
+    if has_alpha or image.getcolors(PNG_MAX_COLORS) is not None:
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+        # Noise-like images with few colours still compress badly; those go to JPEG unless they need alpha
+        if has_alpha or output.tell() <= IMAGE_MAX_BYTES:
+            return output.getvalue(), "image/png", image.size, rotated
+    rgb = image.convert("RGB")
+    quality = IMAGE_JPEG_QUALITY
+    while True:
+        output = io.BytesIO()
+        rgb.save(output, format="JPEG", quality=quality, optimize=True)
+        if output.tell() <= IMAGE_MAX_BYTES or quality <= 40:
+            return output.getvalue(), "image/jpeg", image.size, rotated
+        quality -= 15
+
+
+def _upload_file(output, mime_type, display_name):
+    genai = load_genai()
+    return genai.upload_file(io.BytesIO(output), mime_type=mime_type, display_name=display_name)
+
+
+def _file_reference(entry):
+    from google.generativeai.types.file_types import File
+
+    return File({"name": entry["name"], "uri": entry["uri"], "mime_type": entry["mime_type"]})
+
+
+def upload_image(path):
+    # Blocking: hash, reuse a live upload of the same content, or shrink and upload
+    result = ImageUpload(path)
+    with span("upload_image", path=path) as s:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            result.error = str(e)
+            s.set(error=result.error)
+            return result
+        result.original_bytes = len(data)
+        key = f"{hashlib.sha256(data).hexdigest()}:{IMAGE_MAX_DIMENSION}:{IMAGE_MAX_BYTES}"
+
+        with _lock:
+            entry = _load().get(key)
+        if entry is not None and entry["expires"] > time.time():
+            result.file = _file_reference(entry)
+            result.cached = True
+            result.uploaded_bytes = entry["uploaded_bytes"]
+            result.size = tuple(entry["size"]) if entry.get("size") else None
+            s.set(cached=True, original_bytes=result.original_bytes, uploaded_bytes=result.uploaded_bytes)
+            return result
+
+        start = time.perf_counter()
+        try:
+            output, mime_type, result.size, rotated = prepare_image(data)
+        except Exception as e:
+            result.error = "not an image Pillow can read" if type(e).__name__ == "UnidentifiedImageError" else f"could not read the image: {e}"
+            s.set(error=result.error)
+            return result
+        original_type = mimetypes.guess_type(path)[0]
+        if len(output) >= len(data) and original_type in ("image/png", "image/jpeg", "image/webp") and not rotated:
+            # Already small and compact: send the original untouched
+            output, mime_type = data, original_type
+        result.prepare_ms = (time.perf_counter() - start) * 1000
+        result.uploaded_bytes = len(output)
+
+        start = time.perf_counter()
+        try:
+            uploaded = _upload_file(output, mime_type, os.path.basename(path))
+        except Exception as e:
+            result.error = f"upload failed: {e}"
+            s.set(error=result.error)
+            return result
+        result.upload_ms = (time.perf_counter() - start) * 1000
+        result.file = uploaded
+
+        expires = time.time() + UPLOAD_LIFETIME
+        expiration = getattr(uploaded, "expiration_time", None)
+        if expiration is not None and hasattr(expiration, "timestamp"):
+            expires = min(expires, expiration.timestamp() - 3600)
+        with _lock:
+            _load()[key] = {
+                "name": uploaded.name,
+                "uri": uploaded.uri,
+                "mime_type": getattr(uploaded, "mime_type", None) or mime_type,
+                "expires": expires,
+                "original_bytes": result.original_bytes,
+                "uploaded_bytes": result.uploaded_bytes,
+                "size": list(result.size) if result.size else None,
+            }
+            try:
+                _save()
+            except OSError:
+                pass
+        s.set(cached=False, original_bytes=result.original_bytes, uploaded_bytes=result.uploaded_bytes,
+              prepare_ms=result.prepare_ms, upload_ms=result.upload_ms)
+    return result
+
+
+def start_upload(path):
+    # Begin preparing and uploading now; await the task when the message is sent
+    return asyncio.ensure_future(asyncio.to_thread(upload_image, path))
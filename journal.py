@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import secrets
+import time
+from datetime import datetime
+
+from config import SESSIONS_DIR, JOURNAL_FSYNC_EVERY, JOURNAL_FSYNC_INTERVAL, JOURNAL_INLINE_BYTES
+from messages import History, ToolCall, ToolResult
+
+
+def new_session_id():
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(3)}"
+
+
+def journal_path(session):
+    # Accept a bare session id or a path to a journal file
+    if os.path.isfile(session):
+        return session
+    return os.path.join(SESSIONS_DIR, f"{session}.jsonl")
+
+
+def list_sessions(limit=10):
+    if not os.path.isdir(SESSIONS_DIR):
+        return []
+    journals = [entry for entry in os.scandir(SESSIONS_DIR) if entry.name.endswith(".jsonl")]
+    journals.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return [entry.name[:-len(".jsonl")] for entry in journals[:limit]]
+
+
+def _blob_path(ref):
+    return os.path.join(SESSIONS_DIR, "blobs", ref[:2], ref)
+
+
+def store_blob(text):
+    # Content-addressed, so repeated file snapshots and tool results are stored once
+    data = text.encode("utf-8")
+    ref = hashlib.sha256(data).hexdigest()
+    path = _blob_path(ref)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return ref
+
+
+def load_blob(ref):
+    with open(_blob_path(ref), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def pack_text(text):
+    # Small payloads stay inline, large ones go to the blob store
+    if len(text) <= JOURNAL_INLINE_BYTES:
+        return {"text": text}
+    return {"ref": store_blob(text), "bytes": len(text)}
+
+
+def unpack_text(record):
+    if "ref" in record:
+        return load_blob(record["ref"])
+    return record.get("text", "")
+
+
+class SessionJournal:
+    def __init__(self, session_id=None, path=None):
+        self.session_id = session_id or new_session_id()
+        self.path = path or journal_path(self.session_id)
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, record_type, **fields):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        record = {"t": time.time(), "type": record_type, **fields}
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= JOURNAL_FSYNC_EVERY or time.monotonic() - self._last_sync >= JOURNAL_FSYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        # Records reach the OS on every append; fsync is batched to keep turns fast
+        if self._file is None or not self._unsynced:
+            return
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+def iter_records(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A torn final line from a crash is skipped rather than failing the resume
+                continue
+
+
+def replay(path):
+    history = History()
+    files = {}
+    tokens = {}
+    for record in iter_records(path):
+        record_type = record["type"]
+        if record_type == "message":
+            history.add(record["role"], unpack_text(record))
+        elif record_type == "tool_call":
+            history.add("model", [ToolCall(record["name"], record["args"])])
+        elif record_type == "tool_result":
+            history.add("user", [ToolResult(record["name"], unpack_text(record), record.get("is_error", False))])
+        elif record_type == "file":
+            if record.get("deleted"):
+                files.pop(record["path"], None)
+            else:
+                files[record["path"]] = unpack_text(record)
+        elif record_type == "tokens":
+            counter = tokens.setdefault(record["model"], {"input": 0, "output": 0})
+            counter["input"] += record.get("input", 0)
+            counter["output"] += record.get("output", 0)
+        elif record_type == "rollback":
+            history.rollback(record["messages"])
+        elif record_type == "reset":
+            history, files, tokens = History(), {}, {}
+    return history, files, tokens
+
+
+def export_markdown(path, filename):
+    # Streams the journal into Markdown one record at a time
+    with open(filename, "w", encoding="utf-8") as out:
+        out.write("# Gemini Engineer Chat Log\n\n")
+        for record in iter_records(path):
+            record_type = record["type"]
+            if record_type == "message":
+                heading = "User" if record["role"] == "user" else "Gemini"
+                out.write(f"## {heading}\n\n{unpack_text(record)}\n\n")
+            elif record_type == "tool_call":
+                out.write(f"### Tool Use: {record['name']}\n\n```json\n{json.dumps(record['args'], indent=2)}\n```\n\n")
+            elif record_type == "tool_result":
+                out.write(f"### Tool Result\n\n```\n{unpack_text(record)}\n```\n\n")
+            elif record_type == "rollback":
+                out.write("*The turn above did not finish and was dropped from the conversation*\n\n")
+            elif record_type == "reset":
+                out.write("---\n\n*Conversation reset*\n\n")
+    return filename
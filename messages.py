@@ -0,0 +1,237 @@
+import json
+import mmap
+import os
+import sys
+import tempfile
+from collections.abc import Mapping
+
+from config import HISTORY_SPILL_AFTER_TURNS, HISTORY_SPILL_MIN_BYTES, HISTORY_SPILL_DIR
+
+# Conversation history as compact records. Message, ToolCall, ToolResult and Spilled are Mappings shaped like
+# the dicts the Gemini SDK takes (content and part dicts), so a History goes to the model as it is
+
+
+class SpillStore:
+    # Append-only scratch file for the payloads of old turns, read back through mmap so they sit in the page
+    # cache instead of the heap; deleted when closed
+    def __init__(self, directory=HISTORY_SPILL_DIR):
+        self.directory = directory
+        self.size = 0
+        self._file = None
+        self._map = None
+
+    def put(self, text):
+        if self._file is None:
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+            self._file = tempfile.TemporaryFile(prefix="history-", dir=self.directory)
+        data = text.encode("utf-8", "surrogatepass")
+        offset = self.size
+        self._file.write(data)
+        self.size += len(data)
+        return Spilled(self, offset, len(data))
+
+    def get(self, offset, length):
+        if self._map is None or offset + length > len(self._map):
+            self._file.flush()
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset:offset + length].decode("utf-8", "surrogatepass")
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.size = 0
+
+
+class Spilled(Mapping):
+    # A text payload in a SpillStore; as a part it reads as {"text": ...}
+    __slots__ = ("store", "offset", "length")
+
+    def __init__(self, store, offset, length):
+        self.store = store
+        self.offset = offset
+        self.length = length
+
+    @property
+    def nbytes(self):
+        return self.length
+
+    def __str__(self):
+        return self.store.get(self.offset, self.length)
+
+    def __getitem__(self, key):
+        if key != "text":
+            raise KeyError(key)
+        return str(self)
+
+    def __iter__(self):
+        return iter(("text",))
+
+    def __len__(self):
+        return 1
+
+
+def text_of(value):
+    return value if isinstance(value, str) else str(value)
+
+
+def _spill(store, text):
+    if isinstance(text, str) and len(text) >= HISTORY_SPILL_MIN_BYTES:
+        return store.put(text), len(text)
+    return text, 0
+
+
+class ToolCall(Mapping):
+    # A function call part: {"function_call": {"name", "args"}}
+    __slots__ = ("name", "_args")
+
+    def __init__(self, name, args):
+        self.name = sys.intern(name)
+        self._args = args
+
+    @property
+    def args(self):
+        return json.loads(str(self._args)) if isinstance(self._args, Spilled) else self._args
+
+    def spill(self, store):
+        if isinstance(self._args, Spilled):
+            return 0
+        encoded = json.dumps(self._args, ensure_ascii=False)
+        if len(encoded) < HISTORY_SPILL_MIN_BYTES:
+            return 0
+        self._args = store.put(encoded)
+        return len(encoded)
+
+    def __getitem__(self, key):
+        if key != "function_call":
+            raise KeyError(key)
+        return {"name": self.name, "args": self.args}
+
+    def __iter__(self):
+        return iter(("function_call",))
+
+    def __len__(self):
+        return 1
+
+
+class ToolResult(Mapping):
+    # A function response part: {"function_response": {"name", "response": {"result": {"content", "is_error"}}}}
+    __slots__ = ("name", "_content", "is_error")
+
+    def __init__(self, name, content, is_error=False):
+        self.name = sys.intern(name)
+        self._content = content
+        self.is_error = bool(is_error)
+
+    @property
+    def content(self):
+        return text_of(self._content)
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
+    def spill(self, store):
+        self._content, spilled = _spill(store, self._content)
+        return spilled
+
+    def __getitem__(self, key):
+        if key != "function_response":
+            raise KeyError(key)
+        return {"name": self.name, "response": {"result": {"content": self.content, "is_error": self.is_error}}}
+
+    def __iter__(self):
+        return iter(("function_response",))
+
+    def __len__(self):
+        return 1
+
+
+class Message(Mapping):
+    # {"role", "parts"}: parts is a string or a list of strings, ToolCall, ToolResult, Spilled or uploaded files
+    __slots__ = ("role", "_parts", "turn")
+
+    def __init__(self, role, parts, turn=0):
+        self.role = sys.intern(role)
+        self._parts = parts
+        self.turn = turn
+
+    @property
+    def parts(self):
+        return text_of(self._parts) if isinstance(self._parts, Spilled) else self._parts
+
+    @parts.setter
+    def parts(self, value):
+        self._parts = value
+
+    def spill(self, store):
+        # Move the large payloads to store; returns the bytes moved
+        if not isinstance(self._parts, list):
+            self._parts, spilled = _spill(store, self._parts)
+            return spilled
+        spilled = 0
+        for index, part in enumerate(self._parts):
+            if isinstance(part, (ToolCall, ToolResult)):
+                spilled += part.spill(store)
+            elif isinstance(part, str):
+                self._parts[index], moved = _spill(store, part)
+                spilled += moved
+        return spilled
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "parts":
+            return self.parts
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(("role", "parts"))
+
+    def __len__(self):
+        return 2
+
+
+class History(list):
+    # A conversation's Message records, passed to the model as they are. Once a turn is
+    # HISTORY_SPILL_AFTER_TURNS old its large payloads move to a SpillStore
+    __slots__ = ("_store", "_spilled", "spilled_bytes")
+
+    def __init__(self, messages=()):
+        super().__init__(messages)
+        self._store = None
+        self._spilled = 0  # messages before this index have been through spill()
+        self.spilled_bytes = 0
+
+    def add(self, role, parts, turn=0):
+        message = Message(role, parts, turn)
+        self.append(message)
+        return message
+
+    def rollback(self, length):
+        # Drop the messages after the first length, e.g. those of a turn that failed
+        del self[length:]
+        self._spilled = min(self._spilled, length)
+
+    def spill(self, turn):
+        if HISTORY_SPILL_AFTER_TURNS <= 0:
+            return 0
+        moved = 0
+        while self._spilled < len(self) and self[self._spilled].turn <= turn - HISTORY_SPILL_AFTER_TURNS:
+            if self._store is None:
+                self._store = SpillStore()
+            moved += self[self._spilled].spill(self._store)
+            self._spilled += 1
+        self.spilled_bytes += moved
+        return moved
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
@@ -0,0 +1,148 @@
+import dataclasses
+import hashlib
+import json
+import os
+from collections.abc import Mapping
+
+from config import MODEL_CACHE_DIR, MODEL_CACHE_MAX_BYTES
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def normalize(obj):
+    # Reduce request pieces (dicts, proto messages, uploaded files) to plain JSON values
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    if isinstance(obj, dict):
+        return {str(key): normalize(value) for key, value in sorted(obj.items(), key=lambda item: str(item[0]))}
+    if isinstance(obj, (list, tuple)):
+        return [normalize(item) for item in obj]
+    if hasattr(type(obj), "pb") and hasattr(type(obj), "to_dict"):
+        return normalize(type(obj).to_dict(obj))
+    if dataclasses.is_dataclass(obj):
+        return normalize(dataclasses.asdict(obj))
+    if hasattr(obj, "uri"):
+        return {"file_uri": obj.uri, "mime_type": getattr(obj, "mime_type", None)}
+    if hasattr(obj, "items"):
+        return normalize(dict(obj.items()))
+    return str(obj)
+
+
+def normalize_contents(contents):
+    if not isinstance(contents, (list, tuple)):
+        contents = [{"role": "user", "parts": contents}]
+    normalized = []
+    for message in contents:
+        if isinstance(message, Mapping):
+            parts = message.get("parts", message.get("content"))
+            if not isinstance(parts, (list, tuple)):
+                parts = [parts]
+            normalized.append({
+                "role": message.get("role", "user"),
+                "parts": [{"text": part} if isinstance(part, str) else normalize(part) for part in parts]
+            })
+        else:
+            normalized.append(normalize(message))
+    return normalized
+
+
+def request_key(model, contents, tools=None, tool_config=None):
+    request = {
+        "model": model.model_name,
+        "system_instruction": normalize(getattr(model, "_system_instruction", None)),
+        "generation_config": normalize(getattr(model, "_generation_config", None)),
+        "contents": normalize_contents(contents),
+        "tools": normalize(tools),
+        "tool_config": normalize(tool_config),
+    }
+    encoded = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+# Bytes in the cache as of the last scan plus what this process has stored since; None until the first scan
+_cache_bytes = None
+
+
+def _entry_path(key):
+    return os.path.join(MODEL_CACHE_DIR, key[:2], f"{key}.json")
+
+
+def load(key):
+    path = _entry_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # Touch the entry so eviction treats it as recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    from google.generativeai import protos
+    from google.generativeai.types.generation_types import GenerateContentResponse
+    return GenerateContentResponse.from_response(protos.GenerateContentResponse(entry["response"]))
+
+
+def store(key, model_name, response):
+    global _cache_bytes
+    path = _entry_path(key)
+    entry = {"model": model_name, "response": response.to_dict()}
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        replaced = os.path.getsize(path)
+    except OSError:
+        replaced = 0
+    # The cache is best effort: a full or read-only disk costs the entry, not the turn that produced it
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+    # The directory is only scanned once per process, and again when the running total goes over the limit
+    if _cache_bytes is not None:
+        _cache_bytes += size - replaced
+    if _cache_bytes is None or _cache_bytes > MODEL_CACHE_MAX_BYTES:
+        evict(MODEL_CACHE_MAX_BYTES)
+
+
+def evict(max_bytes):
+    # Drop least recently used entries until the cache fits in max_bytes
+    global _cache_bytes
+    entries = []
+    total = 0
+    if not os.path.isdir(MODEL_CACHE_DIR):
+        return 0
+    for shard in os.scandir(MODEL_CACHE_DIR):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+    removed = 0
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    _cache_bytes = total
+    return removed
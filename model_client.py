@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    MODEL_CACHE_MODE, MODEL_MAX_CONCURRENT_REQUESTS, MODEL_REQUESTS_PER_MINUTE, MODEL_DEADLINES,
+    MODEL_HEDGING, MODEL_HEDGE_BUDGET, MODEL_HEDGE_PERCENTILE, MODEL_HEDGE_MIN_SAMPLES, MODEL_LATENCY_WINDOW,
+)
+import model_cache
+from tracing import span, payload_size
+
+# The SDK call blocks, so it runs here while the event loop keeps serving other sessions
+_executor = ThreadPoolExecutor(max_workers=MODEL_MAX_CONCURRENT_REQUESTS, thread_name_prefix="model")
+
+
+class RateLimiter:
+    # Spaces requests evenly so concurrent sessions share one requests-per-minute budget
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next_slot = 0.0
+
+    async def acquire(self):
+        if not self.interval:
+            return 0.0
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        return slot - now
+
+
+rate_limiter = RateLimiter(MODEL_REQUESTS_PER_MINUTE)
+
+
+class LatencyTracker:
+    # Recent call latencies by model, role and prompt size, and how hedging has gone
+    def __init__(self):
+        self._samples = {}  # (model, role, size bucket or None) -> deque of seconds
+        self.calls = 0
+        self.hedges = {}  # (model, role) -> [hedged, won by the hedge]
+        self.timeouts = {}  # (model, role) -> calls past the deadline
+
+    @staticmethod
+    def _keys(model_name, role, prompt_bytes):
+        # Buckets grow by powers of 4; the role-wide entry covers buckets without enough samples yet
+        return (model_name, role, prompt_bytes.bit_length() // 2), (model_name, role, None)
+
+    def record(self, model_name, role, prompt_bytes, latency):
+        for key in self._keys(model_name, role, prompt_bytes):
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=MODEL_LATENCY_WINDOW)
+            samples.append(latency)
+
+    def hedge_after(self, model_name, role, prompt_bytes):
+        # Seconds after which a call is slower than usual, or None without enough history
+        for key in self._keys(model_name, role, prompt_bytes):
+            samples = self._samples.get(key)
+            if samples is not None and len(samples) >= MODEL_HEDGE_MIN_SAMPLES:
+                ordered = sorted(samples)
+                return ordered[min(len(ordered) - 1, len(ordered) * MODEL_HEDGE_PERCENTILE // 100)]
+        return None
+
+    def take_hedge(self, model_name, role):
+        # Hedges are capped at MODEL_HEDGE_BUDGET of all calls so a slow backend doesn't get twice the load
+        hedged = sum(counts[0] for counts in self.hedges.values())
+        if hedged + 1 > MODEL_HEDGE_BUDGET * self.calls:
+            return False
+        self.hedges.setdefault((model_name, role), [0, 0])[0] += 1
+        return True
+
+
+latency = LatencyTracker()
+
+
+def _consume(future):
+    # The losing attempt's result or error is never looked at
+    if not future.cancelled():
+        future.exception()
+
+
+async def _race(loop, call, model_name, role, prompt_bytes, s):
+    # The first attempt, plus a duplicate if it runs past the usual p90; the first good answer wins
+    attempts = []
+
+    def attempt():
+        start = time.perf_counter()
+        future = loop.run_in_executor(_executor, call)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception() or latency.record(model_name, role, prompt_bytes, time.perf_counter() - start))
+        attempts.append(future)
+        return future
+
+    try:
+        first = attempt()
+        hedge_after = latency.hedge_after(model_name, role, prompt_bytes) if MODEL_HEDGING and role else None
+        if hedge_after is None:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=hedge_after)
+        if done or not latency.take_hedge(model_name, role):
+            return await first
+
+        s.set(hedged_after=hedge_after)
+        await rate_limiter.acquire()
+        second = attempt()
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        latency.hedges[(model_name, role)][1] += 1
+                    s.set(hedge_won=future is second)
+                    return future.result()
+        return first.result()
+    finally:
+        # Attempts that lost, or outlived the deadline, finish on their own; nobody looks at their result
+        for future in attempts:
+            if not future.done():
+                future.add_done_callback(_consume)
+
+
+async def generate_content(model, contents, role=None, **kwargs):
+    # Every model request goes through here so it can be traced, rate limited, recorded or replayed,
+    # held to its role's deadline and hedged
+    from google.api_core.exceptions import DeadlineExceeded
+
+    prompt_bytes = payload_size(contents)
+    with span("model.generate_content", model=model.model_name, role=role, cache_mode=MODEL_CACHE_MODE, bytes_in=prompt_bytes) as s:
+        loop = asyncio.get_running_loop()
+        key = None
+        response = None
+        if MODEL_CACHE_MODE in ("record", "replay"):
+            key = model_cache.request_key(model, contents, kwargs.get("tools"), kwargs.get("tool_config"))
+            response = await loop.run_in_executor(_executor, model_cache.load, key)
+            s.set(cache_hit=response is not None)
+            if response is None and MODEL_CACHE_MODE == "replay":
+                raise model_cache.CacheMiss(f"No recorded response for {model.model_name} request {key[:12]}")
+
+        if response is None:
+            deadline = MODEL_DEADLINES.get(role)
+            if deadline:
+                # The SDK gives up on its own too, so an abandoned attempt doesn't hold a thread for long
+                kwargs["request_options"] = {"timeout": deadline}
+            call = functools.partial(model.generate_content, contents=contents, **kwargs)
+            latency.calls += 1
+            # Only requests that reach the API count against the rate limit
+            s.set(rate_limit_wait=await rate_limiter.acquire())
+            try:
+                response = await asyncio.wait_for(_race(loop, call, model.model_name, role, prompt_bytes, s), deadline)
+            except asyncio.TimeoutError:
+                counts = latency.timeouts
+                counts[(model.model_name, role)] = counts.get((model.model_name, role), 0) + 1
+                s.set(timed_out=True)
+                raise DeadlineExceeded(f"{model.model_name} did not answer within {deadline:g} seconds")
+            if key is not None:
+                await loop.run_in_executor(_executor, model_cache.store, key, model.model_name, response)
+
+        usage = response.usage_metadata
+        s.set(
+            input_tokens=usage.prompt_token_count,
+            output_tokens=usage.candidates_token_count,
+            bytes_out=payload_size(response.candidates[0].content) if response.candidates else 0,
+        )
+        return response
@@ -0,0 +1,121 @@
+import time
+
+from config import MODEL_ROUTING, MODEL_TIERS, MODEL_ROUTES, MODEL_FIXED, ROUTER_ESCALATION_RATE, ROUTER_MIN_SAMPLES, ROUTER_EWMA_WEIGHT, ROUTER_PROBE_INTERVAL
+from model_client import generate_content
+from tracing import span, payload_size
+
+
+class TierStats:
+    __slots__ = ("calls", "failures", "errors", "latency", "recent_failures", "input_tokens", "output_tokens")
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0  # answers that failed validation
+        self.errors = 0  # requests that raised
+        self.latency = None  # EWMA, seconds
+        self.recent_failures = 0.0  # EWMA of validation failures, so a tier can earn its way back
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    @property
+    def failure_rate(self):
+        return self.failures / self.calls if self.calls else 0.0
+
+
+class ModelRouter:
+    # Picks a tier per call: the role's usual tier, pro for prompts too big for flash or after flash keeps
+    # failing validation, flash when pro keeps missing the role's latency SLO
+    def __init__(self):
+        self.stats = {}  # (role, tier) -> TierStats
+        self._overrides = {}  # role -> calls routed away from the usual tier by the stats
+
+    def _stats(self, role, tier):
+        stats = self.stats.get((role, tier))
+        if stats is None:
+            stats = self.stats[(role, tier)] = TierStats()
+        return stats
+
+    def _trusted(self, role, tier):
+        stats = self.stats.get((role, tier))
+        return stats is None or stats.calls < ROUTER_MIN_SAMPLES or stats.recent_failures < ROUTER_ESCALATION_RATE
+
+    def _probe(self, role):
+        # Every ROUTER_PROBE_INTERVAL-th overridden call goes to the usual tier anyway, so stats that put a
+        # tier out of favour get refreshed instead of sticking forever
+        self._overrides[role] = self._overrides.get(role, 0) + 1
+        return self._overrides[role] % ROUTER_PROBE_INTERVAL == 0
+
+    def choose(self, role, prompt_bytes, escalate=False):
+        # Returns (tier, reason)
+        tiers = list(MODEL_TIERS)
+        tier, flash_max_bytes, slo = MODEL_ROUTES[role]
+        reason = "default"
+        if tier == tiers[0] and not self._trusted(role, tier) and not self._probe(role):
+            return (tiers[-1], "failure rate")
+        if flash_max_bytes is not None and prompt_bytes > flash_max_bytes and tier == tiers[0]:
+            tier, reason = tiers[-1], "prompt size"
+        if tier == tiers[-1] and slo is not None and not escalate:
+            # Pro has been slower than the role can wait; flash answers in time if it answers well enough
+            stats = self.stats.get((role, tier))
+            if (stats is not None and stats.latency is not None and stats.latency > slo and self._trusted(role, tiers[0])
+                    and not self._probe(role)):
+                tier, reason = tiers[0], "latency SLO"
+        if escalate and tier != tiers[-1]:
+            tier, reason = tiers[tiers.index(tier) + 1], "escalated"
+        return tier, reason
+
+    def record(self, role, tier, latency, response=None, failed=False, error=False):
+        stats = self._stats(role, tier)
+        stats.calls += 1
+        stats.failures += failed
+        stats.errors += error
+        stats.latency = latency if stats.latency is None else stats.latency + ROUTER_EWMA_WEIGHT * (latency - stats.latency)
+        stats.recent_failures += ROUTER_EWMA_WEIGHT * (failed - stats.recent_failures)
+        if response is not None:
+            stats.input_tokens += response.usage_metadata.prompt_token_count
+            stats.output_tokens += response.usage_metadata.candidates_token_count
+
+
+router = ModelRouter()
+
+
+def require_text(response):
+    # Validation for roles whose answer is prose
+    try:
+        return None if response.text.strip() else "empty response"
+    except ValueError:
+        return "no text in response"
+
+
+def require_content(response):
+    # Validation for roles that may answer with text or function calls
+    if response.candidates and response.candidates[0].content.parts:
+        return None
+    return "empty response"
+
+
+async def generate(role, build, contents, validate=None, escalate=False, prompt_bytes=None, **kwargs):
+    # build(model_name) returns the GenerativeModel to call; validate(response) returns None or what's wrong.
+    # An answer that fails validation is retried once per tier up, and the last answer is returned either way
+    if MODEL_ROUTING == "fixed":
+        return await generate_content(build(MODEL_FIXED[role]), contents, role=role, **kwargs)
+    if prompt_bytes is None:
+        prompt_bytes = payload_size(contents)
+    tier, reason = router.choose(role, prompt_bytes, escalate)
+    tiers = list(MODEL_TIERS)
+    with span("model.route", role=role, prompt_bytes=prompt_bytes) as s:
+        while True:
+            s.set(tier=tier, reason=reason)
+            start = time.perf_counter()
+            try:
+                response = await generate_content(build(MODEL_TIERS[tier]), contents, role=role, **kwargs)
+            except Exception:
+                router.record(role, tier, time.perf_counter() - start, error=True)
+                raise
+            problem = validate(response) if validate else None
+            router.record(role, tier, time.perf_counter() - start, response, failed=problem is not None)
+            if problem is None or tier == tiers[-1]:
+                if problem is not None:
+                    s.set(validation=problem)
+                return response
+            tier, reason = tiers[tiers.index(tier) + 1], f"escalated: {problem}"
@@ -0,0 +1,293 @@
+import fnmatch
+import os
+import re
+
+from config import (
+    PROJECT_TREE_MAX_ENTRIES, PROJECT_TREE_LINE_COUNT_MAX_BYTES,
+    MODEL_CACHE_DIR, SESSIONS_DIR, CODE_INDEX_DIR, IMAGE_CACHE_DIR, TRACE_DIR, BATCH_WORKSPACES_DIR, SERVER_WORKSPACES_DIR,
+)
+
+# Never worth showing the model, whatever .gitignore says
+ALWAYS_IGNORED = {".git", "node_modules", "code_execution_env", "__pycache__", ".venv", ".mypy_cache", ".pytest_cache", ".code_index"}
+
+# This program's own output directories, by absolute path so a project folder that happens to share a name still shows
+TOOL_DIRS = {os.path.abspath(path) for path in (MODEL_CACHE_DIR, SESSIONS_DIR, CODE_INDEX_DIR, IMAGE_CACHE_DIR, TRACE_DIR, BATCH_WORKSPACES_DIR, SERVER_WORKSPACES_DIR) if path}
+
+# Directory listings by path, reused until the directory's mtime changes
+_dir_cache = {}  # path -> (mtime_ns, [(name, is_dir)])
+_ignore_cache = {}  # .gitignore path -> (mtime_ns, rules)
+_line_cache = {}  # file path -> (mtime_ns, size, lines)
+_visible_cache = {}  # path -> (listing and .gitignore signature, entries left after ignore rules)
+
+
+def _scan(path):
+    mtime = os.stat(path).st_mtime_ns
+    cached = _dir_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                entries.append((entry.name, entry.is_dir()))
+            except OSError:
+                continue
+    # Directories first, then files, each alphabetically
+    entries.sort(key=lambda item: (not item[1], item[0].lower()))
+    _dir_cache[path] = (mtime, entries)
+    return entries
+
+
+def _translate(pattern):
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(pattern[i])
+                i += 1
+            else:
+                regex += pattern[i:end + 1]
+                i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+def _parse_gitignore(text):
+    rules = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        # A slash anywhere but the end anchors the pattern to the .gitignore's directory
+        anchored = "/" in line
+        try:
+            regex = re.compile(f"^{_translate(line.lstrip('/'))}$")
+        except re.error:
+            continue
+        rules.append((regex, negate, dir_only, anchored))
+    return rules
+
+
+def _load_rules(directory):
+    # Returns (mtime, rules) for the directory's .gitignore, or None
+    path = os.path.join(directory, ".gitignore")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _ignore_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            cached = (mtime, _parse_gitignore(f.read()))
+        _ignore_cache[path] = cached
+    return cached if cached[1] else None
+
+
+def _ignored(rule_sets, prefixes, name, is_dir):
+    if name in ALWAYS_IGNORED:
+        return True
+    ignored = False
+    # Later and deeper rules win, as in git
+    for (_, _, rules), prefix in zip(rule_sets, prefixes):
+        relative = f"{prefix}/{name}" if prefix else name
+        for regex, negate, dir_only, anchored in rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative if anchored else name):
+                ignored = not negate
+    return ignored
+
+
+def _visible(directory, rule_sets):
+    # Entries that survive the ignore rules, cached until the directory or any applicable .gitignore changes
+    entries = _scan(directory)
+    signature = (_dir_cache[directory][0], tuple((base, mtime) for base, mtime, _ in rule_sets))
+    cached = _visible_cache.get(directory)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    prefixes = []
+    for base, _, _ in rule_sets:
+        prefix = os.path.relpath(directory, base).replace(os.sep, "/")
+        prefixes.append("" if prefix == "." else prefix)
+    visible = [(name, is_dir) for name, is_dir in entries
+               if not _ignored(rule_sets, prefixes, name, is_dir) and not (is_dir and os.path.join(directory, name) in TOOL_DIRS)]
+    _visible_cache[directory] = (signature, visible)
+    return visible
+
+
+def _line_count(path, size, mtime):
+    cached = _line_cache.get(path)
+    if cached is not None and cached[:2] == (mtime, size):
+        return cached[2]
+    lines = None
+    if size <= PROJECT_TREE_LINE_COUNT_MAX_BYTES:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if b"\0" not in data[:8192]:
+                lines = data.count(b"\n") + (1 if data and not data.endswith(b"\n") else 0)
+        except OSError:
+            pass
+    _line_cache[path] = (mtime, size, lines)
+    return lines
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:,.0f} {unit}" if unit == "B" else f"{size:,.1f} {unit}"
+        size /= 1024
+
+
+def _describe_file(path, name, indent):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return f"{indent}{name}"
+    lines = _line_count(path, st.st_size, st.st_mtime_ns)
+    details = format_size(st.st_size) if lines is None else f"{format_size(st.st_size)}, {lines:,} line{'' if lines == 1 else 's'}"
+    return f"{indent}{name} ({details})"
+
+
+def _ancestor_rules(root, path):
+    # .gitignore files between the project root and the listed directory still apply to it
+    rule_sets = []
+    if os.path.commonpath([root, path]) != root:
+        return rule_sets
+    directory = root
+    for part in [""] + os.path.relpath(path, root).split(os.sep):
+        if part and part != ".":
+            directory = os.path.join(directory, part)
+        if directory != path:
+            loaded = _load_rules(directory)
+            if loaded:
+                rule_sets.append((directory, *loaded))
+    return rule_sets
+
+
+def walk(root):
+    # (directory, visible subdirectory names, visible file names) for every directory project_tree would show
+    stack = [(os.path.abspath(root), [])]
+    while stack:
+        directory, rule_sets = stack.pop()
+        loaded = _load_rules(directory)
+        if loaded:
+            rule_sets = rule_sets + [(directory, *loaded)]
+        try:
+            entries = _visible(directory, rule_sets)
+        except OSError:
+            continue
+        dirs = [name for name, is_dir in entries if is_dir]
+        yield directory, dirs, [name for name, is_dir in entries if not is_dir]
+        for name in dirs:
+            stack.append((os.path.join(directory, name), rule_sets))
+
+
+def iter_files(root):
+    # Every file project_tree would show under root, with no depth or output limit
+    for directory, _, files in walk(root):
+        for name in files:
+            yield os.path.join(directory, name)
+
+
+def is_ignored(root, path, is_dir=False):
+    # Whether the ignore rules hide path, or any directory between root and it. Works for deleted paths too
+    if any(path.startswith(tool_dir + os.sep) for tool_dir in TOOL_DIRS if not root.startswith(tool_dir + os.sep)):
+        return True
+    if path == root:
+        return False
+    if os.path.commonpath([root, path]) != root:
+        return _ignored([], [], os.path.basename(path), is_dir)
+    parts = os.path.relpath(path, root).split(os.sep)
+    rule_sets = []
+    directory = root
+    for depth, name in enumerate(parts):
+        loaded = _load_rules(directory)
+        if loaded:
+            rule_sets.append((directory, *loaded))
+        prefixes = []
+        for base, _, _ in rule_sets:
+            prefix = os.path.relpath(directory, base).replace(os.sep, "/")
+            prefixes.append("" if prefix == "." else prefix)
+        if _ignored(rule_sets, prefixes, name, is_dir or depth < len(parts) - 1):
+            return True
+        directory = os.path.join(directory, name)
+    return False
+
+
+class _Truncated(Exception):
+    pass
+
+
+def render_tree(path, depth=3, glob=None, max_entries=PROJECT_TREE_MAX_ENTRIES, project_root=None):
+    path = os.path.abspath(path)
+    project_root = os.path.abspath(project_root or path)
+    if not os.path.isdir(path):
+        raise NotADirectoryError(f"Not a directory: {path}")
+    glob_regex = re.compile(fnmatch.translate(glob)) if glob else None
+
+    lines = []
+
+    def add(line):
+        # Stop walking as soon as the output is full; the rest of the tree would be thrown away anyway
+        if len(lines) >= max_entries:
+            raise _Truncated()
+        lines.append(line)
+
+    def walk(directory, relative_dir, level, rule_sets, indent, headers):
+        # With a glob, directory headers wait in `headers` until a match below them is listed
+        loaded = _load_rules(directory)
+        if loaded:
+            rule_sets = rule_sets + [(directory, *loaded)]
+        for name, is_dir in _visible(directory, rule_sets):
+            full_path = os.path.join(directory, name)
+            relative = f"{relative_dir}{name}"
+            if is_dir:
+                if level >= depth:
+                    if not glob:
+                        add(f"{indent}{name}/ ...")
+                    continue
+                header = [f"{indent}{name}/", False]
+                if not glob:
+                    add(header[0])
+                walk(full_path, f"{relative}/", level + 1, rule_sets, indent + "  ", headers + [header] if glob else headers)
+            elif not glob_regex or glob_regex.match(relative) or glob_regex.match(name):
+                for header in headers:
+                    if not header[1]:
+                        add(header[0])
+                        header[1] = True
+                add(_describe_file(full_path, name, indent))
+
+    truncated = False
+    try:
+        walk(path, "", 1, _ancestor_rules(project_root, path), "  ", [])
+    except _Truncated:
+        truncated = True
+    header = os.path.relpath(path, project_root) if path != project_root else "."
+    output = [f"{header}/"] + lines
+    if truncated:
+        output.append(f"[Output truncated at {max_entries} entries; narrow the path or glob, or lower the depth]")
+    elif not lines:
+        output.append("  (no matching files)" if glob else "  (empty)")
+    return "\n".join(output)
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import secrets
+from contextlib import nullcontext
+
+from aiohttp import web, WSMsgType
+
+from config import *
+from cancellation import cancel_scope
+from journal import new_session_id
+from session import Session
+
+
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+def error(status, message, **headers):
+    return web.json_response({"error": message}, status=status, headers=headers)
+
+
+async def read_json(request):
+    # The request's JSON object, {} without a body
+    if not request.can_read_body:
+        return {}
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text=json.dumps({"error": "Invalid JSON"}), content_type="application/json")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text=json.dumps({"error": "Expected a JSON object"}), content_type="application/json")
+    return body
+
+
+def valid_automode(automode):
+    # Absent, or a positive number of iterations
+    return automode is None or (isinstance(automode, int) and not isinstance(automode, bool) and automode > 0)
+
+
+class SessionServer:
+    # One warm process hosting many sessions; every turn runs as a task on the shared event loop
+    def __init__(self, max_sessions=SERVER_MAX_SESSIONS, max_in_flight=SERVER_MAX_IN_FLIGHT, workspaces=SERVER_WORKSPACES_DIR,
+                 token=SERVER_TOKEN, hosts=(SERVER_HOST, *SERVER_ALLOWED_HOSTS), origins=SERVER_ALLOWED_ORIGINS):
+        self.max_sessions = max_sessions
+        self.max_in_flight = max_in_flight
+        self.workspaces = workspaces
+        # Turns run commands and code, so every caller needs the token, and a page in a browser can't get in
+        # through a cross-origin request or a rebound DNS name
+        self.token = token or secrets.token_urlsafe(32)
+        self.hosts = LOCAL_HOSTS | {host for host in hosts if host not in ("0.0.0.0", "::", "")}
+        self.origins = set(origins)
+        self.sessions = {}
+        self.turns = {}  # session id -> running turn task
+
+    def routes(self):
+        return [
+            web.get("/health", self.health),
+            web.get("/sessions", self.list_sessions),
+            web.post("/sessions", self.create_session),
+            web.delete("/sessions/{session_id}", self.close_session),
+            web.post("/sessions/{session_id}/messages", self.post_message),
+            web.post("/sessions/{session_id}/cancel", self.cancel),
+            web.get("/sessions/{session_id}/events", self.events),
+        ]
+
+    @web.middleware
+    async def guard(self, request, handler):
+        if request.url.host not in self.hosts:
+            return error(403, "Host not allowed")
+        origin = request.headers.get("Origin")
+        if origin is not None and origin not in self.origins:
+            return error(403, "Origin not allowed")
+        if request.path != "/health":
+            scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+            if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), self.token.encode()):
+                return error(401, "Missing or invalid bearer token", **{"WWW-Authenticate": "Bearer"})
+        if request.method == "POST" and request.can_read_body and request.content_type != "application/json":
+            return error(415, "Expected application/json")
+        return await handler(request)
+
+    def describe(self, session):
+        return {
+            "session_id": session.session_id,
+            "cwd": session.cwd,
+            "busy": session.session_id in self.turns,
+            "messages": len(session.conversation_history),
+            "tokens": {name: dict(tokens) for name, tokens in session.token_counters()},
+        }
+
+    def get_session(self, request):
+        session = self.sessions.get(request.match_info["session_id"])
+        if session is None:
+            raise web.HTTPNotFound(text=json.dumps({"error": "Unknown session"}), content_type="application/json")
+        return session
+
+    async def health(self, request):
+        return web.json_response({"sessions": len(self.sessions), "in_flight": len(self.turns), "max_in_flight": self.max_in_flight})
+
+    async def list_sessions(self, request):
+        return web.json_response([self.describe(session) for session in self.sessions.values()])
+
+    async def create_session(self, request):
+        if len(self.sessions) >= self.max_sessions:
+            return error(503, f"Session limit of {self.max_sessions} reached", **{"Retry-After": "5"})
+        body = await read_json(request)
+        session_id = new_session_id()
+        cwd = body.get("cwd")
+        if not cwd:
+            # Without a project directory each session gets a scratch workspace of its own
+            cwd = os.path.join(self.workspaces, session_id)
+            os.makedirs(cwd, exist_ok=True)
+        session = Session(cwd=cwd, session_id=session_id)
+        self.sessions[session.session_id] = session
+        return web.json_response(self.describe(session), status=201)
+
+    async def close_session(self, request):
+        session = self.get_session(request)
+        await self.cancel_turn(session)
+        # A concurrent DELETE may have closed it while the turn was cancelled
+        if self.sessions.pop(session.session_id, None) is session:
+            session.close()
+        return web.json_response({"closed": session.session_id})
+
+    def start_turn(self, session, message, automode=None):
+        # Returns an error response, or None once the turn is running
+        if session.session_id in self.turns:
+            return error(409, "A turn is already running in this session")
+        if len(self.turns) >= self.max_in_flight:
+            return error(503, f"{self.max_in_flight} turns already in flight", **{"Retry-After": "1"})
+        task = asyncio.create_task(self.run_turn(session, message, automode))
+        # Failures are reported on the event stream; this keeps asyncio from logging them again
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        self.turns[session.session_id] = task
+        return None
+
+    async def run_turn(self, session, message, automode):
+        from gemini import chat_with_gemini, run_automode
+
+        try:
+            with cancel_scope(session):
+                await session.emit("turn_started", message=message, automode=automode)
+                if automode:
+                    iterations = await run_automode(session, message, automode)
+                    response = session.conversation_history[-1]["parts"] if session.conversation_history else ""
+                    await session.emit("turn_complete", response=response, iterations=iterations)
+                else:
+                    response, exit_continuation = await chat_with_gemini(session, message)
+                    await session.emit("turn_complete", response=response, exit_continuation=exit_continuation)
+            return response
+        except asyncio.CancelledError:
+            session.automode = False
+            await session.emit("turn_cancelled")
+            raise
+        except Exception as e:
+            await session.emit("turn_error", error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self.turns.pop(session.session_id, None)
+
+    async def cancel_turn(self, session):
+        task = self.turns.get(session.session_id)
+        if task is None:
+            return False
+        if session.cancel_token is not None:
+            session.cancel_token.cancel()
+        else:
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    async def post_message(self, request):
+        session = self.get_session(request)
+        body = await read_json(request)
+        if not isinstance(body.get("message"), str):
+            return error(400, "Expected a JSON body with a 'message' string")
+        if not valid_automode(body.get("automode")):
+            return error(400, "'automode' must be a positive number of iterations")
+        failure = self.start_turn(session, body["message"], body.get("automode"))
+        if failure is not None:
+            return failure
+        if not body.get("wait"):
+            return web.json_response({"session_id": session.session_id, "status": "started"}, status=202)
+
+        # Simple clients can block on the whole turn instead of following the event stream
+        try:
+            response = await asyncio.shield(self.turns[session.session_id])
+        except asyncio.CancelledError:
+            return error(409, "Turn was cancelled")
+        except Exception as e:
+            return error(500, f"{type(e).__name__}: {e}")
+        return web.json_response({"session_id": session.session_id, "response": response})
+
+    async def cancel(self, request):
+        session = self.get_session(request)
+        return web.json_response({"cancelled": await self.cancel_turn(session)})
+
+    async def events(self, request):
+        session = self.get_session(request)
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        queue = session.subscribe()
+
+        async def forward():
+            # Sending waits for the socket to drain, which is what pushes back on the session
+            while True:
+                event = await queue.get()
+                await ws.send_str(json.dumps(event, ensure_ascii=False, default=str))
+
+        sender = asyncio.create_task(forward())
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    command = json.loads(message.data)
+                except ValueError:
+                    await ws.send_json({"event": "error", "error": "Expected JSON"})
+                    continue
+                if not isinstance(command, dict):
+                    await ws.send_json({"event": "error", "error": "Expected a JSON object"})
+                elif command.get("cancel"):
+                    await self.cancel_turn(session)
+                elif not valid_automode(command.get("automode")):
+                    await ws.send_json({"event": "error", "error": "'automode' must be a positive number of iterations"})
+                elif isinstance(command.get("message"), str):
+                    failure = self.start_turn(session, command["message"], command.get("automode"))
+                    if failure is not None:
+                        await ws.send_json({"event": "rejected", "status": failure.status, "error": json.loads(failure.text)["error"]})
+        finally:
+            sender.cancel()
+            session.unsubscribe(queue)
+        return ws
+
+    async def shutdown(self, app):
+        for session in list(self.sessions.values()):
+            await self.cancel_turn(session)
+            session.close()
+        self.sessions.clear()
+
+
+def create_app(server=None):
+    server = server or SessionServer()
+    app = web.Application(middlewares=[server.guard])
+    app["server"] = server
+    app.add_routes(server.routes())
+    app.on_shutdown.append(server.shutdown)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="gemini.py serve", description="Serve sessions over HTTP with WebSocket event streams")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--max-sessions", type=int, default=SERVER_MAX_SESSIONS)
+    parser.add_argument("--max-in-flight", type=int, default=SERVER_MAX_IN_FLIGHT, help="Turns running at once; more are refused with 503")
+    parser.add_argument("--workspaces", default=SERVER_WORKSPACES_DIR, help="Scratch directories for sessions created without a cwd")
+    parser.add_argument("--token", default=SERVER_TOKEN, help="Bearer token clients must send (default: generated)")
+    parser.add_argument("--verbose", action="store_true", help="Show every session's chat output")
+    args = parser.parse_args(argv)
+
+    server = SessionServer(args.max_sessions, args.max_in_flight, args.workspaces, token=args.token,
+                           hosts=(args.host, *SERVER_ALLOWED_HOSTS))
+    if not args.token:
+        print(f"Bearer token: {server.token}", flush=True)
+    app = create_app(server)
+    with nullcontext() if args.verbose else silenced_console():
+        web.run_app(app, host=args.host, port=args.port, keepalive_timeout=SERVER_KEEPALIVE_TIMEOUT)
+    return 0
@@ -0,0 +1,210 @@
+import asyncio
+import os
+
+from config import SESSION_EVENT_QUEUE_SIZE, SESSION_EVENT_TIMEOUT
+from context_compressor import ContextCompressor
+from editor_memory import EditorMemory
+from file_state import FileStateTracker
+from file_reader import read_text
+from file_watcher import get_watcher
+from journal import SessionJournal, pack_text, replay
+from messages import History
+from tool_memo import ToolMemo
+
+
+class Session:
+    # Everything one conversation owns; tools and chat_with_gemini get it passed explicitly
+    def __init__(self, cwd=None, session_id=None, journal=None):
+        self.cwd = os.path.abspath(cwd or os.getcwd())
+
+        # Conversation memory (maintains context for MAINMODEL)
+        self.conversation_history = History()
+
+        # File contents (part of the context for MAINMODEL)
+        self.file_contents = {}
+
+        # Code editor memory (maintains some context for CODEEDITORMODEL between calls)
+        self.code_editor_memory = EditorMemory()
+
+        # Files already present in code editor's context
+        self.code_editor_files = set()
+
+        # The version of each file the model last saw, so later looks can be diffs
+        self.file_state = FileStateTracker()
+
+        # Outlines files the model hasn't looked at for a while, to keep many files within the context window
+        self.context_compressor = ContextCompressor()
+
+        # The running turn's CancelToken, set by cancellation.cancel_scope
+        self.cancel_token = None
+
+        # Processes started by execute_code, by process ID
+        self.running_processes = {}
+        self.process_counter = 0
+
+        # Token tracking
+        self.main_model_tokens = {'input': 0, 'output': 0}
+        self.tool_checker_tokens = {'input': 0, 'output': 0}
+        self.code_editor_tokens = {'input': 0, 'output': 0}
+        self.code_execution_tokens = {'input': 0, 'output': 0}
+
+        self.automode = False
+
+        # User turns so far, and the read-only tool results seen in them
+        self.turn = 0
+        self.tool_memo = ToolMemo()
+        # A remembered result whose copy in the history was superseded or outlined can't be pointed back to
+        self.file_state.on_supersede = lambda path: self.tool_memo.discard(self, [path])
+
+        self.journal = journal or SessionJournal(session_id)
+        self._journaled_files = {}
+        self._journaled_tokens = {}
+
+        # Event queues of whoever is watching this session (the server's WebSocket clients)
+        self._subscribers = []
+
+        # Filesystem watch on cwd, started with the first turn
+        self._watch = None
+
+    @property
+    def session_id(self):
+        return self.journal.session_id
+
+    def resolve(self, path):
+        # Tool paths are relative to the session's working directory
+        return os.path.join(self.cwd, os.path.expanduser(path))
+
+    def subscribe(self):
+        queue = asyncio.Queue(SESSION_EVENT_QUEUE_SIZE)
+        self._subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        if queue in self._subscribers:
+            self._subscribers.remove(queue)
+
+    async def emit(self, event, **data):
+        # A full queue makes the turn wait, so a slow client slows its own session instead of piling up events
+        for queue in list(self._subscribers):
+            try:
+                await asyncio.wait_for(queue.put({"event": event, **data}), SESSION_EVENT_TIMEOUT)
+            except asyncio.TimeoutError:
+                # A client that stopped reading altogether is dropped rather than stalling the session
+                self.unsubscribe(queue)
+
+    def external_changes(self):
+        # Bring file_contents in line with disk after edits made outside the tools (an IDE, a formatter)
+        # and describe them for the next turn; None when nothing the model should know about changed
+        first = self._watch is None
+        if first:
+            watcher = get_watcher()
+            if watcher is None:
+                return None
+            self._watch = watcher.subscribe(self.cwd)
+        in_context = {os.path.normpath(self.resolve(path)): path for path in self.file_contents}
+        self._watch.set_hot(in_context)
+        changed, rescan = self._watch.drain()
+        # A resumed session's files may have changed while nothing was watching
+        if rescan or first:
+            changed.update(in_context)
+
+        updated, removed, others, changes = [], [], [], []
+        for full_path in sorted(changed):
+            path = in_context.get(full_path)
+            if path is None:
+                others.append(os.path.relpath(full_path, self.cwd))
+                continue
+            if not os.path.exists(full_path):
+                del self.file_contents[path]
+                self.code_editor_files.discard(path)
+                self.code_editor_memory.forget(path)
+                self.file_state.forget(path)
+                removed.append(path)
+                continue
+            read = read_text(full_path, budget=None)
+            if read.content is None:
+                continue
+            content = read.content
+            # Our own writes leave disk and file_contents identical
+            if content != self.file_contents[path]:
+                changes.append(self.file_state.show_edit(path, self.file_contents[path], content))
+                self.file_contents[path] = content
+                self.code_editor_files.discard(path)
+                self.code_editor_memory.forget(path)
+                updated.append(path)
+        if not (updated or removed or others):
+            return None
+
+        lines = ["Files changed on disk outside the file tools since the last turn:"]
+        lines += [f"- {path}: modified; the changes follow" for path in updated]
+        lines += [f"- {path}: deleted; removed from your context" for path in removed]
+        if others:
+            shown = ", ".join(others[:10])
+            more = f" and {len(others) - 10} more" if len(others) > 10 else ""
+            lines.append(f"- Not in your context: {shown}{more}")
+        return "\n".join(lines + [change for change in changes if change])
+
+    def token_counters(self):
+        return [("main", self.main_model_tokens),
+                ("tool_checker", self.tool_checker_tokens),
+                ("code_editor", self.code_editor_tokens),
+                ("code_execution", self.code_execution_tokens)]
+
+    def journal_state_changes(self):
+        # Append file_contents changes and token deltas since the last call
+        for path, content in self.file_contents.items():
+            if self._journaled_files.get(path) is not content:
+                self.journal.append("file", path=path, **pack_text(content))
+                self._journaled_files[path] = content
+        for path in [path for path in self._journaled_files if path not in self.file_contents]:
+            self.journal.append("file", path=path, deleted=True)
+            del self._journaled_files[path]
+
+        for name, tokens in self.token_counters():
+            last_input, last_output = self._journaled_tokens.get(name, (0, 0))
+            if tokens['input'] != last_input or tokens['output'] != last_output:
+                self.journal.append("tokens", model=name, input=tokens['input'] - last_input, output=tokens['output'] - last_output)
+                self._journaled_tokens[name] = (tokens['input'], tokens['output'])
+
+    def reset(self):
+        self.conversation_history.close()
+        self.conversation_history = History()
+        for _, tokens in self.token_counters():
+            tokens['input'] = 0
+            tokens['output'] = 0
+        self.file_contents.clear()
+        self.code_editor_memory.clear()
+        self.code_editor_files.clear()
+        self.file_state.clear()
+        self.context_compressor.clear()
+        self.tool_memo.clear()
+        self._journaled_files.clear()
+        self._journaled_tokens.clear()
+        self.journal.append("reset")
+
+    def restore(self, path):
+        # Rebuild state by streaming a journal, then keep appending to it
+        history, files, tokens = replay(path)
+        self.journal.close()
+        self.journal = SessionJournal(os.path.basename(path)[:-len(".jsonl")], path=path)
+
+        self.conversation_history.close()
+        self.conversation_history = history
+        self.file_state.clear()
+        self.file_state.resume(history)
+        self.context_compressor.clear()
+        self.tool_memo.clear()
+        self.file_contents.clear()
+        self.file_contents.update(files)
+        self._journaled_files = dict(self.file_contents)
+        for name, counter in self.token_counters():
+            counter['input'] = tokens.get(name, {}).get('input', 0)
+            counter['output'] = tokens.get(name, {}).get('output', 0)
+            self._journaled_tokens[name] = (counter['input'], counter['output'])
+
+    def close(self):
+        self.conversation_history.close()
+        if self._watch is not None:
+            self._watch.close()
+            self._watch = None
+        self.journal.close()
@@ -0,0 +1,89 @@
+import os
+
+# Tools whose result depends only on their arguments and the files they look at
+READ_ONLY_TOOLS = {"read_file", "read_multiple_files"}
+
+# Tools that change the given path; anything that runs a subprocess may change anything
+PATH_MUTATING_TOOLS = {"create_file", "create_folder", "edit_and_apply", "edit_many"}
+SUBPROCESS_TOOLS = {"execute_code", "run_command", "stop_process"}
+
+
+def tool_paths(tool_name, tool_input):
+    if tool_name in ("read_multiple_files", "edit_many"):
+        return list(tool_input.get("paths", []))
+    return [tool_input["path"]] if "path" in tool_input else []
+
+
+def stamp(path):
+    # mtime and size catch edits made outside the tools too, e.g. by the user's editor
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class ToolMemo:
+    # Remembers read-only tool results per session, so a repeat read can point back at the earlier turn
+    def __init__(self):
+        self._entries = {}  # (tool, resolved paths) -> (stamps, turn)
+
+    def _key(self, session, tool_name, tool_input):
+        paths = tuple(os.path.normpath(session.resolve(path)) for path in tool_paths(tool_name, tool_input))
+        # Line ranges and patterns: a different slice of the same file is a different result
+        options = tuple(sorted((name, repr(value)) for name, value in tool_input.items() if name not in ("path", "paths")))
+        return tool_name, paths, options
+
+    def lookup(self, session, tool_name, tool_input):
+        # Returns the turn an identical result was produced in, or None
+        if tool_name not in READ_ONLY_TOOLS:
+            return None
+        key = self._key(session, tool_name, tool_input)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stamps, turn = entry
+        if stamps != [stamp(path) for path in key[1]]:
+            del self._entries[key]
+            return None
+        return turn
+
+    def remember(self, session, tool_name, tool_input, result):
+        # read_multiple_files reports each file that failed on its own line among the others; a result with any
+        # failure in it is not one to point back at. A file with such a line in it merely goes unremembered
+        if tool_name not in READ_ONLY_TOOLS or any(line.startswith("Error") for line in str(result).splitlines()):
+            return
+        key = self._key(session, tool_name, tool_input)
+        stamps = [stamp(path) for path in key[1]]
+        if None not in stamps:
+            self._entries[key] = (stamps, session.turn)
+
+    def invalidate(self, session, tool_name, tool_input):
+        if tool_name in SUBPROCESS_TOOLS:
+            self._entries.clear()
+            return
+        if tool_name not in PATH_MUTATING_TOOLS:
+            return
+        self.discard(session, tool_paths(tool_name, tool_input))
+
+    def discard(self, session, paths):
+        # Forget results covering any of paths, e.g. once the copy in the history is no longer whole
+        touched = {os.path.normpath(session.resolve(path)) for path in paths}
+        for key in [key for key in self._entries if touched.intersection(key[1])]:
+            del self._entries[key]
+
+    def rollback(self, turn):
+        # Forget results from turn on, once those turns are dropped from the history
+        for key in [key for key, (_, seen) in self._entries.items() if seen >= turn]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+def unchanged_message(tool_name, tool_input, turn):
+    paths = ", ".join(f"'{path}'" for path in tool_paths(tool_name, tool_input))
+    options = ", ".join(f"{name}={value!r}" for name, value in tool_input.items() if name not in ("path", "paths"))
+    if options:
+        paths += f" ({options})"
+    return f"{paths} unchanged since turn {turn}; the contents returned then are still current."
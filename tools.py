@@ -1,4 +1,3 @@
-from google.generativeai.protos import Tool, FunctionDeclaration, Schema, Type, ToolConfig, FunctionCallingConfig
 import os
 import difflib
 import subprocess
@@ -6,14 +5,24 @@ import platform
 import shutil
 import shlex
 import asyncio
+import ast
+import functools
+import time
 from config import *
+import model_router
+from model_router import require_text
+from tracing import span, traced, payload_size
+from tool_memo import unchanged_message
+from project_tree import render_tree, format_size
+from file_reader import read_text, read_files, read_lines, describe_binary, truncation_marker
+from edit_window import relevant_windows, render_windows, split_segments, join_segments
+from cancellation import kill_process_group
+import venv_manager
+import code_index
 import json
 import re
 import sys
 import signal
-import venv
-
-from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn
 
 def highlight_diff(diff_text):
     return Syntax(diff_text, "diff", theme="monokai", line_numbers=True)
@@ -46,23 +55,30 @@ def parse_search_replace_blocks(response_text):
     return json.dumps(blocks)  # Keep returning JSON string
 
 
-async def generate_edit_instructions(file_path, file_content, instructions, project_context, full_file_contents):
-    global code_editor_tokens, code_editor_memory, code_editor_files
+async def generate_edit_instructions(session, file_path, file_content, instructions, project_context, full_file_contents, windows=None, escalate=False):
     try:
-        # Prepare memory context (this is the only part that maintains some context between calls)
-        memory_context = "\n".join([f"Memory {i+1}:\n{mem}" for i, mem in enumerate(code_editor_memory)])
+        # Prepare memory context (this is the only part that maintains some context between calls):
+        # earlier edits to this file and the files it imports or is imported by
+        memory_context = session.code_editor_memory.context(file_path, full_file_contents) or "No earlier edits to this file or the files related to it."
 
         # Prepare full file contents context, excluding the file being edited if it's already in code_editor_files
+        # (or if only part of it is being shown)
         full_file_contents_context = "\n\n".join([
             f"--- {path} ---\n{content}" for path, content in full_file_contents.items()
-            if path != file_path or path not in code_editor_files
+            if path != file_path or (path not in session.code_editor_files and not windows)
         ])
 
+        if windows:
+            file_review = f"""Review the relevant parts of the file. Lines outside them are left out and stay unchanged; SEARCH blocks must only use code shown here:
+        {render_windows(file_content, windows)}"""
+        else:
+            file_review = f"""Review the entire file content to understand the context:
+        {file_content}"""
+
         system_prompt = f"""
         You are an AI coding agent that generates edit instructions for code files. Your task is to analyze the provided code and generate SEARCH/REPLACE blocks for necessary changes. Follow these steps:
 
-        1. Review the entire file content to understand the context:
-        {file_content}
+        1. {file_review}
 
         2. Carefully analyze the specific instructions:
         {instructions}
@@ -102,29 +118,44 @@ async def generate_edit_instructions(file_path, file_content, instructions, proj
         If no changes are needed, return an empty list.
         """
 
-        # Make the API call to CODEEDITORMODEL (context is not maintained except for code_editor_memory)
-        code_edit_model = genai.GenerativeModel(
-            model_name=CODEEDITORMODEL,
-            generation_config=generation_config,
-            system_instruction=system_prompt,
-        )
-        response = main_model.generate_content(
-            contents =[
-                {"role": "user", "content": "Generate SEARCH/REPLACE blocks for the necessary changes."}
-            ]
+        # Blocks that don't parse or don't match the code shown are sent back up a tier
+        editable = [text for text, is_editable in split_segments(file_content, windows) if is_editable]
+
+        def validate(response):
+            try:
+                text = response.text
+            except ValueError:
+                return "empty response"
+            blocks = json.loads(parse_search_replace_blocks(text))
+            if "<SEARCH>" in text and not blocks:
+                return "malformed SEARCH/REPLACE blocks"
+            if any(not any(block['search'] in segment for segment in editable) for block in blocks):
+                return "SEARCH text not found in the file"
+            return None
+
+        # Make the API call to the code editor (context is not maintained except for code_editor_memory)
+        contents = [{"role": "user", "parts": ["Generate SEARCH/REPLACE blocks for the necessary changes."]}]
+        response = await model_router.generate(
+            "code_editor",
+            lambda model_name: load_genai().GenerativeModel(
+                model_name=model_name,
+                generation_config=generation_config,
+                system_instruction=system_prompt,
+            ),
+            contents,
+            validate=validate,
+            escalate=escalate,
+            prompt_bytes=len(system_prompt) + payload_size(contents),
         )
         # Update token usage for code editor
-        code_editor_tokens['input'] += response.usage_metadata.prompt_token_count
-        code_editor_tokens['output'] += response.usage_metadata.candidates_token_count
+        session.code_editor_tokens['input'] += response.usage_metadata.prompt_token_count
+        session.code_editor_tokens['output'] += response.usage_metadata.candidates_token_count
 
         # Parse the response to extract SEARCH/REPLACE blocks
         edit_instructions = parse_search_replace_blocks(response.text)
 
-        # Update code editor memory (this is the only part that maintains some context between calls)
-        code_editor_memory.append(f"Edit Instructions for {file_path}:\n{response.text}")
-
         # Add the file to code_editor_files set
-        code_editor_files.add(file_path)
+        session.code_editor_files.add(file_path)
 
         return edit_instructions
 
@@ -132,12 +163,33 @@ async def generate_edit_instructions(file_path, file_content, instructions, proj
         console.print(f"Error in generating edit instructions: {str(e)}", style="bold red")
         return []  # Return empty list if any exception occurs
 
-async def apply_edits(file_path, edit_instructions, original_content):
+def apply_block(segments, edit):
+    # Replace the first match of one SEARCH block in the editable segments, in place; False if there is none
+    search_content = edit['search'].strip()
+    # Use regex to find the content, ignoring leading/trailing whitespace
+    pattern = re.compile(re.escape(search_content), re.DOTALL)
+    for index, (text, editable) in enumerate(segments):
+        match = pattern.search(text) if editable else None
+        if match:
+            # Replace the content, preserving the original whitespace
+            start, end = match.span()
+            # Strip <SEARCH> and <REPLACE> tags from replace_content
+            replace_content = re.sub(r'</?SEARCH>|</?REPLACE>', '', edit['replace'].strip())
+            segments[index] = (text[:start] + replace_content + text[end:], True)
+            return True
+    return False
+
+
+@traced("apply_edits")
+async def apply_edits(session, file_path, edit_instructions, original_content, windows=None):
     changes_made = False
-    edited_content = original_content
+    # Only the windows the editor saw can be matched; the rest of a large file is carried over as is
+    segments = split_segments(original_content, windows)
     total_edits = len(edit_instructions)
     failed_edits = []
 
+    from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn
+
     with Progress(
         SpinnerColumn(),
         TextColumn("[progress.description]{task.description}"),
@@ -150,17 +202,8 @@ async def apply_edits(file_path, edit_instructions, original_content):
         for i, edit in enumerate(edit_instructions, 1):
             search_content = edit['search'].strip()
             replace_content = edit['replace'].strip()
-            
-            # Use regex to find the content, ignoring leading/trailing whitespace
-            pattern = re.compile(re.escape(search_content), re.DOTALL)
-            match = pattern.search(edited_content)
-            
-            if match:
-                # Replace the content, preserving the original whitespace
-                start, end = match.span()
-                # Strip <SEARCH> and <REPLACE> tags from replace_content
-                replace_content_cleaned = re.sub(r'</?SEARCH>|</?REPLACE>', '', replace_content)
-                edited_content = edited_content[:start] + replace_content_cleaned + edited_content[end:]
+
+            if apply_block(segments, edit):
                 changes_made = True
                 
                 # Display the diff for this edit
@@ -172,45 +215,60 @@ async def apply_edits(file_path, edit_instructions, original_content):
 
             progress.update(edit_task, advance=1)
 
+    edited_content = join_segments(segments)
     if not changes_made:
         console.print(Panel("No changes were applied. The file content already matches the desired state.", style="green"))
     else:
         # Write the changes to the file
-        with open(file_path, 'w') as file:
+        with open(session.resolve(file_path), 'w') as file:
             file.write(edited_content)
         console.print(Panel(f"Changes have been written to {file_path}", style="green"))
 
     return edited_content, changes_made, "\n".join(failed_edits)
     
-def create_folder(path):
+def create_folder(session, path):
     try:
-        os.makedirs(path, exist_ok=True)
+        os.makedirs(session.resolve(path), exist_ok=True)
         return f"Folder created: {path}"
     except Exception as e:
         return f"Error creating folder: {str(e)}"
 
 
-def create_file(path, content=""):
+def create_file(session, path, content=""):
     try:
-        with open(path, "w", newline='\n', encoding="utf-8") as f:
+        with open(session.resolve(path), "w", newline='\n', encoding="utf-8") as f:
             content = content.replace(r'\n', '\n')
             f.write(content)
-        file_contents[path] = content
+        session.file_contents[path] = content
+        session.file_state.saw(path, content)
         return f"File created: {path}"
     except Exception as e:
         return f"Error creating file: {str(e)}"
 
-async def edit_and_apply(path, instructions, project_context, is_automode=False, max_retries=3):
-    global file_contents
+async def edit_and_apply(session, path, instructions, project_context, is_automode=False, max_retries=3, start_line=None, end_line=None):
+    file_contents = session.file_contents
+    requested = instructions
+    initial_content = None
+    cancelled = False
     try:
         original_content = file_contents.get(path, "")
         if not original_content:
-            with open(path, 'r') as file:
+            with open(session.resolve(path), 'r') as file:
                 original_content = file.read()
             file_contents[path] = original_content
+        initial_content = original_content
 
         for attempt in range(max_retries):
-            edit_instructions_json = await generate_edit_instructions(path, original_content, instructions, project_context, file_contents)
+            # Large files: the editor only gets the part the instructions (or the given lines) are about
+            windows = relevant_windows(original_content, instructions, start_line, end_line)
+            if windows:
+                shown = sum(end - start + 1 for start, end in windows)
+                ranges = ", ".join(f"{start}-{end}" for start, end in windows)
+                total_lines = original_content.count("\n") + 1
+                console.print(Panel(f"Sending lines {ranges} of {path} to the editor ({shown} of {total_lines} lines)", style="cyan"))
+            # A retry means the last answer didn't apply, so it goes to the stronger model
+            edit_instructions_json = await generate_edit_instructions(session, path, original_content, instructions, project_context, file_contents, windows,
+                                                                      escalate=attempt > 0)
             
             if edit_instructions_json:
                 edit_instructions = json.loads(edit_instructions_json)  # Parse JSON here
@@ -219,7 +277,7 @@ async def edit_and_apply(path, instructions, project_context, is_automode=False,
                     console.print(f"Block {i}:")
                     console.print(Panel(f"SEARCH:\n{block['search']}\n\nREPLACE:\n{block['replace']}", expand=False))
 
-                edited_content, changes_made, failed_edits = await apply_edits(path, edit_instructions, original_content)
+                edited_content, changes_made, failed_edits = await apply_edits(session, path, edit_instructions, original_content, windows)
 
                 if changes_made:
                     file_contents[path] = edited_content  # Update the file_contents with the new content
@@ -228,10 +286,13 @@ async def edit_and_apply(path, instructions, project_context, is_automode=False,
                     if failed_edits:
                         console.print(Panel(f"Some edits could not be applied. Retrying...", style="yellow"))
                         instructions += f"\n\nPlease retry the following edits that could not be applied:\n{failed_edits}"
+                        if end_line:
+                            # Keep the given range over the same code now that lines were added or removed
+                            end_line = int(end_line) + edited_content.count("\n") - original_content.count("\n")
                         original_content = edited_content
                         continue
                     
-                    return f"Changes applied to {path}"
+                    return f"Changes applied to {path}\n{session.file_state.show_edit(path, initial_content, edited_content)}"
                 elif attempt == max_retries - 1:
                     return f"No changes could be applied to {path} after {max_retries} attempts. Please review the edit instructions and try again."
                 else:
@@ -240,25 +301,195 @@ async def edit_and_apply(path, instructions, project_context, is_automode=False,
                 return f"No changes suggested for {path}"
         
         return f"Failed to apply changes to {path} after {max_retries} attempts."
+    except asyncio.CancelledError:
+        # Cancelled between attempts: put back the file as it was before this edit began
+        cancelled = True
+        if initial_content is not None and file_contents.get(path) != initial_content:
+            with open(session.resolve(path), 'w') as file:
+                file.write(initial_content)
+            file_contents[path] = initial_content
+            console.print(Panel(f"Edit cancelled; {path} restored.", style="yellow"))
+        raise
     except Exception as e:
         return f"Error editing/applying to file: {str(e)}"
+    finally:
+        # Code editor memory gets what was actually applied, over all attempts; a cancelled edit was undone
+        if not cancelled and initial_content is not None and file_contents.get(path, initial_content) != initial_content:
+            session.code_editor_memory.record(path, requested, initial_content, file_contents[path], session.turn)
 
 
-def read_multiple_files(paths):
-    global file_contents
-    results = []
-    for path in paths:
+def syntax_error(path, original, edited):
+    # What broke when a Python file that parsed before the edit no longer does; None otherwise
+    if not path.endswith(".py"):
+        return None
+    try:
+        ast.parse(edited)
+        return None
+    except SyntaxError as e:
         try:
-            with open(path, 'r') as f:
-                content = f.read()
-            file_contents[path] = content
-            results.append(f"File '{path}' has been read and stored in the system prompt.")
-        except Exception as e:
-            results.append(f"Error reading file '{path}': {str(e)}")
+            ast.parse(original)
+        except SyntaxError:
+            return None
+        return f"the edit leaves a syntax error at line {e.lineno}: {e.msg}"
+
+
+async def plan_file_edit(session, path, original_content, instructions, project_context, max_retries=3):
+    # The edited text of one file from up to max_retries editor calls, retrying the blocks that didn't apply
+    # the way edit_and_apply does; nothing is written here
+    start = time.perf_counter()
+    plan = {"path": path, "content": original_content, "blocks": 0, "attempts": 0, "error": None}
+    content = original_content
+    retry_instructions = instructions
+    missed = []
+    for attempt in range(max_retries):
+        plan["attempts"] += 1
+        windows = relevant_windows(content, retry_instructions, None, None)
+        edit_instructions = json.loads(await generate_edit_instructions(session, path, content, retry_instructions, project_context,
+                                                                        session.file_contents, windows, escalate=attempt > 0) or "[]")
+        if not edit_instructions:
+            break
+        segments = split_segments(content, windows)
+        missed = [edit for edit in edit_instructions if not apply_block(segments, edit)]
+        plan["blocks"] += len(edit_instructions) - len(missed)
+        content = join_segments(segments)
+        if not missed:
+            break
+        failed_edits = "\n".join(f"Edit: {edit['search'].strip()}" for edit in missed)
+        retry_instructions = f"{instructions}\n\nPlease retry the following edits that could not be applied:\n{failed_edits}"
+    plan["content"] = content
+    if missed:
+        plan["error"] = f"{len(missed)} edit(s) could not be applied: " + "; ".join(edit['search'].strip().splitlines()[0] for edit in missed)
+    else:
+        plan["error"] = syntax_error(path, original_content, content)
+    plan["seconds"] = time.perf_counter() - start
+    return plan
+
+
+def write_files_atomically(session, contents, originals):
+    # Stage every file next to its target, then rename them all into place; a failure part way puts back the
+    # files already replaced. Returns None, or what went wrong
+    staged = []
+    replaced = []
+    try:
+        for path, content in contents.items():
+            full_path = session.resolve(path)
+            tmp_path = f"{full_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as file:
+                file.write(content)
+            shutil.copymode(full_path, tmp_path)
+            staged.append((path, tmp_path))
+        for path, tmp_path in staged:
+            os.replace(tmp_path, session.resolve(path))
+            replaced.append(path)
+    except OSError as e:
+        for path in replaced:
+            with open(session.resolve(path), 'w') as file:
+                file.write(originals[path])
+        return f"{type(e).__name__}: {e}"
+    finally:
+        for _, tmp_path in staged:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return None
+
+
+@traced("edit_many")
+async def edit_many(session, paths, instructions, project_context, max_retries=3):
+    # One set of instructions over several files. The editor calls for all the files run at once (under the
+    # shared model rate limit), and the edits are written only if every file's edit applied and still parses,
+    # as one batch
+    start = time.perf_counter()
+    paths = list(dict.fromkeys(paths))
+    if not paths:
+        return "Error: no files given."
+    if len(paths) > EDIT_MANY_MAX_FILES:
+        return f"Error: edit_many takes up to {EDIT_MANY_MAX_FILES} files per call; split the edit into smaller groups."
+
+    file_contents = session.file_contents
+    originals = {}
+    for path in paths:
+        content = file_contents.get(path, "")
+        if not content:
+            try:
+                with open(session.resolve(path), 'r') as file:
+                    content = file.read()
+            except OSError as e:
+                return f"Error editing files: cannot read {path}: {str(e)}"
+        originals[path] = content
+    file_contents.update(originals)
+
+    console.print(Panel(f"Generating edits for {len(paths)} files concurrently: {', '.join(paths)}", style="cyan"))
+    plans = await asyncio.gather(*(plan_file_edit(session, path, originals[path], instructions, project_context, max_retries)
+                                   for path in paths))
+    changed = {plan["path"]: plan["content"] for plan in plans if not plan["error"] and plan["content"] != originals[plan["path"]]}
+
+    # The editor calls take a while; a file changed in the meantime would be overwritten with an edit of the old text
+    for plan in plans:
+        if plan["path"] in changed:
+            read = read_text(session.resolve(plan["path"]), budget=None)
+            if read.content != originals[plan["path"]]:
+                plan["error"] = "the file changed on disk while the edits were being generated"
+                del changed[plan["path"]]
+
+    failures = [plan for plan in plans if plan["error"]]
+    write_error = None
+    if not failures and changed:
+        write_error = write_files_atomically(session, changed, originals)
+
+    lines = []
+    for plan in plans:
+        timing = f"{plan['attempts']} attempt{'s' if plan['attempts'] != 1 else ''}, {plan['seconds']:.1f} s"
+        if plan["error"]:
+            lines.append(f"- {plan['path']}: FAILED, {plan['error']} ({timing})")
+        elif plan["path"] in changed:
+            lines.append(f"- {plan['path']}: {plan['blocks']} block(s) applied ({timing})")
+        else:
+            lines.append(f"- {plan['path']}: no changes suggested ({timing})")
+    elapsed = time.perf_counter() - start
+    editor_time = sum(plan["seconds"] for plan in plans)
+    timing = f"{elapsed:.1f} s ({editor_time:.1f} s of editor calls, run concurrently)"
+
+    if write_error:
+        console.print(Panel(f"{write_error}\n" + "\n".join(lines), title="No files written", style="bold red"))
+        return f"Error: no files were written, as writing them failed ({write_error}); every file was left as it was. Took {timing}.\n" + "\n".join(lines)
+    if failures:
+        console.print(Panel("\n".join(lines), title=f"No files written: {len(failures)} failed", style="bold red"))
+        return (f"No files were written: {len(failures)} of {len(plans)} files could not be edited cleanly, and edit_many writes "
+                f"all or nothing. Fix the instructions for the failed files and call edit_many again, or edit them one at a "
+                f"time with edit_and_apply. Took {timing}.\n" + "\n".join(lines))
+
+    console.print(Panel("\n".join(lines), title=f"Edited {len(changed)} of {len(plans)} files in {elapsed:.1f} s", style="green"))
+    diffs = []
+    for path, content in changed.items():
+        file_contents[path] = content
+        session.code_editor_memory.record(path, instructions, originals[path], content, session.turn)
+        diffs.append(session.file_state.show_edit(path, originals[path], content))
+    header = f"Changes applied to {len(changed)} of {len(plans)} files in {timing}:"
+    return "\n".join([header] + lines + [diff for diff in diffs if diff])
+
+
+def read_multiple_files(session, paths):
+    results = []
+    reads = read_files([session.resolve(path) for path in paths])
+    for path, read in zip(paths, reads):
+        if read.error:
+            results.append(f"Error reading file '{path}': {read.error}")
+        elif read.binary:
+            results.append(f"File '{path}' is a {describe_binary(path, read.size)}.")
+        elif read.truncated:
+            # A partial copy in the system prompt could be written back over the whole file, so it stays out
+            results.append(f"File '{path}' is too large to store in the system prompt; its beginning follows.\n"
+                           f"--- {path} ---\n{read.content}{truncation_marker(read)}")
+        else:
+            session.file_contents[path] = read.content
+            results.append(session.file_state.show(path, read.content))
+    timings = ", ".join(f"{path} {format_size(read.read_bytes)} in {read.elapsed_ms:.1f} ms" for path, read in zip(paths, reads) if not read.error)
+    if timings:
+        results.append(f"[Read {format_size(sum(read.read_bytes for read in reads))}: {timings}]")
     return "\n".join(results)
 
-def stop_process(process_id):
-    global running_processes
+def stop_process(session, process_id):
+    running_processes = session.running_processes
     if process_id in running_processes:
         process = running_processes[process_id]
         if sys.platform == "win32":
@@ -271,27 +502,18 @@ def stop_process(process_id):
         return f"No running process found with ID {process_id}."
 
 
-def setup_virtual_environment():
+def setup_virtual_environment(session):
     venv_name = "code_execution_env"
-    venv_path = os.path.join(os.getcwd(), venv_name)
+    venv_path = os.path.join(session.cwd, venv_name)
     try:
-        if not os.path.exists(venv_path):
-            venv.create(venv_path, with_pip=True)
-        
-        # Activate the virtual environment
-        if sys.platform == "win32":
-            activate_script = os.path.join(venv_path, "Scripts", "activate.bat")
-        else:
-            activate_script = os.path.join(venv_path, "bin", "activate")
-        
-        return venv_path, activate_script
+        # Created on first use, or cloned from a snapshot of a fresh one
+        venv_manager.ensure_venv(venv_path)
+        return venv_path, venv_manager.venv_python(venv_path)
     except Exception as e:
         print(f"Error setting up virtual environment: {str(e)}")
         raise    
 
-async def send_to_ai_for_executing(code, execution_result):
-    global code_execution_tokens
-
+async def send_to_ai_for_executing(session, code, execution_result):
     try:
         system_prompt = f"""
         You are an AI code execution agent. Your task is to analyze the provided code and its execution result from the 'code_execution_env' virtual environment, then provide a concise summary of what worked, what didn't work, and any important observations. Follow these steps:
@@ -313,20 +535,24 @@ async def send_to_ai_for_executing(code, execution_result):
 
         IMPORTANT: PROVIDE ONLY YOUR ANALYSIS AND OBSERVATIONS. DO NOT INCLUDE ANY PREFACING STATEMENTS OR EXPLANATIONS OF YOUR ROLE.
         """
-        code_execution_model = genai.GenerativeModel(
-            model_name=CODEEXECUTIONMODEL,
-            generation_config=generation_config,
-            system_instruction=system_prompt,
-        )
-        response = code_execution_model.generate_content(
-            contents =[
-                {"role": "user", "parts": f"Analyze this code execution from the 'code_execution_env' virtual environment:\n\nCode:\n{code}\n\nExecution Result:\n{execution_result}"}
-            ]
+        contents = [
+            {"role": "user", "parts": f"Analyze this code execution from the 'code_execution_env' virtual environment:\n\nCode:\n{code}\n\nExecution Result:\n{execution_result}"}
+        ]
+        response = await model_router.generate(
+            "code_execution",
+            lambda model_name: load_genai().GenerativeModel(
+                model_name=model_name,
+                generation_config=generation_config,
+                system_instruction=system_prompt,
+            ),
+            contents,
+            validate=require_text,
+            prompt_bytes=len(system_prompt) + payload_size(contents),
         )
         
         # Update token usage for code execution
-        code_execution_tokens['input'] += response.usage_metadata.prompt_token_count
-        code_execution_tokens['output'] += response.usage_metadata.candidates_token_count
+        session.code_execution_tokens['input'] += response.usage_metadata.prompt_token_count
+        session.code_execution_tokens['output'] += response.usage_metadata.candidates_token_count
 
         analysis = response.text
 
@@ -336,34 +562,39 @@ async def send_to_ai_for_executing(code, execution_result):
         console.print(f"Error in AI code execution analysis: {str(e)}", style="bold red")
         return f"Error analyzing code execution from 'code_execution_env': {str(e)}"    
     
-async def execute_code(code, timeout=10):
-    global running_processes
-    venv_path, activate_script = setup_virtual_environment()
+@traced("subprocess.execute_code")
+async def execute_code(session, code, timeout=10):
+    venv_path, python = await asyncio.to_thread(setup_virtual_environment, session)
+    # Packages the code imports and the venv lacks come from the local wheelhouse, before the code runs
+    with span("venv.prepare") as s:
+        environment = await asyncio.to_thread(venv_manager.prepare, venv_path, code, session.cwd, session.cancel_token)
+        s.set(note=environment)
     
     # Generate a unique identifier for this process
-    process_id = f"process_{len(running_processes)}"
+    process_id = f"process_{session.process_counter}"
+    session.process_counter += 1
     
     # Write the code to a temporary file
-    with open(f"{process_id}.py", "w") as f:
+    with open(session.resolve(f"{process_id}.py"), "w") as f:
         f.write(code)
     
-    # Prepare the command to run the code
-    if sys.platform == "win32":
-        command = f'"{activate_script}" && python3 {process_id}.py'
-    else:
-        command = f'source "{activate_script}" && python3 {process_id}.py'
+    # The venv's interpreter directly, with the environment activation would set up for anything the code starts
+    env = dict(os.environ, VIRTUAL_ENV=venv_path, PATH=os.pathsep.join([venv_manager.bin_dir(venv_path), os.environ.get("PATH", "")]))
+    env.pop("PYTHONHOME", None)
     
     # Create a process to run the command
-    process = await asyncio.create_subprocess_shell(
-        command,
+    process = await asyncio.create_subprocess_exec(
+        python,
+        f"{process_id}.py",
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
-        shell=True,
-        preexec_fn=None if sys.platform == "win32" else os.setsid
+        cwd=session.cwd,
+        env=env,
+        start_new_session=sys.platform != "win32"
     )
     
-    # Store the process in our global dictionary
-    running_processes[process_id] = process
+    # Store the process on the session
+    session.running_processes[process_id] = process
     
     try:
         # Wait for initial output or timeout
@@ -371,6 +602,11 @@ async def execute_code(code, timeout=10):
         stdout = stdout.decode()
         stderr = stderr.decode()
         return_code = process.returncode
+    except asyncio.CancelledError:
+        # The turn was cancelled: the code doesn't get to carry on in the background
+        kill_process_group(process)
+        session.running_processes.pop(process_id, None)
+        raise
     except asyncio.TimeoutError:
         # If we timeout, it means the process is still running
         stdout = "Process started and running in the background."
@@ -378,6 +614,8 @@ async def execute_code(code, timeout=10):
         return_code = "Running"
     
     execution_result = f"Process ID: {process_id}\n\nStdout:\n{stdout}\n\nStderr:\n{stderr}\n\nReturn Code: {return_code}"
+    if environment:
+        execution_result = f"Environment: {environment}\n\n{execution_result}"
     return process_id, execution_result    
     
 def generate_and_apply_diff(original_content, new_content, path):
@@ -400,52 +638,135 @@ def generate_and_apply_diff(original_content, new_content, path):
     except Exception as e:
         return f"Error applying changes: {str(e)}"
 
-def write_to_file(path, content):
+def write_to_file(session, path, content):
     try:
-        if os.path.exists(path):
-            with open(path, 'r') as f:
+        full_path = session.resolve(path)
+        if os.path.exists(full_path):
+            with open(full_path, 'r') as f:
                 original_content = f.read()
-            result = generate_and_apply_diff(original_content, content, path)
+            result = generate_and_apply_diff(original_content, content, full_path)
         else:
-            with open(path, 'w', newline='\n', encoding="utf-8") as f:
+            with open(full_path, 'w', newline='\n', encoding="utf-8") as f:
                 content = content.replace(r'\n', '\n')
                 f.write(content)
             result = f"New file created and content written to: {path}"
+        # The caller supplied the content, so the model already has this version
+        session.file_state.saw(path, content)
         return result
     except Exception as e:
         return f"Error writing to file: {str(e)}"
 
-def read_file(path):
+def read_file(session, path, start_line=None, end_line=None, around_pattern=None, full=False):
+    if start_line or end_line or around_pattern:
+        try:
+            return read_file_lines(session, path, start_line, end_line, around_pattern)
+        except Exception as e:
+            return f"Error reading file: {str(e)}"
+    read = read_text(session.resolve(path))
+    if read.error:
+        return f"Error reading file: {read.error}"
+    if read.binary:
+        return f"'{path}' is a {describe_binary(path, read.size)}."
+    if read.truncated:
+        return read.content + truncation_marker(read)
+    # A diff against the version the model last saw, when it has seen one
+    return session.file_state.show(path, read.content, full=full)
+
+def read_file_lines(session, path, start_line=None, end_line=None, around_pattern=None):
+    # Numbered lines from part of a file: a range served from the line index, or the lines around a pattern
+    full_path = session.resolve(path)
+    if around_pattern:
+        try:
+            matcher = re.compile(around_pattern)
+        except re.error:
+            matcher = re.compile(re.escape(around_pattern))
+        read = read_text(full_path, budget=None)
+        if read.error:
+            return f"Error reading file: {read.error}"
+        if read.binary:
+            return f"'{path}' is a {describe_binary(path, read.size)}."
+        lines = read.content.split("\n")
+        if lines and lines[-1] == "":
+            lines.pop()
+        total = len(lines)
+        first, last = int(start_line or 1), int(end_line or total)
+        hits = [number for number in range(max(1, first), min(total, last) + 1) if matcher.search(lines[number - 1])]
+        if not hits:
+            return f"No lines in '{path}' match {around_pattern!r}."
+        windows = []
+        for number in hits[:READ_PATTERN_MAX_MATCHES]:
+            start, end = max(1, number - READ_PATTERN_CONTEXT_LINES), min(total, number + READ_PATTERN_CONTEXT_LINES)
+            if windows and start <= windows[-1][1] + 1:
+                windows[-1][1] = end
+            else:
+                windows.append([start, end])
+        header = f"'{path}': {len(hits)} line{'s' if len(hits) != 1 else ''} matching {around_pattern!r} of {total:,}"
+        if len(hits) > READ_PATTERN_MAX_MATCHES:
+            header += f" (showing the first {READ_PATTERN_MAX_MATCHES})"
+        sections = [(start, lines[start - 1:end]) for start, end in windows]
+    else:
+        start = int(start_line or 1)
+        end = int(end_line) if end_line else start + READ_DEFAULT_RANGE_LINES - 1
+        selected, total = read_lines(full_path, start, end)
+        if not selected:
+            return f"'{path}' has {total:,} lines; nothing in lines {start}-{end}."
+        start = max(1, start)
+        header = f"'{path}' lines {start}-{start + len(selected) - 1} of {total:,}"
+        sections = [(start, selected)]
+
+    output = [header + ":"]
+    size = 0
+    for index, (start, section) in enumerate(sections):
+        if index:
+            output.append("   ...")
+        for number, line in enumerate(section, start):
+            text = f"{number:>6}  {line}"
+            size += len(text) + 1
+            if size > READ_MAX_FILE_BYTES:
+                output.append(f"[... truncated at line {number - 1}; request a smaller range]")
+                return "\n".join(output)
+            output.append(text)
+    return "\n".join(output)
+
+def project_tree(session, path=".", depth=PROJECT_TREE_DEPTH, glob=None):
     try:
-        with open(path, 'r') as f:
-            content = f.read()
-        return content
+        return render_tree(session.resolve(path), depth=int(depth), glob=glob or None, project_root=session.cwd)
     except Exception as e:
-        return f"Error reading file: {str(e)}"
+        return f"Error listing files: {str(e)}"
 
-def list_files(path="."):
+def search_code(session, pattern, glob=None, regex=False):
     try:
-        files = os.listdir(path)
-        return "\n".join(files)
+        return code_index.search_code(session.cwd, pattern, glob=glob or None, is_regex=bool(regex))
+    except re.error as e:
+        return f"Error: invalid regular expression: {str(e)}"
     except Exception as e:
-        return f"Error listing files: {str(e)}"
+        return f"Error searching code: {str(e)}"
 
 def is_command_available(command):
     return shutil.which(command) is not None
     
-def run_command(command):
+@traced("subprocess.run_command")
+def run_command(session, command):
     try:
         cmd = command.split()[0]
         if not is_command_available(cmd):
             return f"Error: Command '{cmd}' is not available on this system."
         
         if platform.system().lower() == "windows":
-            process = subprocess.Popen(f'cmd.exe /c {command}', stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
+            process = subprocess.Popen(f'cmd.exe /c {command}', stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True, cwd=session.cwd)
         else:
             args = shlex.split(command)
-            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        
-        stdout, stderr = process.communicate()
+            # Its own process group, so cancelling the turn can kill whatever the command started too
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=session.cwd, start_new_session=True)
+
+        # This runs on a worker thread the turn's task doesn't wait on once cancelled, so the kill comes from the token
+        token = session.cancel_token
+        stop = token.on_cancel(functools.partial(kill_process_group, process)) if token else None
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            if stop:
+                token.remove(stop)
         return_code = process.returncode
         
         print(f"Command: {command}\n")
@@ -459,187 +780,266 @@ def run_command(command):
     except Exception as e:
         return f"Error executing command: {str(e)}"   
     
-tool_list = [
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name='create_file',
-                description="Create a new file at the specified path with optional content. Use this when you need to create a new file in the project structure.",
-                parameters=Schema(
-                    type= Type.OBJECT,
-                    properties={
-                        "path": Schema(type=Type.STRING)
-                        },
-                    required=["path"]
-                ) 
-            )
-        ]
-    ),
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name='create_folder',
-                description="Create a new folder at the specified path. Use this when you need to create a new directory in the project structure.",
-                parameters=Schema(
-                    type= Type.OBJECT,
-                    properties={
-                        "path": Schema(type=Type.STRING)
-                    },
-                    required=["path"]
-                ) 
-            )
-        ]
-    ),
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name='edit_and_apply',
-                description= "Apply AI-powered improvements to a file based on specific instructions and detailed project context. This function reads the file, processes it in batches using AI with conversation history and comprehensive code-related project context. It generates a diff and allows the user to confirm changes before applying them. The goal is to maintain consistency and prevent breaking connections between files. This tool should be used for complex code modifications that require understanding of the broader project context.",
-                parameters=Schema(
-                    type= Type.OBJECT,
-                    properties={
-                        "path": Schema(type=Type.STRING),
-                        "instructions": Schema(type=Type.STRING),
-                        "project_context": Schema(type=Type.STRING),
-                        },
-                    required=["path", "instructions", "project_context"]
-                ) 
-            )
-        ]
-    ),
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name='execute_code',
-                description="Execute Python code in the 'code_execution_env' virtual environment and return the output. This tool should be used when you need to run code and see its output or check for errors. All code execution happens exclusively in this isolated environment. The tool will return the standard output, standard error, and return code of the executed code. Long-running processes will return a process ID for later management.",
-                parameters=Schema(
-                    type= Type.OBJECT,
-                    properties={
-                        "code": Schema(type=Type.STRING),
-                        },
-                    description = "The Python code to execute in the 'code_execution_env' virtual environment. Include all necessary imports and ensure the code is complete and self-contained.",
-                    required=["code"]
-                ) 
-            )
-        ]
-    ),
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name="stop_process",
-                description="Stop a running process by its ID. This tool should be used to terminate long-running processes that were started by the execute_code tool. It will attempt to stop the process gracefully, but may force termination if necessary. The tool will return a success message if the process is stopped, and an error message if the process doesn't exist or can't be stopped.",
-                parameters=Schema(
-                    type= Type.OBJECT,
-                    properties={
-                        "process_id": Schema(type=Type.STRING),
-                        },
-                    required=["process_id"]
-                ) 
-            )
-        ]
-    ),
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name='read_file',
-                description="Read the contents of a file at the specified path. Use this when you need to examine the contents of an existing file.",
-                parameters=Schema(
-                    type= Type.OBJECT,
-                    properties={
-                        "path": Schema(type=Type.STRING),
-                        },
-                    required=["path"]
-                ) 
-            )
-        ]
-    ),
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name="read_multiple_files",
-                description= "Read the contents of multiple files at the specified paths. This tool should be used when you need to examine the contents of multiple existing files at once. It will return the status of reading each file, and store the contents of successfully read files in the system prompt. If a file doesn't exist or can't be read, an appropriate error message will be returned for that file.",
-                parameters=Schema(
-                    type= Type.OBJECT,
-                    properties={
-                        "paths": Schema(
-                            type=Type.ARRAY,
-                            items= Schema(type= Type.STRING)
-                        ),
-                        },
-                    description = "An array of absolute or relative paths of the files to read. Use forward slashes (/) for path separation, even on Windows systems.",
-                    required=["paths"]
-                ) 
-            )
-        ]
-    ),
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name='list_files',
-                description="List all files and directories in the root folder where the script is running. Use this when you need to see the contents of the current directory.",
-                parameters=Schema(
-                    type= Type.OBJECT,
-                    properties={
-                        "path": Schema(type=Type.STRING),
-                        },
-                    required=["path"]
-                ) 
-            )
-        ]
-    ),
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name='run_command',
-                description= "Execute a local command and return the result. Use this to run system commands or start processes.",
-                parameters=Schema(
-                    type= Type.OBJECT,
-                    properties={
-                        "command": Schema(type=Type.STRING),
-                        },
-                    required=["command"]
-                ) 
-            )
+# The protobuf schemas are built on first use so importing tools stays cheap
+_tool_list = None
+
+
+def get_tool_list():
+    global _tool_list
+    if _tool_list is None:
+        from google.generativeai.protos import Tool, FunctionDeclaration, Schema, Type
+        _tool_list = [
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name='create_file',
+                        description="Create a new file at the specified path with optional content. Use this when you need to create a new file in the project structure.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "path": Schema(type=Type.STRING)
+                                },
+                            required=["path"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name='create_folder',
+                        description="Create a new folder at the specified path. Use this when you need to create a new directory in the project structure.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "path": Schema(type=Type.STRING)
+                            },
+                            required=["path"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name='edit_and_apply',
+                        description= "Apply AI-powered improvements to a file based on specific instructions and detailed project context. This function reads the file, processes it in batches using AI with conversation history and comprehensive code-related project context. It generates a diff and allows the user to confirm changes before applying them. The goal is to maintain consistency and prevent breaking connections between files. This tool should be used for complex code modifications that require understanding of the broader project context. The result includes the applied changes as a diff against the version of the file you last saw. In large files only the parts the instructions refer to are sent to the editor; name the functions or classes to change, or pass start_line/end_line from an earlier ranged read_file.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "path": Schema(type=Type.STRING),
+                                "instructions": Schema(type=Type.STRING),
+                                "project_context": Schema(type=Type.STRING),
+                                "start_line": Schema(type=Type.INTEGER, description="For large files: first line of the code to change, if known."),
+                                "end_line": Schema(type=Type.INTEGER, description="For large files: last line of the code to change, if known."),
+                                },
+                            required=["path", "instructions", "project_context"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name='edit_many',
+                        description="Apply one set of instructions to several files at once, e.g. a rename or signature change that touches many files. The editor works on all the files concurrently, and the edits are written together only if every file's edit applies cleanly (and Python files still parse); otherwise nothing is written and the result says which files failed. The result lists each file's outcome and timing, followed by the applied changes as diffs. Use this instead of several edit_and_apply calls when the same change spans files; the instructions should say what to change in each file.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "paths": Schema(
+                                    type=Type.ARRAY,
+                                    items= Schema(type= Type.STRING)
+                                ),
+                                "instructions": Schema(type=Type.STRING),
+                                "project_context": Schema(type=Type.STRING),
+                                },
+                            required=["paths", "instructions", "project_context"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name='execute_code',
+                        description="Execute Python code in the 'code_execution_env' virtual environment and return the output. This tool should be used when you need to run code and see its output or check for errors. All code execution happens exclusively in this isolated environment. The tool will return the standard output, standard error, and return code of the executed code. Long-running processes will return a process ID for later management.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "code": Schema(type=Type.STRING),
+                                },
+                            description = "The Python code to execute in the 'code_execution_env' virtual environment. Include all necessary imports and ensure the code is complete and self-contained.",
+                            required=["code"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name="stop_process",
+                        description="Stop a running process by its ID. This tool should be used to terminate long-running processes that were started by the execute_code tool. It will attempt to stop the process gracefully, but may force termination if necessary. The tool will return a success message if the process is stopped, and an error message if the process doesn't exist or can't be stopped.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "process_id": Schema(type=Type.STRING),
+                                },
+                            required=["process_id"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name='read_file',
+                        description="Read the contents of a file at the specified path. Use this when you need to examine the contents of an existing file. Binary files are described rather than returned, and files larger than the read limit are cut off with a truncation marker. For large files, read only the part you need: start_line/end_line return that range of lines (numbered), and around_pattern returns the lines surrounding each line matching a regular expression or text. Files are versioned: a file you have already seen comes back as a diff against the version you last saw, or as unchanged; pass full to get the whole file again.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "path": Schema(type=Type.STRING),
+                                "start_line": Schema(type=Type.INTEGER, description="First line to return, 1-based."),
+                                "end_line": Schema(type=Type.INTEGER, description="Last line to return, inclusive."),
+                                "around_pattern": Schema(type=Type.STRING, description="Return numbered lines around each match of this regular expression (or literal text)."),
+                                "full": Schema(type=Type.BOOLEAN, description="Return the whole file even if an earlier version of it is already in the conversation."),
+                                },
+                            required=["path"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name="read_multiple_files",
+                        description= "Read the contents of multiple files at the specified paths. This tool should be used when you need to examine the contents of multiple existing files at once. It will return the contents of each file, or, for a file already seen in the conversation, a diff against the version last seen. If a file doesn't exist or can't be read, an appropriate error message will be returned for that file. Files are read in parallel within a total size budget handed out in the order given, so list the most important files first; files over the per-file limit are returned truncated, and binary files are only described.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "paths": Schema(
+                                    type=Type.ARRAY,
+                                    items= Schema(type= Type.STRING)
+                                ),
+                                },
+                            description = "An array of absolute or relative paths of the files to read. Use forward slashes (/) for path separation, even on Windows systems.",
+                            required=["paths"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name='project_tree',
+                        description="Show the directory tree under a path, recursively, with file sizes and line counts. Entries ignored by .gitignore and folders such as .git, node_modules and code_execution_env are skipped. Use depth to control how far down to go (default 3) and glob (e.g. '*.py' or 'src/**/test_*.py') to list only matching files. Use this to explore the project instead of listing directories one at a time.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "path": Schema(type=Type.STRING),
+                                "depth": Schema(type=Type.INTEGER),
+                                "glob": Schema(type=Type.STRING),
+                                },
+                            required=["path"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name='search_code',
+                        description="Search the contents of every project file for a pattern and return matching lines as path:line: text, with two lines of context. The pattern is a literal string unless regex is true, in which case it is a Python regular expression (use (?i) for case-insensitive). Use glob (e.g. '*.py' or 'src/**/*.ts') to limit which files are searched. Files ignored by .gitignore are skipped. Results are capped; refine the pattern or glob if they are truncated.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "pattern": Schema(type=Type.STRING),
+                                "glob": Schema(type=Type.STRING),
+                                "regex": Schema(type=Type.BOOLEAN),
+                                },
+                            required=["pattern"]
+                        ) 
+                    )
+                ]
+            ),
+            Tool(
+                function_declarations=[
+                    FunctionDeclaration(
+                        name='run_command',
+                        description= "Execute a local command and return the result. Use this to run system commands or start processes.",
+                        parameters=Schema(
+                            type= Type.OBJECT,
+                            properties={
+                                "command": Schema(type=Type.STRING),
+                                },
+                            required=["command"]
+                        ) 
+                    )
+                ]
+            ),
         ]
-    ),
-    
-    
-]
+    return _tool_list
+
+
+async def execute_tool(session, tool_name, tool_input):
+    with span("execute_tool", tool=tool_name, bytes_in=len(json.dumps(tool_input, default=str))) as s:
+        # A repeated read of something that hasn't changed points back at the earlier result
+        turn = session.tool_memo.lookup(session, tool_name, tool_input)
+        if turn is not None:
+            result = {"content": unchanged_message(tool_name, tool_input, turn), "is_error": False}
+            s.set(memo_hit=True, bytes_out=len(result["content"]), is_error=False)
+            return result
+
+        session.tool_memo.invalidate(session, tool_name, tool_input)
+        code_index.invalidate_for_tool(session, tool_name, tool_input)
+        result = await _dispatch_tool(session, tool_name, tool_input)
+        if not result["is_error"]:
+            session.tool_memo.remember(session, tool_name, tool_input, result["content"])
+        s.set(bytes_out=len(str(result["content"])), is_error=result["is_error"])
+        return result
 
 
-async def execute_tool(tool_name, tool_input):
+async def _dispatch_tool(session, tool_name, tool_input):
     try:
         result = None
         is_error = False
         
         if tool_name == "create_folder":
-            result = create_folder(tool_input["path"])
+            result = create_folder(session, tool_input["path"])
         elif tool_name == "create_file":
-            result = create_file(tool_input["path"], tool_input.get("content", ""))
+            result = create_file(session, tool_input["path"], tool_input.get("content", ""))
         elif tool_name == "edit_and_apply":
             result = await edit_and_apply(
+                session,
                 tool_input["path"],
                 tool_input["instructions"],
                 tool_input["project_context"],
-                is_automode=automode
+                is_automode=session.automode,
+                start_line=tool_input.get("start_line"),
+                end_line=tool_input.get("end_line")
             )
+        elif tool_name == "edit_many":
+            result = await edit_many(session, tool_input["paths"], tool_input["instructions"], tool_input["project_context"])
         elif tool_name == "read_file":
-            result = read_file(tool_input["path"])
+            result = read_file(session, tool_input["path"], tool_input.get("start_line"), tool_input.get("end_line"), tool_input.get("around_pattern"), tool_input.get("full", False))
         elif tool_name == "read_multiple_files":
-            result = read_multiple_files(tool_input["paths"])
-        elif tool_name == "list_files":
-            result = list_files(tool_input.get("path", "."))
+            result = await asyncio.to_thread(read_multiple_files, session, tool_input["paths"])
+        elif tool_name == "project_tree":
+            result = project_tree(session, tool_input.get("path", "."), tool_input.get("depth", PROJECT_TREE_DEPTH), tool_input.get("glob"))
+        elif tool_name == "search_code":
+            # The first search of a project builds its index, which can take a while
+            result = await asyncio.to_thread(search_code, session, tool_input["pattern"], tool_input.get("glob"), tool_input.get("regex", False))
         elif tool_name == "stop_process":
-            result = stop_process(tool_input["process_id"])
+            result = stop_process(session, tool_input["process_id"])
         elif tool_name == "execute_code":
-            process_id, execution_result = await execute_code(tool_input["code"])
-            analysis_task = asyncio.create_task(send_to_ai_for_executing(tool_input["code"], execution_result))
+            process_id, execution_result = await execute_code(session, tool_input["code"])
+            analysis_task = asyncio.create_task(send_to_ai_for_executing(session, tool_input["code"], execution_result))
             analysis = await analysis_task
             result = f"{execution_result}\n\nAnalysis:\n{analysis}"
-            if process_id in running_processes:
+            if process_id in session.running_processes:
                 result += "\n\nNote: The process is still running in the background."
         elif tool_name == "run_command":
-            result = run_command(tool_input["command"])
+            # Runs on a worker thread so other sessions keep going while the command does
+            result = await asyncio.to_thread(run_command, session, tool_input["command"])
         else:
             is_error = True
             result = f"Unknown tool: {tool_name}"
@@ -0,0 +1,164 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+from config import TRACE_DIR, TRACE_MAX_TRACES
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_traces = deque(maxlen=TRACE_MAX_TRACES)
+_trace_file = None
+_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent", "start_ns", "end_ns", "attributes", "children", "error")
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.children = []
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    @property
+    def duration(self):
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end - self.start_ns) / 1e9
+
+    @property
+    def self_time(self):
+        return max(0.0, self.duration - sum(child.duration for child in self.children))
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_otel(self):
+        # One span in the OTLP/JSON layout, so traces load into OpenTelemetry tooling
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent.span_id if self.parent else "",
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _otel_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+
+
+def _otel_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def current_span():
+    return _current_span.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    parent = _current_span.get()
+    s = Span(name, parent, attributes)
+    if parent:
+        parent.children.append(s)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        s.end_ns = time.time_ns()
+        _current_span.reset(token)
+        if parent is None:
+            _finish_trace(s)
+
+
+def traced(name=None):
+    # Decorator form of span() for plain and async functions
+    def decorator(func):
+        span_name = name or func.__name__
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _finish_trace(root):
+    global _trace_file
+    with _lock:
+        _traces.append(root)
+        if not TRACE_DIR:
+            return
+        try:
+            if _trace_file is None:
+                os.makedirs(TRACE_DIR, exist_ok=True)
+                path = os.path.join(TRACE_DIR, f"trace_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.jsonl")
+                _trace_file = open(path, "a", encoding="utf-8")
+            for s in root.walk():
+                _trace_file.write(json.dumps(s.to_otel(), ensure_ascii=False) + "\n")
+            _trace_file.flush()
+        except OSError:
+            pass
+
+
+def recent_traces(count=5, name=None):
+    with _lock:
+        traces = [root for root in _traces if name is None or root.name == name]
+    return traces[-count:]
+
+
+def payload_size(obj):
+    # Cheap size estimate for request/response payloads without serialising them
+    if obj is None:
+        return 0
+    if isinstance(obj, str):
+        return len(obj)
+    if isinstance(obj, bytes):
+        return len(obj)
+    if hasattr(obj, "nbytes"):
+        # Payloads kept out of memory (spilled history) know their size without being read back
+        return obj.nbytes
+    if isinstance(obj, Mapping):
+        return sum(payload_size(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(payload_size(item) for item in obj)
+    if hasattr(type(obj), "pb"):
+        return type(obj).pb(obj).ByteSize()
+    return len(str(obj))
@@ -0,0 +1,310 @@
+import argparse
+import ast
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+import venv
+import zipfile
+
+from config import CODE_WHEELHOUSE, CODE_VENV_SNAPSHOT_DIR, CODE_VENV_INSTALL_TIMEOUT
+from cancellation import kill_process_group
+
+# Dependencies for code_execution_env: the third-party imports of a snippet are installed from a local wheelhouse
+# (pip --no-index, so no network is needed) before it runs. Each venv records the set of distributions installed
+# this way, and with CODE_VENV_SNAPSHOT_DIR set a copy of the venv is kept per set, so the next venv that needs
+# the same set is a clone instead of a venv.create and pip run
+
+STATE_FILE = "venv_state.json"
+
+
+def canonical(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def third_party_imports(code, cwd):
+    # Top-level modules the code imports that are neither in the standard library nor next to it in cwd
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return []
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+            names.add(node.module.split(".")[0])
+    return sorted(name for name in names if name not in sys.stdlib_module_names
+                  and not os.path.exists(os.path.join(cwd, f"{name}.py"))
+                  and not os.path.isdir(os.path.join(cwd, name)))
+
+
+def _wheel_modules(path):
+    # Top-level modules a wheel installs, from its file list (foo/..., foo.py, foo.cpython-311-x86_64-linux-gnu.so)
+    modules = set()
+    with zipfile.ZipFile(path) as wheel:
+        for name in wheel.namelist():
+            top = name.split("/")[0]
+            if top.endswith((".dist-info", ".data")) or top == "__pycache__":
+                continue
+            modules.add(top.split(".")[0] if "/" not in name else top)
+    return modules
+
+
+class Wheelhouse:
+    # The .whl files in a directory, by the modules they provide
+    def __init__(self, path):
+        self.path = path
+        self.modules = {}  # import name -> distribution
+        self.wheels = {}  # distribution -> wheel file names
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(".whl"):
+                continue
+            dist = canonical(name.split("-")[0])
+            self.wheels.setdefault(dist, []).append(name)
+            try:
+                for module in _wheel_modules(os.path.join(path, name)):
+                    self.modules.setdefault(module, dist)
+            except (OSError, zipfile.BadZipFile):
+                continue
+
+    def resolve(self, module):
+        # The distribution providing module, or None
+        return self.modules.get(module) or (canonical(module) if canonical(module) in self.wheels else None)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_wheelhouse(path, mtime_ns):
+    return Wheelhouse(path)
+
+
+def get_wheelhouse(path=CODE_WHEELHOUSE):
+    # Rescanned only when the directory changes
+    if not path or not os.path.isdir(path):
+        return None
+    return _load_wheelhouse(path, os.stat(path).st_mtime_ns)
+
+
+def bin_dir(venv_path):
+    return os.path.join(venv_path, "Scripts" if sys.platform == "win32" else "bin")
+
+
+def venv_python(venv_path):
+    return os.path.join(bin_dir(venv_path), "python.exe" if sys.platform == "win32" else "python")
+
+
+def site_packages(venv_path):
+    if sys.platform == "win32":
+        return os.path.join(venv_path, "Lib", "site-packages")
+    return os.path.join(venv_path, "lib", f"python{sys.version_info.major}.{sys.version_info.minor}", "site-packages")
+
+
+def installed_modules(venv_path):
+    # Top-level names importable from the venv's site-packages
+    try:
+        entries = os.listdir(site_packages(venv_path))
+    except OSError:
+        return set()
+    return {entry.split(".")[0] for entry in entries if not entry.endswith((".dist-info", ".egg-info", ".pth"))}
+
+
+def read_state(venv_path):
+    try:
+        with open(os.path.join(venv_path, STATE_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"packages": []}
+
+
+def write_state(venv_path, packages, key):
+    # Replaced, not rewritten: in a clone the old file is a hard link into the snapshot
+    path = os.path.join(venv_path, STATE_FILE)
+    with open(f"{path}.{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"packages": sorted(packages), "key": key}, f)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+
+def state_key(packages, wheelhouse=None):
+    # The venv's identity: the interpreter and the distributions installed, with the wheels they came from
+    lines = [f"python {sys.version_info.major}.{sys.version_info.minor} {sys.platform}"]
+    for dist in sorted(packages):
+        wheels = wheelhouse.wheels.get(dist, []) if wheelhouse else []
+        lines.append(f"{dist} {' '.join(wheels)}")
+    return hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()[:16]
+
+
+def snapshot_path(key, snapshot_dir=CODE_VENV_SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, key) if snapshot_dir else None
+
+
+def _link_or_copy(source, target):
+    # Hard links make a clone nearly free; pip and the bytecode cache replace files rather than write into them
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def clone_venv(source, target):
+    # A venv can't just be copied: its activate scripts and entry points name its own path
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    shutil.copytree(source, tmp_path, symlinks=True, copy_function=_link_or_copy)
+    old, new = os.path.abspath(source).encode(), os.path.abspath(target).encode()
+    for name in os.listdir(bin_dir(tmp_path)):
+        path = os.path.join(bin_dir(tmp_path), name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        if old in data:
+            # A new file rather than a write through the hard link, which would change the source too
+            mode = os.stat(path).st_mode
+            os.remove(path)
+            with open(path, "wb") as f:
+                f.write(data.replace(old, new))
+            os.chmod(path, mode)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.replace(tmp_path, target)
+
+
+def save_snapshot(venv_path, key):
+    # Keep a copy of the venv for the next one that needs the same set; another process may get there first
+    path = snapshot_path(key)
+    if path is None or os.path.exists(path):
+        return
+    os.makedirs(CODE_VENV_SNAPSHOT_DIR, exist_ok=True)
+    try:
+        clone_venv(venv_path, path)
+    except OSError:
+        pass
+
+
+def ensure_venv(venv_path):
+    # The venv at venv_path, created if missing: a clone of the empty-set snapshot when there is one
+    if os.path.exists(venv_python(venv_path)):
+        return venv_path
+    key = state_key([])
+    snapshot = snapshot_path(key)
+    if snapshot and os.path.exists(venv_python(snapshot)):
+        clone_venv(snapshot, venv_path)
+        return venv_path
+    venv.create(venv_path, with_pip=True)
+    write_state(venv_path, [], key)
+    save_snapshot(venv_path, key)
+    return venv_path
+
+
+def pip_install(venv_path, wheelhouse, packages, token=None):
+    # Offline install from the wheelhouse, dependencies included; returns pip's error output, or None
+    command = [venv_python(venv_path), "-m", "pip", "install", "--no-index", "--find-links", wheelhouse.path,
+               "--disable-pip-version-check", "--no-input", "--quiet", *packages]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                               start_new_session=sys.platform != "win32")
+    # Runs on a worker thread; cancelling the turn kills pip through the token
+    stop = token.on_cancel(functools.partial(kill_process_group, process)) if token else None
+    try:
+        _, stderr = process.communicate(timeout=CODE_VENV_INSTALL_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        kill_process_group(process)
+        process.communicate()
+        return f"pip did not finish within {CODE_VENV_INSTALL_TIMEOUT:g} seconds"
+    finally:
+        if stop:
+            token.remove(stop)
+    if process.returncode:
+        return stderr.strip() or f"pip exited with {process.returncode}"
+    return None
+
+
+def prepare(venv_path, code, cwd, token=None):
+    # Install what the code imports and the venv lacks, from the wheelhouse; returns a note for the model, or
+    # None when nothing was missing
+    missing = [module for module in third_party_imports(code, cwd) if module not in installed_modules(venv_path)]
+    if not missing:
+        return None
+    wheelhouse = get_wheelhouse()
+    if wheelhouse is None:
+        return f"Not installed in code_execution_env: {', '.join(missing)} (no local wheelhouse is configured)."
+    wanted = {module: wheelhouse.resolve(module) for module in missing}
+    unavailable = [module for module, dist in wanted.items() if dist is None]
+    dists = sorted({dist for dist in wanted.values() if dist})
+    notes = [f"Not in the local wheelhouse: {', '.join(unavailable)}."] if unavailable else []
+    if not dists:
+        return " ".join(notes)
+
+    start = time.perf_counter()
+    packages = set(read_state(venv_path)["packages"]) | set(dists)
+    key = state_key(packages, wheelhouse)
+    snapshot = snapshot_path(key)
+    if snapshot and os.path.exists(venv_python(snapshot)):
+        clone_venv(snapshot, venv_path)
+        notes.insert(0, f"Installed {', '.join(dists)} from a venv snapshot in {time.perf_counter() - start:.1f} s.")
+        return " ".join(notes)
+
+    error = pip_install(venv_path, wheelhouse, dists, token)
+    if error:
+        notes.insert(0, f"Installing {', '.join(dists)} from the local wheelhouse failed: {error}")
+        return " ".join(notes)
+    write_state(venv_path, packages, key)
+    save_snapshot(venv_path, key)
+    notes.insert(0, f"Installed {', '.join(dists)} from the local wheelhouse in {time.perf_counter() - start:.1f} s.")
+    return " ".join(notes)
+
+
+def prebuild(packages):
+    # A snapshot for exactly these distributions (and the empty base), ahead of the first snippet that needs them
+    wheelhouse = get_wheelhouse()
+    if wheelhouse is None or not CODE_VENV_SNAPSHOT_DIR:
+        return "Set CODE_WHEELHOUSE and CODE_VENV_SNAPSHOT_DIR first."
+    dists = sorted({canonical(package) for package in packages})
+    unknown = [dist for dist in dists if dist not in wheelhouse.wheels]
+    if unknown:
+        return f"Not in the wheelhouse: {', '.join(unknown)}"
+    os.makedirs(CODE_VENV_SNAPSHOT_DIR, exist_ok=True)
+    build_path = os.path.join(CODE_VENV_SNAPSHOT_DIR, f"build.{os.getpid()}")
+    try:
+        ensure_venv(build_path)
+        key = state_key(dists, wheelhouse)
+        if dists and not os.path.exists(snapshot_path(key)):
+            error = pip_install(build_path, wheelhouse, dists)
+            if error:
+                return f"Installing {', '.join(dists)} failed: {error}"
+            write_state(build_path, dists, key)
+            save_snapshot(build_path, key)
+    finally:
+        shutil.rmtree(build_path, ignore_errors=True)
+    return f"Snapshot {key} ready for: {', '.join(dists) or 'no packages'}"
+
+
+def list_snapshots():
+    if not CODE_VENV_SNAPSHOT_DIR or not os.path.isdir(CODE_VENV_SNAPSHOT_DIR):
+        return []
+    snapshots = []
+    for key in sorted(os.listdir(CODE_VENV_SNAPSHOT_DIR)):
+        path = os.path.join(CODE_VENV_SNAPSHOT_DIR, key)
+        if os.path.exists(venv_python(path)):
+            snapshots.append((key, read_state(path)["packages"]))
+    return snapshots
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="gemini.py venv", description="Prebuild code_execution_env snapshots from the local wheelhouse")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("prebuild", help="Build the snapshot for a set of distributions")
+    build.add_argument("packages", nargs="*", help="Distribution names in CODE_WHEELHOUSE; none builds the empty base")
+    commands.add_parser("list", help="List the snapshots in CODE_VENV_SNAPSHOT_DIR")
+    args = parser.parse_args(argv)
+    if args.command == "prebuild":
+        print(prebuild(args.packages))
+    else:
+        for key, packages in list_snapshots():
+            print(f"{key}  {', '.join(packages) or '(base)'}")
+    return 0
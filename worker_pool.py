@@ -0,0 +1,188 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from collections import deque
+from contextlib import nullcontext
+
+from config import *
+
+MAX_ATTEMPTS = 2  # a task in flight on a crashed worker is retried once elsewhere
+
+
+def worker_main(index, inbox, results, options):
+    # Own process group, so killing a hung worker also takes down the commands it started
+    if hasattr(os, "setsid"):
+        os.setsid()
+
+    import model_client
+
+    # Each worker gets its share of the requests-per-minute budget
+    model_client.rate_limiter = model_client.RateLimiter(options["requests_per_minute"])
+    if MODEL_BACKEND == "fake":
+        from fake_backend import FakeBackend, install_fake_backend, scripted
+        install_fake_backend(FakeBackend(scripted()))
+
+    with nullcontext() if options["verbose"] else silenced_console():
+        asyncio.run(_worker_loop(index, inbox, results, options))
+
+
+async def _worker_loop(index, inbox, results, options):
+    from batch import execute_task
+
+    loop = asyncio.get_running_loop()
+    running = set()
+
+    async def run(task):
+        record = await execute_task(task, options["max_iterations"], options["workspaces"])
+        record["worker"] = index
+        results.put(("finished", index, record))
+        results.put(("ready", index, None))
+
+    # Ask for one task per free slot; the supervisor hands them out as they come in
+    for _ in range(options["concurrency"]):
+        results.put(("ready", index, None))
+    while True:
+        task = await loop.run_in_executor(None, inbox.get)
+        if task is None:
+            break
+        job = asyncio.create_task(run(task))
+        running.add(job)
+        job.add_done_callback(running.discard)
+    if running:
+        await asyncio.gather(*running)
+
+
+class Worker:
+    def __init__(self, context, index, results, options):
+        self.index = index
+        self.inbox = context.Queue()
+        self.free = 0
+        self.in_flight = {}  # task id -> (task, start time)
+        self.process = context.Process(target=worker_main, args=(index, self.inbox, results, options), daemon=True)
+        self.process.start()
+
+    def assign(self, task):
+        self.free -= 1
+        self.in_flight[task["id"]] = (task, time.monotonic())
+        self.inbox.put(task)
+
+    def kill(self):
+        # Signal the whole group even if the worker already died, so commands it started don't outlive it
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (AttributeError, ProcessLookupError, PermissionError):
+            if self.process.is_alive():
+                self.process.kill()
+        self.process.join()
+
+
+class Supervisor:
+    # Tasks go to whichever worker asks for one, so fast workers take more of the backlog
+    def __init__(self, tasks, args, writer, progress):
+        self.pending = deque(tasks)
+        self.remaining = {task["id"] for task in tasks}
+        self.attempts = {}
+        self.args = args
+        self.writer = writer
+        self.progress = progress
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.options = {
+            "concurrency": args.concurrency,
+            "max_iterations": args.max_iterations,
+            "workspaces": args.workspaces,
+            "verbose": args.verbose,
+            "requests_per_minute": MODEL_REQUESTS_PER_MINUTE / args.workers,
+        }
+        self.workers = {}
+        self.spawned = 0
+
+    def spawn(self):
+        # Ids are never reused, so late messages from a killed worker can't be credited to its replacement
+        self.spawned += 1
+        self.workers[self.spawned] = Worker(self.context, self.spawned, self.results, self.options)
+
+    def dispatch(self):
+        for worker in self.workers.values():
+            while worker.free > 0 and self.pending:
+                worker.assign(self.pending.popleft())
+
+    def finish(self, record):
+        if record["id"] not in self.remaining:
+            return
+        self.remaining.discard(record["id"])
+        self.writer.write(record)
+        self.progress(record)
+
+    def fail(self, task, error, started):
+        self.finish({"id": task["id"], "status": "error", "error": error, "elapsed_s": time.monotonic() - started})
+
+    def replace(self, worker, hung=(), reason=""):
+        # Kill the worker, settle what it was running and start a fresh one in its place
+        worker.kill()
+        for task_id, (task, started) in worker.in_flight.items():
+            attempts = self.attempts[task_id] = self.attempts.get(task_id, 0) + 1
+            if task_id in hung or attempts >= MAX_ATTEMPTS:
+                self.fail(task, reason, started)
+            else:
+                self.pending.appendleft(task)
+        del self.workers[worker.index]
+        if self.remaining:
+            self.spawn()
+
+    def check_workers(self):
+        now = time.monotonic()
+        for worker in list(self.workers.values()):
+            if not worker.process.is_alive():
+                self.replace(worker, reason=f"worker {worker.index} exited with code {worker.process.exitcode}")
+            elif self.args.task_timeout:
+                hung = {task_id for task_id, (_, started) in worker.in_flight.items() if now - started > self.args.task_timeout}
+                if hung:
+                    self.replace(worker, hung, f"timed out after {self.args.task_timeout:g} s; worker {worker.index} was restarted")
+
+    def handle(self, message):
+        kind, index, payload = message
+        worker = self.workers.get(index)
+        if kind == "ready":
+            if worker is not None:
+                worker.free += 1
+        elif kind == "finished":
+            if worker is not None:
+                worker.in_flight.pop(payload["id"], None)
+            self.finish(payload)
+
+    def run(self):
+        for _ in range(self.args.workers):
+            self.spawn()
+        try:
+            while self.remaining:
+                try:
+                    self.handle(self.results.get(timeout=0.5))
+                except queue.Empty:
+                    pass
+                self.check_workers()
+                self.dispatch()
+            for worker in self.workers.values():
+                worker.inbox.put(None)
+            for worker in self.workers.values():
+                worker.process.join(timeout=10)
+        finally:
+            for worker in self.workers.values():
+                worker.kill()
+
+
+def run_pool(args):
+    from batch import BatchProgress, ResultWriter, pending_tasks
+
+    pending = pending_tasks(args)
+    progress = BatchProgress(len(pending))
+    writer = ResultWriter(args.output)
+    try:
+        if pending:
+            Supervisor(pending, args, writer, progress).run()
+    finally:
+        writer.close()
+    return progress.finish(args.output)